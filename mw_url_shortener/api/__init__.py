@@ -1 +0,0 @@
-print(f"imported mw_url_shortener.api.__init__ as {__name__}")
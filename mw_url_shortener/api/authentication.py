@@ -1,11 +1,13 @@
-print(f"imported mw_url_shortener.api.authentication as {__name__}")
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from passlib.context import CryptContext
 from pony.orm import Database
 
-from ..database import get_db, user
+from ..database import user
 from ..database.models import UserModel
+from ..metrics import PASSWORD_VERIFY_SECONDS
+from ..server import get_app_db, get_settings
+from ..settings import ServerSettings
 from ..types import HashedPassword, PlainPassword, Username
 
 security = HTTPBasic()
@@ -24,7 +26,8 @@ def verify_password(
     Copied from:
     https://fastapi.tiangolo.com/tutorial/security/oauth2-jwt/#hash-and-verify-the-passwords
     """
-    return password_context.verify(plain_password, hashed_password)
+    with PASSWORD_VERIFY_SECONDS.time():
+        return password_context.verify(plain_password, hashed_password)
 
 
 def hash_password(plain_password: PlainPassword) -> HashedPassword:
@@ -37,7 +40,7 @@ def hash_password(plain_password: PlainPassword) -> HashedPassword:
 # The passlib module's CryptContext automatically creates salts and adds them
 # to the password hash as needed
 def authorize(
-    db: Database = Depends(get_db),
+    db: Database = Depends(get_app_db),
     credentials: HTTPBasicCredentials = Depends(security),
 ) -> UserModel:
     """
@@ -53,13 +56,30 @@ def authorize(
         detail="Incorrect email or password",
         headers={"WWW-Authenticate": "Basic"},
     )
-    user = user.get(db=db, username=credentials.username)
-    if not user:
-        raise authentication_error
+    try:
+        found_user = user.get(db=db, username=credentials.username)
+    except user.UserNotFoundError as err:
+        raise authentication_error from err
 
     if not verify_password(
-        plain_password=credentials.password, hashed_password=user.hashed_password
+        plain_password=credentials.password, hashed_password=found_user.hashed_password
     ):
         raise authentication_error
 
-    return credentials.username
+    return found_user
+
+
+def authorize_sync_user(
+    settings: ServerSettings = Depends(get_settings),
+    current_user: UserModel = Depends(authorize),
+) -> UserModel:
+    """
+    A FastAPI dependency that only lets the users in sync_users through, for
+    endpoints that show every user's redirects
+    """
+    if current_user.username not in settings.sync_users:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only sync users can read every user's redirects",
+        )
+    return current_user
@@ -0,0 +1,38 @@
+"""
+Reports how full the key space is
+"""
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, Depends, Query
+from pony.orm import Database
+
+from ..database.keyspace import MAX_FAILURE_PROBABILITY, analyze_keyspace, report_dict
+from ..profiling import profiled
+from ..server import get_app_db, get_settings
+from ..settings import ServerSettings
+from ..utils import DEFAULT_HOST
+
+router_v1 = APIRouter()
+
+
+@router_v1.get("/")
+@profiled
+def read(
+    key_length: Optional[int] = Query(None, ge=1),
+    max_failure_probability: float = Query(MAX_FAILURE_PROBABILITY, gt=0, lt=1),
+    host: str = DEFAULT_HOST,
+    db: Database = Depends(get_app_db),
+    settings: ServerSettings = Depends(get_settings),
+) -> Dict[str, Any]:
+    """
+    the occupancy of each key length, and whether key_length should be raised
+
+    key_length defaults to the server's current setting
+    """
+    report = analyze_keyspace(
+        db=db,
+        key_length=key_length or settings.key_length,
+        max_failure_probability=max_failure_probability,
+        host=host,
+    )
+    return report_dict(report)
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, FastAPI
 
-from . import redirects, users
+from . import keyspace, redirects, users
 from .authentication import authorize
 
 api_router_v1 = APIRouter()
@@ -16,6 +16,11 @@ api_router_v1.include_router(
     prefix="/redirects",
     tags=["redirects"],
 )
+api_router_v1.include_router(
+    keyspace.router_v1,
+    prefix="/keyspace",
+    tags=["keyspace"],
+)
 
 
 api_app_v1 = FastAPI(
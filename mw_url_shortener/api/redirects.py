@@ -1,31 +1,212 @@
-print(f"imported mw_url_shortener.api.redirects as {__name__}")
 """
 Manages the redirects portion of the API
 """
-from fastapi import APIRouter, Body
+from typing import List, Optional, Union
 
-from ..database.entities import RedirectEntity
-from ..database.interface import add_redirect
-from ..database.models import Redirect
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, status
+from pony.orm import Database
+
+from ..database.errors import (
+    DatabaseError,
+    DuplicateKeyError,
+    DuplicateThresholdError,
+    RedirectQuotaError,
+    UserNotFoundError,
+)
+from ..database.interface import (
+    create_redirect,
+    create_redirects,
+    last_change_sequence,
+    list_changes,
+    list_redirects,
+)
+from ..database.models import (
+    BulkResultModel,
+    NewRedirectModel,
+    RedirectChangeModel,
+    RedirectModel,
+    RedirectSnapshotModel,
+    UserModel,
+)
+from ..profiling import profiled
+from ..server import get_app_db, get_settings
+from ..settings import ServerSettings
+from ..types import Key
+from ..utils import DEFAULT_HOST
+from .authentication import authorize, authorize_sync_user
 
 router_v1 = APIRouter()
 
+# The most redirects one bulk create can make
+MAX_BULK_CREATE = 1000
 
-@router_v1.post("/", response_model=Redirect)
-async def create(new_redirect: Redirect = Body(...)) -> RedirectEntity:
-    return add_redirect(redirect=new_redirect)
+# The status each error would give, if the redirect was made alone
+ERROR_STATUSES = {
+    DuplicateKeyError: status.HTTP_409_CONFLICT,
+    DuplicateThresholdError: status.HTTP_409_CONFLICT,
+    RedirectQuotaError: status.HTTP_403_FORBIDDEN,
+    UserNotFoundError: status.HTTP_404_NOT_FOUND,
+}
 
 
-@router_v1.get("/")
-async def read() -> None:
-    raise NotImplementedError()
+def _served(host: str, settings: ServerSettings) -> bool:
+    """
+    whether requests can reach redirects on a host: DEFAULT_HOST is reached
+    from every domain, or from any Host if there are none
+    """
+    return host == DEFAULT_HOST or host in settings.domains
+
+
+def _unserved_detail(host: str) -> str:
+    return f"'{host}' isn't one of the domains this server answers for"
+
+
+def _bulk_result(result: Union[RedirectModel, DatabaseError]) -> BulkResultModel:
+    if isinstance(result, RedirectModel):
+        return BulkResultModel(status=status.HTTP_200_OK, redirect=result)
+    return BulkResultModel(status=ERROR_STATUSES[type(result)], detail=str(result))
+
+
+@router_v1.post("/", response_model=RedirectModel)
+@profiled
+def create(
+    new_redirect: RedirectModel = Body(...),
+    db: Database = Depends(get_app_db),
+    settings: ServerSettings = Depends(get_settings),
+    current_user: UserModel = Depends(authorize),
+) -> RedirectModel:
+    "adds a redirect, owned by the current user, on a host the server answers for"
+    if not _served(new_redirect.host, settings):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=_unserved_detail(new_redirect.host),
+        )
+    try:
+        return create_redirect(
+            redirect=new_redirect.copy(update={"owner": current_user.username}),
+            db=db,
+        )
+    except DuplicateKeyError as err:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(err))
+    except RedirectQuotaError as err:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(err))
+
+
+@router_v1.post("/bulk", response_model=List[BulkResultModel])
+@profiled
+def create_bulk(
+    new_redirects: List[NewRedirectModel] = Body(...),
+    db: Database = Depends(get_app_db),
+    settings: ServerSettings = Depends(get_settings),
+    current_user: UserModel = Depends(authorize),
+) -> List[BulkResultModel]:
+    """
+    adds many redirects, owned by the current user, in one transaction;
+    redirects without a key are given a new one
+
+    there's a result for each redirect, in the same order, with the status
+    making it alone would have had, so one bad redirect doesn't stop the
+    others
+    """
+    if len(new_redirects) > MAX_BULK_CREATE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"at most {MAX_BULK_CREATE} redirects can be made at once",
+        )
+    served = [
+        new_redirect.copy(update={"owner": current_user.username})
+        for new_redirect in new_redirects
+        if _served(new_redirect.host, settings)
+    ]
+    created = iter(create_redirects(served, db=db, key_length=settings.key_length))
+    return [
+        _bulk_result(next(created))
+        if _served(new_redirect.host, settings)
+        else BulkResultModel(
+            status=status.HTTP_400_BAD_REQUEST,
+            detail=_unserved_detail(new_redirect.host),
+        )
+        for new_redirect in new_redirects
+    ]
+
+
+@router_v1.get("/", response_model=List[RedirectModel])
+@profiled
+def read(
+    host: str = DEFAULT_HOST,
+    after: Optional[Key] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Database = Depends(get_app_db),
+    current_user: UserModel = Depends(authorize),
+) -> List[RedirectModel]:
+    """
+    one page of the current user's redirects on one host, in order of their
+    keys
+
+    the next page starts after the key of the last redirect on this one
+    """
+    return list_redirects(
+        db=db, owner=current_user.username, host=host, after=after, limit=limit
+    )
+
+
+@router_v1.get("/changes", response_model=List[RedirectChangeModel])
+@profiled
+def read_changes(
+    after: int = Query(0, ge=0),
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Database = Depends(get_app_db),
+    current_user: UserModel = Depends(authorize_sync_user),
+) -> List[RedirectChangeModel]:
+    """
+    the changes made to every redirect after the one numbered after, oldest
+    first, for caches to apply; only sync users can read them
+
+    the next request passes the sequence of the last change in this one as
+    after; an empty list means the cache is up to date
+    """
+    return list_changes(db=db, after=after, limit=limit)
+
+
+@router_v1.get("/snapshot", response_model=RedirectSnapshotModel)
+@profiled
+def read_snapshot(
+    after_host: Optional[str] = None,
+    after: Optional[Key] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Database = Depends(get_app_db),
+    current_user: UserModel = Depends(authorize_sync_user),
+) -> RedirectSnapshotModel:
+    """
+    one page of every user's current redirects, on every host, in order of
+    their hosts, then keys, for a new cache to start from; only sync users can
+    read them
+
+    the next page starts after the host and key of the last redirect on this
+    one; once it has every page, the cache follows the change log from the
+    first page's sequence, which was read before the page was
+    """
+    if (after_host is None) != (after is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="after_host and after are given together",
+        )
+    sequence = last_change_sequence(db=db)
+    return RedirectSnapshotModel(
+        sequence=sequence,
+        redirects=list_redirects(
+            db=db, after_host=after_host, after=after, limit=limit
+        ),
+    )
 
 
 @router_v1.patch("/")
+@profiled
 async def update() -> None:
     raise NotImplementedError()
 
 
 @router_v1.delete("/")
+@profiled
 async def delete() -> None:
     raise NotImplementedError()
@@ -1,27 +1,32 @@
-print(f"imported mw_url_shortener.api.users as {__name__}")
 """
 Manages the users portion of the API
 """
 from fastapi import APIRouter
 
+from ..profiling import profiled
+
 router_v1 = APIRouter()
 
 
 @router_v1.post("/")
+@profiled
 async def create() -> None:
     raise NotImplementedError()
 
 
 @router_v1.get("/")
+@profiled
 async def read() -> None:
     raise NotImplementedError()
 
 
 @router_v1.patch("/")
+@profiled
 async def update() -> None:
     raise NotImplementedError()
 
 
 @router_v1.delete("/")
+@profiled
 async def delete() -> None:
     raise NotImplementedError()
@@ -1,4 +1,3 @@
-print(f"imported mw_url_shortener.client as {__name__}")
 """
 The client for interacting with a running, remote server
 
@@ -11,4 +10,608 @@ mw_url_shortener server --docs --port 8000
 Then go to:
 
 http://localhost:8000/docs
+
+ApiClient keeps a pool of HTTP/1.1 keep-alive connections, shared between
+threads, so a busy service only pays for connection and TLS setup once per
+connection, instead of once per call; AsyncApiClient does the same for
+asyncio code, by sending requests from a pool of worker threads
+
+shorten() calls made around the same time, from any number of threads or
+tasks, are collected into one request to the bulk create endpoint, which
+makes them all in one transaction; create_many() does that for a list of
+redirects directly
+
+requests that fail because a connection dropped, or because the server was
+briefly unavailable, are retried with exponential backoff; creates are only
+retried when the server can't have made the redirects
+
+The client subcommand runs a sync agent (see sync.py), which uses ApiClient to
+follow a server's changes to its redirects
 """
+import asyncio
+import base64
+import http.client
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+from urllib.parse import quote, urlencode, urlsplit
+
+import orjson
+
+from .database.models import (
+    BulkResultModel,
+    NewRedirectModel,
+    RedirectChangeModel,
+    RedirectModel,
+    RedirectSnapshotModel,
+)
+from .types import Key, Uri, Username
+from .utils import DEFAULT_HOST
+
+__all__ = [
+    "ClientError",
+    "Retry",
+    "ConnectionPool",
+    "ApiClient",
+    "AsyncApiClient",
+]
+
+# How long to wait, in seconds, for the server to answer
+TIMEOUT = 10.0
+
+# How many connections to the server are kept open at most
+MAX_CONNECTIONS = 10
+
+# How many shorten() calls are sent in one bulk create, at most; the server
+# takes up to 1000
+BATCH_SIZE = 100
+
+# How long, in seconds, a shorten() call waits for others to share its
+# request with
+MAX_DELAY = 0.005
+
+
+class ClientError(Exception):
+    "the server couldn't be reached, or refused a request"
+
+    def __init__(self, message: str, status: Optional[int] = None) -> None:
+        super().__init__(message)
+        # the HTTP status code, if the server answered
+        self.status = status
+
+
+class Retry(NamedTuple):
+    "how requests that fail are retried"
+    # how many times a request is sent, at most
+    attempts: int = 4
+    # how long to wait, in seconds, before the first retry; this doubles
+    # with each retry, up to max_backoff, and is randomly shortened by up to
+    # half, so clients that failed together don't retry together
+    backoff: float = 0.05
+    max_backoff: float = 2.0
+    # responses that mean the server is briefly unavailable
+    statuses: FrozenSet[int] = frozenset({502, 503, 504})
+
+    def delay(self, retry: int) -> float:
+        "how long to wait before a retry, counting from 0"
+        return min(self.max_backoff, self.backoff * 2 ** retry) * random.uniform(0.5, 1)
+
+
+class _RequestFailed(Exception):
+    "a request didn't get a response"
+
+    def __init__(self, error: Exception, unsent: bool) -> None:
+        super().__init__(str(error))
+        # whether the server can't have acted on the request: it was never
+        # sent, or an idle connection had been closed by the server
+        self.unsent = unsent
+
+
+class ConnectionPool:
+    """
+    keep-alive connections to one server, which any number of threads can
+    send requests over; connections are opened as they're needed, up to
+    max_connections, and reused, most recently used first
+    """
+
+    def __init__(
+        self,
+        server_url: str,
+        max_connections: int = MAX_CONNECTIONS,
+        timeout: float = TIMEOUT,
+    ) -> None:
+        url = urlsplit(server_url)
+        if url.scheme not in ("http", "https") or not url.hostname:
+            raise ValueError(f"expected an http or https url, got '{server_url}'")
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        self._connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._netloc = url.netloc.rpartition("@")[2]
+        self._timeout = timeout
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _checkout(self) -> Tuple[http.client.HTTPConnection, bool]:
+        "an idle connection, or a new one, and whether it's been used before"
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connection_class(self._netloc, timeout=self._timeout), False
+
+    def request(
+        self, method: str, target: str, body: Optional[bytes], headers: Dict[str, str]
+    ) -> Tuple[int, bytes]:
+        "sends a request, and returns the status and body of the response"
+        with self._slots:
+            connection, reused = self._checkout()
+            sent = False
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as err:
+                connection.close()
+                # NOTE: a server closing an idle connection just as a request
+                # is sent over it looks the same as a server that dropped the
+                # connection while acting on it; like most clients, this
+                # assumes the first
+                unsent = not sent or (
+                    reused
+                    and isinstance(
+                        err, (http.client.RemoteDisconnected, ConnectionResetError)
+                    )
+                )
+                raise _RequestFailed(err, unsent) from err
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    self._idle.append(connection)
+            return response.status, data
+
+    def close(self) -> None:
+        "closes the idle connections"
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class _Batcher:
+    """
+    collects items submitted from many threads into batches, which are sent
+    as soon as one is full, or max_delay after its first item was submitted
+
+    a full batch is sent by the thread that filled it; the rest are sent by a
+    timer thread
+    """
+
+    def __init__(
+        self,
+        send: Callable[[List[Any]], List[Any]],
+        batch_size: int,
+        max_delay: float,
+    ) -> None:
+        self._send = send
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._pending: List[Tuple[Any, Future]] = []
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def submit(self, item: Any) -> Future:
+        "adds an item to the next batch, and returns a future for its result"
+        future: Future = Future()
+        batch = None
+        with self._lock:
+            self._pending.append((item, future))
+            if len(self._pending) >= self._batch_size:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._max_delay, self._send_pending)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._send_batch(batch)
+        return future
+
+    def _take(self) -> List[Tuple[Any, Future]]:
+        "takes the pending items; needs the lock"
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _send_pending(self) -> None:
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send_batch(batch)
+
+    def _send_batch(self, batch: List[Tuple[Any, Future]]) -> None:
+        try:
+            results = self._send([item for item, _ in batch])
+        except Exception as err:  # pylint: disable=broad-except
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+class _AsyncBatcher:
+    "like _Batcher, for coroutines on one event loop"
+
+    def __init__(
+        self,
+        send: Callable[[List[Any]], Awaitable[List[Any]]],
+        batch_size: int,
+        max_delay: float,
+    ) -> None:
+        self._send = send
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._pending: List[Tuple[Any, "asyncio.Future[Any]"]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, item: Any) -> Any:
+        "adds an item to the next batch, and waits for its result"
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self._batch_size:
+            self._send_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_delay, self._send_pending)
+        return await future
+
+    def _send_pending(self) -> None:
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if batch:
+            asyncio.ensure_future(self._send_batch(batch))
+
+    async def _send_batch(self, batch: List[Tuple[Any, "asyncio.Future[Any]"]]) -> None:
+        try:
+            results = await self._send([item for item, _ in batch])
+        except Exception as err:  # pylint: disable=broad-except
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def _new_redirect(
+    uri: Uri,
+    key: Optional[Key] = None,
+    host: str = DEFAULT_HOST,
+    expires_at: Optional[datetime] = None,
+) -> NewRedirectModel:
+    return NewRedirectModel(host=host, key=key, uri=uri, expires_at=expires_at)
+
+
+def _created(result: BulkResultModel) -> RedirectModel:
+    "the redirect a bulk create made, or the error it gave"
+    if result.redirect is None:
+        raise ClientError(f"{result.status}: {result.detail}", status=result.status)
+    return result.redirect
+
+
+def _chunks(items: List[Any], size: int) -> Iterable[List[Any]]:
+    return (items[start : start + size] for start in range(0, len(items), size))
+
+
+class ApiClient:
+    """
+    talks to a server's API, over a pool of keep-alive connections; it can be
+    shared between threads
+
+    server_url is where the server is, like http://127.0.0.1:8000, and the API
+    is under its api_key
+    """
+
+    def __init__(
+        self,
+        server_url: str,
+        api_key: Key,
+        username: Username,
+        password: str,
+        timeout: float = TIMEOUT,
+        max_connections: int = MAX_CONNECTIONS,
+        retry: Retry = Retry(),
+        batch_size: int = BATCH_SIZE,
+        max_delay: float = MAX_DELAY,
+    ) -> None:
+        self.server_url = server_url
+        self.retry = retry
+        self.batch_size = batch_size
+        self._pool = ConnectionPool(server_url, max_connections, timeout)
+        path = urlsplit(server_url).path.rstrip("/")
+        self._prefix = f"{path}/{quote(api_key, safe='')}/v1"
+        credentials = f"{username}:{password}".encode("latin-1")
+        self._headers = {
+            "Authorization": "Basic " + base64.b64encode(credentials).decode("ascii"),
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        self._batcher = _Batcher(self._create_batch, batch_size, max_delay)
+
+    def close(self) -> None:
+        "closes the idle connections"
+        self._pool.close()
+
+    def __enter__(self) -> "ApiClient":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Any = None,
+    ) -> Any:
+        """
+        sends a request to a path under the API, retrying it if that's safe,
+        and returns the JSON it's answered with
+
+        GET requests are retried after any failure; others only when the
+        server can't have acted on them
+        """
+        target = self._prefix + path
+        if params:
+            target += "?" + urlencode(params)
+        data = None if body is None else orjson.dumps(body)
+        idempotent = method == "GET"
+
+        for attempt in range(self.retry.attempts):
+            last_attempt = attempt == self.retry.attempts - 1
+            try:
+                status, payload = self._pool.request(
+                    method, target, data, self._headers
+                )
+            except _RequestFailed as err:
+                if last_attempt or not (idempotent or err.unsent):
+                    raise ClientError(f"could not reach {self.server_url}: {err}")
+            else:
+                retryable = status in self.retry.statuses and (
+                    idempotent or status == 503
+                )
+                if last_attempt or not retryable:
+                    return self._decode(status, payload)
+            time.sleep(self.retry.delay(attempt))
+        raise AssertionError("unreachable")
+
+    @staticmethod
+    def _decode(status: int, payload: bytes) -> Any:
+        if status != 200:
+            try:
+                detail = orjson.loads(payload)["detail"]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                detail = payload.decode("utf-8", errors="replace")
+            raise ClientError(f"{status}: {detail}", status=status)
+        return orjson.loads(payload)
+
+    def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        "requests a path under the API, and returns the JSON it answers with"
+        return self.request("GET", path, params)
+
+    def _create_batch(
+        self, new_redirects: List[NewRedirectModel]
+    ) -> List[BulkResultModel]:
+        body = [
+            new_redirect.dict(exclude={"owner"}, exclude_none=True)
+            for new_redirect in new_redirects
+        ]
+        # datetimes aren't JSON, but orjson encodes them as ISO 8601
+        return [
+            BulkResultModel(**result)
+            for result in self.request("POST", "/redirects/bulk", body=body)
+        ]
+
+    def create_many(
+        self, new_redirects: Iterable[NewRedirectModel]
+    ) -> List[BulkResultModel]:
+        """
+        makes redirects, batch_size to a request, and returns a result for
+        each, in the same order; redirects without a key are given one
+        """
+        results: List[BulkResultModel] = []
+        for chunk in _chunks(list(new_redirects), self.batch_size):
+            results.extend(self._create_batch(chunk))
+        return results
+
+    def shorten(
+        self,
+        uri: Uri,
+        key: Optional[Key] = None,
+        host: str = DEFAULT_HOST,
+        expires_at: Optional[datetime] = None,
+    ) -> RedirectModel:
+        """
+        makes a redirect, with a new key unless one is given, and returns it
+
+        calls made around the same time are sent in one bulk create
+        """
+        future = self._batcher.submit(_new_redirect(uri, key, host, expires_at))
+        return _created(future.result())
+
+    def list_redirects(
+        self,
+        host: str = DEFAULT_HOST,
+        after: Optional[Key] = None,
+        limit: Optional[int] = None,
+    ) -> List[RedirectModel]:
+        "one page of the user's redirects on a host, in order of their keys"
+        params: Dict[str, Any] = {"host": host}
+        if after is not None:
+            params["after"] = after
+        if limit is not None:
+            params["limit"] = limit
+        return [RedirectModel(**found) for found in self.get("/redirects/", params)]
+
+    def changes(
+        self, after: int = 0, limit: Optional[int] = None
+    ) -> List[RedirectChangeModel]:
+        "the changes made to redirects after the one numbered after, oldest first"
+        params: Dict[str, Any] = {"after": after}
+        if limit is not None:
+            params["limit"] = limit
+        return [
+            RedirectChangeModel(**change)
+            for change in self.get("/redirects/changes", params)
+        ]
+
+    def snapshot(
+        self,
+        after_host: Optional[str] = None,
+        after: Optional[Key] = None,
+        limit: Optional[int] = None,
+    ) -> RedirectSnapshotModel:
+        "one page of every current redirect, in order of their hosts, then keys"
+        params: Dict[str, Any] = {}
+        if after is not None:
+            params.update(after_host=after_host, after=after)
+        if limit is not None:
+            params["limit"] = limit
+        return RedirectSnapshotModel(**self.get("/redirects/snapshot", params))
+
+
+class AsyncApiClient:
+    """
+    ApiClient, for asyncio code; requests are sent from a pool of worker
+    threads, one for each connection, so the event loop is never blocked
+
+    it has to be used from one event loop
+    """
+
+    def __init__(
+        self,
+        server_url: str,
+        api_key: Key,
+        username: Username,
+        password: str,
+        timeout: float = TIMEOUT,
+        max_connections: int = MAX_CONNECTIONS,
+        retry: Retry = Retry(),
+        batch_size: int = BATCH_SIZE,
+        max_delay: float = MAX_DELAY,
+    ) -> None:
+        self._client = ApiClient(
+            server_url,
+            api_key,
+            username,
+            password,
+            timeout=timeout,
+            max_connections=max_connections,
+            retry=retry,
+            batch_size=batch_size,
+        )
+        self.server_url = server_url
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+        self._batcher = _AsyncBatcher(self._create_batch_async, batch_size, max_delay)
+
+    async def _run(self, function: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(function, *args))
+
+    async def close(self) -> None:
+        "closes the connections, and stops the worker threads"
+        await self._run(self._client.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncApiClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    async def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        "requests a path under the API, and returns the JSON it answers with"
+        return await self._run(self._client.get, path, params)
+
+    async def _create_batch_async(
+        self, new_redirects: List[NewRedirectModel]
+    ) -> List[BulkResultModel]:
+        return await self._run(self._client._create_batch, new_redirects)
+
+    async def create_many(
+        self, new_redirects: Iterable[NewRedirectModel]
+    ) -> List[BulkResultModel]:
+        """
+        makes redirects, batch_size to a request, and returns a result for
+        each, in the same order; the requests are sent at the same time
+        """
+        chunks = _chunks(list(new_redirects), self._client.batch_size)
+        results = await asyncio.gather(
+            *(self._create_batch_async(chunk) for chunk in chunks)
+        )
+        return [result for chunk_results in results for result in chunk_results]
+
+    async def shorten(
+        self,
+        uri: Uri,
+        key: Optional[Key] = None,
+        host: str = DEFAULT_HOST,
+        expires_at: Optional[datetime] = None,
+    ) -> RedirectModel:
+        """
+        makes a redirect, with a new key unless one is given, and returns it
+
+        calls made around the same time are sent in one bulk create
+        """
+        result = await self._batcher.submit(_new_redirect(uri, key, host, expires_at))
+        return _created(result)
+
+    async def list_redirects(
+        self,
+        host: str = DEFAULT_HOST,
+        after: Optional[Key] = None,
+        limit: Optional[int] = None,
+    ) -> List[RedirectModel]:
+        "one page of the user's redirects on a host, in order of their keys"
+        return await self._run(self._client.list_redirects, host, after, limit)
+
+    async def changes(
+        self, after: int = 0, limit: Optional[int] = None
+    ) -> List[RedirectChangeModel]:
+        "the changes made to redirects after the one numbered after, oldest first"
+        return await self._run(self._client.changes, after, limit)
+
+    async def snapshot(
+        self,
+        after_host: Optional[str] = None,
+        after: Optional[Key] = None,
+        limit: Optional[int] = None,
+    ) -> RedirectSnapshotModel:
+        "one page of every current redirect, in order of their hosts, then keys"
+        return await self._run(self._client.snapshot, after_host, after, limit)
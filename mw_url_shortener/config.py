@@ -1,10 +1,10 @@
-print(f"imported mw_url_shortener.config as {__name__}")
 """
 where the global application configuration is retrieved and modified
 """
 import os
 from argparse import Namespace
 from collections.abc import Mapping
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, NamedTuple, Optional
 
@@ -15,6 +15,7 @@ from . import settings
 from .database.config import get_config as get_from_db
 from .database.config import save_config as save_to_db
 from .database.errors import BadConfigInDBError
+from .metrics import record_cache_lookup
 from .settings import CommonSettings, SettingsClassName
 
 # From:
@@ -94,6 +95,22 @@ def settings_env_names(
     return SettingsEnvNames(class_name=class_name, value_name=value_name)
 
 
+@lru_cache(maxsize=None)
+def default_settings_env_names() -> SettingsEnvNames:
+    "the environment variable names for CommonSettings, which never change"
+    return settings_env_names()
+
+
+class EnvCache(NamedTuple):
+    "the settings last parsed from the environment, and the raw values"
+    class_name: str
+    value: str
+    settings: CommonSettings
+
+
+_env_cache: Optional[EnvCache] = None
+
+
 def set_env(
     new_settings: CommonSettings, env_names_or_none: Optional[SettingsEnvNames] = None
 ) -> None:
@@ -123,9 +140,9 @@ def set_env(
         ) from err
 
     if env_names_or_none is None:
-        env_names = settings_env_names()
+        env_names = default_settings_env_names()
     else:
-        env_name = env_names_or_none
+        env_names = env_names_or_none
 
     settings_json = new_settings.json()
     assert new_settings == settings_class.parse_raw(
@@ -144,20 +161,37 @@ def get_env(env_names_or_none: SettingsEnvNames = None) -> CommonSettings:
         raise TypeError("env_names must be a SettingsEnvNames or None")
 
     if env_names_or_none is None:
-        env_names = settings_env_names()
+        env_names = default_settings_env_names()
     else:
-        env_name = env_names_or_none
+        env_names = env_names_or_none
 
     settings_class_name = os.getenv(env_names.class_name, None)
     settings_value = os.getenv(env_names.value_name, None)
     if settings_class_name is None or settings_value is None:
         raise ValueError("environment not set")
 
+    # Settings are immutable, so the same object can be handed out until the
+    # environment changes
+    global _env_cache
+    cached = _env_cache
+    if (
+        cached is not None
+        and cached.class_name == settings_class_name
+        and cached.value == settings_value
+    ):
+        record_cache_lookup("env_settings", hit=True)
+        return cached.settings
+    record_cache_lookup("env_settings", hit=False)
+
     settings_class = getattr(settings, settings_class_name, None)
     if settings_class is None or not issubclass(settings_class, CommonSettings):
         raise ValueError(f"cannot find class '{settings_class_name}'")
 
-    return settings_class.parse_raw(settings_value)
+    env_settings = settings_class.parse_raw(settings_value)
+    _env_cache = EnvCache(
+        class_name=settings_class_name, value=settings_value, settings=env_settings
+    )
+    return env_settings
 
 
 def set(
@@ -1,10 +1,11 @@
-print(f"imported mw_url_shortener.console as {__name__}")
 """
 The main cli frontend for the program
 
 Primarily uses: https://github.com/Woile/decli
 """
 import argparse
+import logging
+import sqlite3
 import sys
 from argparse import ArgumentTypeError, Namespace
 from pathlib import Path
@@ -12,9 +13,11 @@ from typing import Callable, Optional, Union
 
 from decli import cli
 
-from . import __version__, config
-from .config import CommonSettings, ServerSettings
-from .utils import unsafe_random_chars
+from . import __version__
+
+# NOTE: Only the standard library and decli are imported here, so that
+# parsing arguments, --help, and --version stay fast. Each subcommand
+# imports what it needs when it's run.
 
 
 class ArgumentValidationError(ArgumentTypeError, TypeError):
@@ -47,6 +50,24 @@ class OpenableFile(metaclass=OpenableFileMeta):
     pass
 
 
+class CreatableFileMeta(type):
+    "Only here to make CreatableFile a callable class"
+
+    def __call__(self, filename: Union[Path, str, type(None)]) -> Path:
+        "checks that the filename is a file, or can be made, and returns it"
+        path = Path(filename).resolve()
+        if path.exists():
+            return OpenableFile(path)
+        if not path.parent.is_dir():
+            raise ArgumentValidationError(f"'{path.parent}' is not a directory")
+        return path
+
+
+class CreatableFile(metaclass=CreatableFileMeta):
+    "Will take a file that's able to be read, or one that doesn't exist yet"
+    pass
+
+
 def raise_not_implemented_gen(message: str) -> Callable[[], None]:
     """
     Make a function that will raise a NotImplemented error with a custom
@@ -67,15 +88,21 @@ def server_run(args: Namespace) -> None:
     # run, to keep load times down
     import uvicorn
 
-    from . import server
+    from . import metrics, profiling, server
     from .api.main import api_app_v1
 
     # NOTE:BUG have to import this or entities won't be added to module
     # database object
     from .database import entities
     from .database.interface import get_db, setup_db
+    from .settings import ServerSettings
+    from .utils import safe_key_chars
 
-    if args.env_file:
+    if "api_key" in args and args.api_key is None:
+        # --api-key was given without a value
+        args.api_key = safe_key_chars(10)
+
+    if getattr(args, "env_file", None):
         settings = ServerSettings(_env_file=args.env_file, **vars(args))
     else:
         settings = ServerSettings.from_orm(args)
@@ -87,28 +114,297 @@ def server_run(args: Namespace) -> None:
 
     # NOTE:BUG create_tables should be False, if use of the setup command needs
     # to be forced
-    setup_db(db=get_db(), filename=settings.database_file, create_tables=True)
+    db = setup_db(
+        db=get_db(),
+        filename=settings.database_file,
+        create_tables=True,
+        check=settings.integrity_check,
+    )
 
     print(f"\nsettings:\n{settings}\n")
     server.app.state.settings = settings
-    # NOTE:BUG Is this necessary?
-    # Are the settings states shared to mounted apps?
-    # Do I need to manage updates to that state in both places?
-    # server.api_app_v1.state.settings = settings
-    server.app.mount(f"/{settings.api_key}", api_app_v1)
+    server.app.state.db = db
+    if not settings.read_only:
+        # Mounted apps don't share their parent's state, so the API is given
+        # the same state object, which also lets it see reloaded settings
+        api_app_v1.state = server.app.state
+        server.app.mount(f"/{settings.api_key}", api_app_v1)
     server.app.include_router(server.app_router)
 
+    if settings.metrics_port is not None:
+        metrics.start_http_server(port=settings.metrics_port)
+
+    if settings.profile is not None:
+        if settings.profile_file:
+            sink = profiling.FileSink(settings.profile_file)
+        else:
+            logging.basicConfig(level=logging.INFO)
+            sink = profiling.LogSink()
+        profiling.enable(sink, sample_rate=settings.profile)
+
     # NOTE:IMPROVEMENT This needs to be updated to programmatically find the
     # appropriate name of the module and function to run, istead of hardcoding
     # it to mw_url_shortener.server:app
-    if not settings.root_path:
-        uvicorn.run("mw_url_shortener.server:app", reload=settings.reload, root_path="")
-    else:
-        uvicorn.run(
-            "mw_url_shortener.server:app",
-            reload=settings.reload,
-            root_path=settings.root_path,
+    uvicorn.run(
+        "mw_url_shortener.server:app",
+        host=settings.host,
+        port=settings.port,
+        reload=settings.reload,
+        root_path=settings.root_path or "",
+    )
+
+
+def client_run(args: Namespace) -> None:
+    """
+    Runs a sync agent, which keeps a local database file up to date with a
+    server's redirects, for a read-only server to serve
+    """
+    from pydantic import ValidationError
+
+    from . import sync
+    from .client import ApiClient, ClientError
+    from .database import entities
+    from .database.interface import delete_expired_redirects, get_db, setup_db
+    from .settings import SyncSettings
+
+    try:
+        if getattr(args, "env_file", None):
+            settings = SyncSettings(_env_file=args.env_file, **vars(args))
+        else:
+            settings = SyncSettings(**vars(args))
+    except ValidationError as err:
+        sys.exit(str(err))
+
+    sync.prepare_mirror(settings.database_file)
+    db = setup_db(db=get_db(), filename=settings.database_file, create_tables=True)
+    client = ApiClient(
+        server_url=settings.server_url,
+        api_key=settings.api_key,
+        username=settings.username,
+        password=settings.password,
+    )
+    logging.basicConfig(level=logging.INFO)
+    with client:
+        if args.once:
+            try:
+                applied = sync.sync_once(db, client, settings.sync_batch_size)
+            except ClientError as err:
+                sys.exit(str(err))
+            print(f"applied {applied} changes")
+            if settings.expiry_sweep_interval > 0:
+                deleted = delete_expired_redirects(db=db)
+                print(f"deleted {deleted} expired redirects")
+            return
+        try:
+            sync.run_agent(
+                db,
+                client,
+                poll_interval=settings.sync_poll_interval,
+                batch_size=settings.sync_batch_size,
+                expiry_sweep_interval=settings.expiry_sweep_interval,
+            )
+        except KeyboardInterrupt:
+            pass
+
+
+def loadtest_run(args: Namespace) -> None:
+    """
+    Starts a local server, and drives it with rising concurrency to find where
+    it saturates
+    """
+    from .loadtest import loadtest_run as run
+
+    run(args)
+
+
+def keyspace_run(args: Namespace) -> None:
+    """
+    Reports how full each key length is, and whether the key_length setting
+    should be raised
+    """
+    import orjson
+
+    from .database import entities
+    from .database.config import get_config
+    from .database.errors import BadConfigInDBError
+    from .database.interface import get_db, setup_db
+    from .database.keyspace import analyze_keyspace, report_dict
+    from .settings import ServerSettings
+    from .utils import normalize_host
+
+    database_file: Optional[Path] = getattr(args, "database_file", None)
+    if not database_file:
+        sys.exit("No database file specified; use --database-file")
+    db = setup_db(db=get_db(), filename=database_file, create_tables=False)
+
+    key_length: Optional[int] = args.key_length
+    if key_length is None:
+        # the key_length the server would use, if it's been saved
+        try:
+            saved_settings = get_config(db=db)
+        except (ValueError, BadConfigInDBError):
+            saved_settings = None
+        if isinstance(saved_settings, ServerSettings):
+            key_length = saved_settings.key_length
+        else:
+            key_length = ServerSettings.__fields__["key_length"].default
+
+    report = analyze_keyspace(
+        db=db,
+        key_length=key_length,
+        max_failure_probability=args.max_failure_probability,
+        host=normalize_host(args.host),
+    )
+    if args.json:
+        print(orjson.dumps(report_dict(report), option=orjson.OPT_INDENT_2).decode())
+        return
+
+    print(f"{report.total} keys, alphabet of {len(report.alphabet)} characters\n")
+    print(
+        f"{'length':>6} {'used':>10} {'other':>7} {'occupancy':>10} "
+        f"{'P(fail)':>9} {'remaining':>12}"
+    )
+    for length in report.lengths:
+        print(
+            f"{length.length:>6} {length.used:>10} {length.other:>7} "
+            f"{length.occupancy:>10.2%} {length.failure_probability:>9.1e} "
+            f"{length.remaining:>12}"
         )
+    current = next(
+        length for length in report.lengths if length.length == report.key_length
+    )
+    print(
+        f"\nat key_length {report.key_length}, {current.remaining} more keys can "
+        f"be generated before P(fail) exceeds {report.max_failure_probability:.0e}"
+    )
+    if report.raise_key_length:
+        print(f"raise key_length to {report.recommended_key_length}")
+
+
+def compress_uris_run(args: Namespace) -> None:
+    """
+    Trains a compression dictionary on the long uris in the database, and
+    moves any long uris still in the redirect table out of it
+    """
+    from .database import entities
+    from .database.interface import (
+        compress_long_uris,
+        get_db,
+        setup_db,
+        train_uri_dictionary,
+    )
+
+    database_file: Optional[Path] = getattr(args, "database_file", None)
+    if not database_file:
+        sys.exit("No database file specified; use --database-file")
+    db = setup_db(db=get_db(), filename=database_file, create_tables=False)
+
+    # moved first, so that they're included in the training sample
+    moved = compress_long_uris(db=db)
+    print(f"moved {moved} long uris out of the redirect table")
+    if args.train:
+        dictionary_id = train_uri_dictionary(db=db, sample_size=args.sample_size)
+        if dictionary_id is None:
+            print("the long uris have too little in common to train a dictionary")
+        else:
+            print(f"new long uris will be compressed with dictionary {dictionary_id}")
+
+
+def backup_run(args: Namespace) -> None:
+    """
+    Takes a snapshot of the database, which can be in use by a running
+    server, and deletes the oldest snapshots
+    """
+    from .database.backup import backup_database
+    from .database.errors import BackupError
+    from .types import IntegrityCheck
+
+    database_file: Optional[Path] = getattr(args, "database_file", None)
+    if not database_file:
+        sys.exit("No database file specified; use --database-file")
+    try:
+        snapshot = backup_database(
+            database_file,
+            directory=args.directory,
+            keep=args.keep,
+            pages_per_step=args.pages_per_step,
+            step_delay=args.step_delay,
+            verify=IntegrityCheck(args.verify),
+        )
+    except (BackupError, ValueError) as err:
+        sys.exit(str(err))
+    print(snapshot)
+
+
+def export_run(args: Namespace) -> None:
+    """
+    Writes the redirects, the users, or both, to files, a chunk at a time, to
+    move them to another instance or into analytics
+    """
+    from .database import entities
+    from .database.export import export_redirects, export_users
+    from .database.interface import get_db, setup_db
+    from .types import Compression, ExportFormat
+
+    database_file: Optional[Path] = getattr(args, "database_file", None)
+    if not database_file:
+        sys.exit("No database file specified; use --database-file")
+    if not (args.redirects or args.users):
+        sys.exit("Nothing to export; use --redirects, --users, or both")
+    db = setup_db(db=get_db(), filename=database_file, create_tables=False)
+
+    export_format = ExportFormat(args.format) if args.format else None
+    compression = Compression(args.compression) if args.compression else None
+    # users first, so that an SQLite export has the owners of the redirects
+    for name, output, export in [
+        ("users", args.users, export_users),
+        ("redirects", args.redirects, export_redirects),
+    ]:
+        if not output:
+            continue
+        try:
+            written = export(
+                db,
+                output,
+                export_format=export_format,
+                compression=compression,
+                chunk_size=args.chunk_size,
+            )
+        except (ValueError, OSError, sqlite3.Error) as err:
+            sys.exit(f"could not export {name} to {output}: {err}")
+        print(f"exported {written} {name} to {output}")
+
+
+def setup_run(args: Namespace) -> None:
+    """
+    Makes the database file if it doesn't exist, and brings its tables up to
+    date with this version
+    """
+    from .database import entities
+    from .database.interface import (
+        generate_mapping,
+        get_db,
+        set_database_file_and_connect,
+    )
+    from .database.migrations import LATEST_VERSION, migrate, pending_migrations
+
+    database_file: Optional[Path] = getattr(args, "database_file", None)
+    if not database_file:
+        sys.exit("No database file specified; use --database-file")
+    db = set_database_file_and_connect(db=get_db(), filename=database_file)
+
+    pending = pending_migrations(db)
+    for migration in pending:
+        print(f"{migration.version}: {migration.description}")
+    if args.dry_run:
+        print(f"{len(pending)} migrations to apply")
+        return
+
+    # each migration logs when it starts, which helps on large databases
+    logging.basicConfig(level=logging.INFO)
+    migrate(db, batch_size=args.batch_size)
+    generate_mapping(db=db, create_tables=True)
+    print(f"database is up to date, at schema version {LATEST_VERSION}")
 
 
 interface_spec = {
@@ -132,7 +428,7 @@ interface_spec = {
             "name": ["--database-file"],
             "type": OpenableFile,
             "default": argparse.SUPPRESS,
-            "help": "a database file; to make one, see the setup subcommand",
+            "help": "a database file that exists; to make one, use setup --database-file",
         },
     ],
     "subcommands": {
@@ -154,7 +450,7 @@ interface_spec = {
                         "name": ["--api-key"],
                         "help": "Sets a prefix for the API URL; leave blank for autogenerated",
                         "default": argparse.SUPPRESS,
-                        "const": unsafe_random_chars(10),
+                        "const": None,
                         "nargs": "?",
                     },
                     {
@@ -162,11 +458,329 @@ interface_spec = {
                         "help": "Sets an app-wide prefix (e.g. domain.test/example_root_path/api_key/v1/users)",
                         "default": argparse.SUPPRESS,
                     },
+                    {
+                        "name": ["--host"],
+                        "help": "The address to listen on (default 127.0.0.1)",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--port"],
+                        "help": "The port to listen on (default 8000)",
+                        "type": int,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--key-normalization"],
+                        "help": "How closely a requested key has to match: exact; lenient, which ignores trailing slashes, percent-encoding, and unicode normalization forms; or casefold, which also ignores case (default exact)",
+                        "choices": ["exact", "lenient", "casefold"],
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--settings-poll-interval"],
+                        "help": "How often, in seconds, to check the database for changed settings; 0 to only check on SIGHUP (default 5)",
+                        "type": float,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--expiry-sweep-interval"],
+                        "help": "How often, in seconds, to delete expired redirects; 0 to never delete them (default 60)",
+                        "type": float,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--integrity-check"],
+                        "help": "How thoroughly to check the database on startup: header only reads the file header and schema, quick and full read the whole database, unless it hasn't changed since it was last checked (default header)",
+                        "choices": ["header", "quick", "full"],
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--integrity-check-interval"],
+                        "help": "How often, in seconds, to run a quick check on the database while running; 0 to never do that (default 0)",
+                        "type": float,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--backup-interval"],
+                        "help": "How often, in seconds, to take a snapshot of the database; 0 to never do that (default 0)",
+                        "type": float,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--backup-directory"],
+                        "help": "Where to keep snapshots (default: a backups directory next to the database)",
+                        "type": Path,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--backup-keep"],
+                        "help": "How many snapshots to keep (default 7)",
+                        "type": int,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--read-only"],
+                        "help": "Serves redirects from a mirror kept up to date by the client subcommand, without the API",
+                        "action": "store_true",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--domain"],
+                        "help": "A domain to serve redirects on, with its own keys; can be given more than once, and any other domain is rejected (default: serve the same keys on any domain)",
+                        "dest": "domains",
+                        "metavar": "DOMAIN",
+                        "action": "append",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--sync-user"],
+                        "help": "A user that can read the change log, and so every user's redirects, to mirror them with the client subcommand; can be given more than once (default: none)",
+                        "dest": "sync_users",
+                        "metavar": "USERNAME",
+                        "action": "append",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--metrics-port"],
+                        "help": "Serves Prometheus metrics on this port, on localhost",
+                        "type": int,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--profile"],
+                        "help": "Records timings, SQL statement and row counts, and runs this fraction of requests under cProfile (default 0.01)",
+                        "type": float,
+                        "nargs": "?",
+                        "const": 0.01,
+                        "default": argparse.SUPPRESS,
+                        "group": "development",
+                    },
+                    {
+                        "name": ["--profile-file"],
+                        "help": "Appends the --profile records to this file as JSON lines, instead of logging them",
+                        "type": Path,
+                        "default": argparse.SUPPRESS,
+                        "group": "development",
+                    },
+                ],
+            },
+            {
+                "name": "loadtest",
+                "help": "finds the saturation point of a locally started server",
+                "func": loadtest_run,
+                "arguments": [
+                    {
+                        "name": ["--redirects"],
+                        "help": "how many redirects to put in a temporary database, if --database-file isn't given (default 10000)",
+                        "type": int,
+                        "default": 10_000,
+                    },
+                    {
+                        "name": ["--zipf"],
+                        "help": "the exponent of the Zipf distribution of requested keys (default 1.1)",
+                        "type": float,
+                        "default": 1.1,
+                    },
+                    {
+                        "name": ["--concurrency"],
+                        "help": "comma-separated concurrency levels to step through (default 1,2,4,8,16,32,64,128)",
+                        "default": "1,2,4,8,16,32,64,128",
+                    },
+                    {
+                        "name": ["--duration"],
+                        "help": "seconds to run each concurrency level (default 10)",
+                        "type": float,
+                        "default": 10.0,
+                    },
+                    {
+                        "name": ["--host"],
+                        "help": "the address for the server to listen on (default 127.0.0.1)",
+                        "default": "127.0.0.1",
+                    },
+                    {
+                        "name": ["--port"],
+                        "help": "the port for the server to listen on (default: any free port)",
+                        "type": int,
+                        "default": None,
+                    },
+                ],
+            },
+            {
+                "name": "keyspace",
+                "help": "reports how full each key length is",
+                "func": keyspace_run,
+                "arguments": [
+                    {
+                        "name": ["--key-length"],
+                        "help": "the key_length to plan for (default: the saved server setting)",
+                        "type": int,
+                        "default": None,
+                    },
+                    {
+                        "name": ["--max-failure-probability"],
+                        "help": "recommends raising key_length once generating a key is more likely than this to fail (default 1e-6)",
+                        "type": float,
+                        "default": 1e-6,
+                    },
+                    {
+                        "name": ["--host"],
+                        "help": "the domain whose keys to report on, counting the keys it falls back to (default: the keys made without a domain)",
+                        "default": "*",
+                    },
+                    {
+                        "name": ["--json"],
+                        "help": "prints the report as JSON",
+                        "action": "store_true",
+                    },
+                ],
+            },
+            {
+                "name": "compress-uris",
+                "help": "stores long uris compressed, outside of the redirect table",
+                "func": compress_uris_run,
+                "arguments": [
+                    {
+                        "name": ["--no-train"],
+                        "help": "doesn't train a new compression dictionary",
+                        "dest": "train",
+                        "action": "store_false",
+                    },
+                    {
+                        "name": ["--sample-size"],
+                        "help": "how many long uris to train the dictionary on (default 2000)",
+                        "type": int,
+                        "default": 2000,
+                    },
+                ],
+            },
+            {
+                "name": "backup",
+                "help": "takes a snapshot of the database, even while a server is using it",
+                "func": backup_run,
+                "arguments": [
+                    {
+                        "name": ["--directory"],
+                        "help": "where to keep snapshots (default: a backups directory next to the database)",
+                        "type": Path,
+                        "default": None,
+                    },
+                    {
+                        "name": ["--keep"],
+                        "help": "how many snapshots to keep (default 7)",
+                        "type": int,
+                        "default": 7,
+                    },
+                    {
+                        "name": ["--pages-per-step"],
+                        "help": "how many pages to copy at a time (default 256)",
+                        "type": int,
+                        "default": 256,
+                    },
+                    {
+                        "name": ["--step-delay"],
+                        "help": "how long to wait, in seconds, between steps (default 0.01)",
+                        "type": float,
+                        "default": 0.01,
+                    },
+                    {
+                        "name": ["--verify"],
+                        "help": "how thoroughly to check the snapshot (default quick)",
+                        "choices": ["header", "quick", "full"],
+                        "default": "quick",
+                    },
+                ],
+            },
+            {
+                "name": "export",
+                "help": "writes the redirects and users to JSON lines, CSV, or SQLite files",
+                "func": export_run,
+                "arguments": [
+                    {
+                        "name": ["--redirects"],
+                        "help": "the file to write the redirects to",
+                        "type": Path,
+                        "default": None,
+                    },
+                    {
+                        "name": ["--users"],
+                        "help": "the file to write the users to; can be the same SQLite file as --redirects",
+                        "type": Path,
+                        "default": None,
+                    },
+                    {
+                        "name": ["--format"],
+                        "help": "the format to write (default: from the file name, or jsonl)",
+                        "choices": ["jsonl", "csv", "sqlite"],
+                        "default": None,
+                    },
+                    {
+                        "name": ["--compression"],
+                        "help": "how to compress JSON lines and CSV files (default: from the file name, like .jsonl.gz, or none)",
+                        "choices": ["none", "gzip", "bz2", "xz"],
+                        "default": None,
+                    },
+                    {
+                        "name": ["--chunk-size"],
+                        "help": "how many rows to read and write at a time (default 5000)",
+                        "type": int,
+                        "default": 5000,
+                    },
                 ],
             },
             {
                 "name": "client",
-                "func": raise_not_implemented_gen("No client command"),
+                "help": "mirrors a server's redirects into the database file, for a read-only server",
+                "func": client_run,
+                "arguments": [
+                    {
+                        "name": ["--database-file"],
+                        "help": "the mirror's database file; made if it doesn't exist",
+                        "type": CreatableFile,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--server-url"],
+                        "help": "where the server is, without the API key (default http://127.0.0.1:8000)",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--api-key"],
+                        "help": "the server's API key",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--username"],
+                        "help": "the user to log in to the API as; the server has to list it with --sync-user",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--password"],
+                        "help": "the user's password; better set with the URL_SHORTENER_PASSWORD environment variable",
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--sync-poll-interval"],
+                        "help": "how long to wait, in seconds, before asking for more changes, once caught up (default 1)",
+                        "type": float,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--expiry-sweep-interval"],
+                        "help": "how often, in seconds, to delete expired redirects from the mirror; 0 to never delete them (default 60)",
+                        "type": float,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--sync-batch-size"],
+                        "help": "how many changes to ask for, and apply, at a time (default 1000)",
+                        "type": int,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--once"],
+                        "help": "catches up once, then exits",
+                        "action": "store_true",
+                    },
+                ],
             },
             {
                 "name": "config",
@@ -174,7 +788,27 @@ interface_spec = {
             },
             {
                 "name": "setup",
-                "func": raise_not_implemented_gen("No setup command"),
+                "help": "makes the database, or upgrades one made by an earlier version",
+                "func": setup_run,
+                "arguments": [
+                    {
+                        "name": ["--database-file"],
+                        "help": "the database file to make, or upgrade; made if it doesn't exist",
+                        "type": CreatableFile,
+                        "default": argparse.SUPPRESS,
+                    },
+                    {
+                        "name": ["--dry-run"],
+                        "help": "only list the migrations that would be applied",
+                        "action": "store_true",
+                    },
+                    {
+                        "name": ["--batch-size"],
+                        "help": "how many rows to change in each transaction (default 1000)",
+                        "type": int,
+                        "default": 1000,
+                    },
+                ],
             },
         ],
     },
@@ -1,2 +1 @@
-print(f"imported mw_url_shortener.database.__init__ as {__name__}")
 from .entities import get_db
@@ -0,0 +1,168 @@
+"""
+takes consistent snapshots of the live database
+
+copying the database file while the server is writing to it can give a
+corrupt copy, so snapshots are made with SQLite's online backup API, which
+copies the database a few pages at a time; between steps, no lock is held,
+and the backup waits a moment, so the server's writes aren't held up
+
+if another connection writes to the database during a backup, SQLite starts
+the backup over, so a copy is always of one moment in time; after
+max_restarts of those, the rest is copied in a single step
+
+each snapshot is written under a temporary name, checked, then renamed, so a
+file with a snapshot's name is always a complete, checked, database
+
+needs Python 3.7 or later, for sqlite3.Connection.backup
+"""
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from ..types import IntegrityCheck, SPath
+from . import integrity
+from .errors import BackupError
+
+__all__ = [
+    "PAGES_PER_STEP",
+    "STEP_DELAY",
+    "KEEP",
+    "MAX_RESTARTS",
+    "list_snapshots",
+    "rotate_snapshots",
+    "backup_database",
+]
+
+# How many pages are copied in each step
+PAGES_PER_STEP = 256
+
+# How long to wait, in seconds, between steps
+STEP_DELAY = 0.01
+
+# How many snapshots are kept, by default
+KEEP = 7
+
+# How many times a backup is started over, after writes to the database,
+# before the rest is copied in one step
+MAX_RESTARTS = 3
+
+SNAPSHOT_SUFFIX = ".sqlitedb"
+PARTIAL_SUFFIX = ".partial"
+
+
+class _Restarted(Exception):
+    "a backup has been started over too many times"
+    pass
+
+
+def _snapshot_directory(database_file: Path, directory: Optional[SPath]) -> Path:
+    if directory is None:
+        return database_file.parent / "backups"
+    return Path(directory).resolve()
+
+
+def list_snapshots(
+    database_file: SPath, directory: Optional[SPath] = None
+) -> List[Path]:
+    """
+    the snapshots of a database, oldest first; by default, they're kept in a
+    backups directory next to the database
+    """
+    database_file = Path(database_file).resolve()
+    snapshot_directory = _snapshot_directory(database_file, directory)
+    # the names end in a UTC timestamp, so they sort by age
+    return sorted(snapshot_directory.glob(f"{database_file.stem}-*{SNAPSHOT_SUFFIX}"))
+
+
+def rotate_snapshots(
+    database_file: SPath, directory: Optional[SPath] = None, keep: int = KEEP
+) -> List[Path]:
+    "deletes all but the newest keep snapshots, and returns the deleted ones"
+    if keep < 1:
+        raise ValueError("keep must be at least 1")
+    snapshots = list_snapshots(database_file, directory)
+    removed = snapshots[:-keep]
+    for snapshot in removed:
+        snapshot.unlink()
+    return removed
+
+
+def _copy(
+    source: sqlite3.Connection,
+    destination: sqlite3.Connection,
+    pages_per_step: int,
+    step_delay: float,
+    max_restarts: int,
+) -> None:
+    "copies the database a few pages at a time, pausing between steps"
+    restarts = 0
+    last_remaining: Optional[int] = None
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _Restarted()
+        last_remaining = remaining
+        # no locks are held here, so this doesn't hold up writers
+        time.sleep(step_delay)
+
+    try:
+        source.backup(destination, pages=pages_per_step, progress=progress)
+    except _Restarted:
+        source.backup(destination, pages=-1)
+
+
+def backup_database(
+    database_file: SPath,
+    directory: Optional[SPath] = None,
+    keep: int = KEEP,
+    pages_per_step: int = PAGES_PER_STEP,
+    step_delay: float = STEP_DELAY,
+    verify: IntegrityCheck = IntegrityCheck.quick,
+    max_restarts: int = MAX_RESTARTS,
+) -> Path:
+    """
+    takes a snapshot of a database that may be in use, checks it as
+    thoroughly as verify asks for, and deletes all but the newest keep
+    snapshots
+
+    returns the path of the new snapshot
+    """
+    if not hasattr(sqlite3.Connection, "backup"):
+        raise BackupError("backups need Python 3.7 or later")
+    if pages_per_step < 1:
+        raise ValueError("pages_per_step must be at least 1")
+    database_file = Path(database_file).resolve()
+    if not integrity.check_database_file(database_file):
+        raise BackupError(f"'{database_file}' is not a valid database file")
+
+    snapshot_directory = _snapshot_directory(database_file, directory)
+    snapshot_directory.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+    snapshot = snapshot_directory / f"{database_file.stem}-{timestamp}{SNAPSHOT_SUFFIX}"
+    partial_snapshot = snapshot.with_name(snapshot.name + PARTIAL_SUFFIX)
+
+    try:
+        source = sqlite3.connect(f"{database_file.as_uri()}?mode=rw", uri=True)
+        destination = sqlite3.connect(str(partial_snapshot))
+        try:
+            _copy(source, destination, pages_per_step, step_delay, max_restarts)
+        finally:
+            destination.close()
+            source.close()
+
+        if not integrity.run_check(partial_snapshot, verify):
+            raise BackupError(f"the snapshot of '{database_file}' failed its check")
+        partial_snapshot.replace(snapshot)
+    except sqlite3.Error as err:
+        raise BackupError(f"could not back up '{database_file}': {err}") from err
+    finally:
+        if partial_snapshot.exists():
+            partial_snapshot.unlink()
+
+    rotate_snapshots(database_file, snapshot_directory, keep)
+    return snapshot
@@ -1,32 +1,178 @@
-print(f"imported mw_url_shortener.database.config as {__name__}")
-from pony.orm import Database, db_session
+"""
+stores the application settings in the database
+
+every save adds a new version to an append-only history, and moves a pointer
+row to it; rolling back only moves the pointer
+
+reading the settings is on the path of every request that needs them, so the
+deserialized settings are cached for the whole process, and revalidated
+cheaply:
+- saving settings through save_config() clears the cache immediately
+- changes made by other connections, including other processes, are noticed
+  through SQLite's PRAGMA data_version, which changes whenever another
+  connection commits; this is checked at most once every max_age seconds per
+  thread, so reads in between cost a dictionary lookup
+"""
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+import orjson
+from pony.orm import Database, select
+from pony.orm.core import Entity
 from pydantic import ValidationError
 
 from .. import settings
+from ..metrics import record_cache_lookup
 from ..settings import CommonSettings, SettingsClasses, SettingsClassName
 from .errors import BadConfigInDBError
+from .interface import session
 
+# The name of the pointer row
+CURRENT = "current"
 
-def get_config(db: Database) -> CommonSettings:
-    "retrieves and deserializes CommonSettings from the database"
-    with db_session:
-        current_config = db.ConfigEntity.get(version="current")
+# How long, in seconds, cached settings are trusted before data_version is
+# checked again
+CONFIG_MAX_AGE: float = 1.0
 
-        if not current_config:
-            raise ValueError("No current config")
 
-        current_config_json = current_config.json
-        class_name = SettingsClassName.validate(current_config.class_name)
-        settings_class = getattr(settings, class_name)
+class CachedConfig(NamedTuple):
+    "settings read from the database, and when they were read"
+    settings: CommonSettings
+    # the cache generation when these settings were read
+    generation: int
+
+
+class _ThreadCheck(NamedTuple):
+    "when this thread last revalidated the cache, and what it saw"
+    checked_at: float
+    data_version: int
+    generation: int
+
+
+# Shared by every thread in the process, keyed by database object
+_config_cache: "WeakKeyDictionary[Database, CachedConfig]" = WeakKeyDictionary()
+_cache_lock = threading.Lock()
+_generation = 0
+# data_version is per-connection, and pony uses one connection per thread, so
+# each thread keeps track of what it last saw
+_local = threading.local()
+
+
+def clear_config_cache(db: Optional[Database] = None) -> None:
+    "forgets the cached settings for a database, or for all databases"
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        if db is None:
+            _config_cache.clear()
+        else:
+            _config_cache.pop(db, None)
+
+
+def _thread_checks() -> "WeakKeyDictionary[Database, _ThreadCheck]":
+    checks = getattr(_local, "checks", None)
+    if checks is None:
+        checks = _local.checks = WeakKeyDictionary()
+    return checks
+
 
+def _data_version(db: Database) -> int:
+    "changes whenever a different connection commits to the database"
+    return int(db.execute("PRAGMA data_version;").fetchone()[0])
+
+
+def _current_version(db: Database) -> Optional[int]:
+    "follows the pointer row to the version in use; needs a db_session"
+    pointer = db.CurrentConfigEntity.get(name=CURRENT)
+    return pointer.version if pointer else None
+
+
+def _parse_config(config_entity: Entity) -> CommonSettings:
+    "deserializes a stored version of the settings"
+    class_name = SettingsClassName.validate(config_entity.class_name)
+    settings_class = getattr(settings, class_name)
     try:
-        return settings_class.parse_raw(current_config_json)
+        return settings_class.parse_raw(config_entity.json)
     except ValidationError as err:
         raise BadConfigInDBError("bad configuration in database") from err
 
 
+def _read_config(db: Database) -> CommonSettings:
+    "retrieves and deserializes the current settings, bypassing the cache"
+    with session():
+        version = _current_version(db)
+        current_config = db.ConfigEntity.get(version=version) if version else None
+
+        if not current_config:
+            raise ValueError("No current config")
+
+        return _parse_config(current_config)
+
+
+def get_config(db: Database, max_age: float = CONFIG_MAX_AGE) -> CommonSettings:
+    """
+    retrieves and deserializes CommonSettings from the database
+
+    the settings may be cached for up to max_age seconds; pass 0 to always
+    check for changes made by other connections
+    """
+    now = monotonic()
+    cached = _config_cache.get(db)
+    checks = _thread_checks()
+    check = checks.get(db)
+    if (
+        cached is not None
+        and check is not None
+        and check.generation == cached.generation
+        and now - check.checked_at < max_age
+    ):
+        record_cache_lookup("config", hit=True)
+        return cached.settings
+
+    with session():
+        data_version = _data_version(db)
+        if (
+            cached is not None
+            and check is not None
+            and check.generation == cached.generation
+            and check.data_version == data_version
+        ):
+            checks[db] = check._replace(checked_at=now)
+            record_cache_lookup("config", hit=True)
+            return cached.settings
+
+        record_cache_lookup("config", hit=False)
+        generation = _generation
+        current_settings = _read_config(db)
+
+    with _cache_lock:
+        if generation == _generation:
+            _config_cache[db] = CachedConfig(
+                settings=current_settings, generation=generation
+            )
+    checks[db] = _ThreadCheck(
+        checked_at=now, data_version=data_version, generation=generation
+    )
+    return current_settings
+
+
+def _point_current_at(db: Database, version: int) -> None:
+    "moves the pointer row; needs a db_session"
+    pointer = db.CurrentConfigEntity.get(name=CURRENT)
+    if pointer:
+        pointer.version = version
+    else:
+        db.CurrentConfigEntity(name=CURRENT, version=version)
+
+
 def save_config(db: Database, new_settings: CommonSettings) -> CommonSettings:
-    "encodes the settings and writes them to the database"
+    """
+    encodes the settings and adds them to the database as a new version,
+    which becomes the current version
+    """
     bad_class_msg = "new_settings must be an instance of a settings class"
     try:
         class_name = SettingsClassName.validate(new_settings.__class__.__name__)
@@ -37,8 +183,107 @@ def save_config(db: Database, new_settings: CommonSettings) -> CommonSettings:
     if settings_class != type(new_settings):
         raise ValueError(bad_class_msg)
 
-    with db_session:
-        config_entity = db.ConfigEntity(
-            version="current", class_name=class_name, json=new_settings.json()
+    with session():
+        # NOTE: the settings classes encode with orjson, which produces compact
+        # JSON with no extra whitespace
+        config_entity = db.ConfigEntity(class_name=class_name, json=new_settings.json())
+        db.flush()
+        _point_current_at(db, config_entity.version)
+        saved_settings = settings_class.parse_raw(config_entity.json)
+
+    clear_config_cache(db)
+    return saved_settings
+
+
+class ConfigVersion(NamedTuple):
+    "a summary of one saved version of the settings"
+    version: int
+    class_name: str
+    created: datetime
+    size: int
+    current: bool
+
+
+def list_config_versions(db: Database) -> List[ConfigVersion]:
+    """
+    lists every saved version of the settings, oldest first
+
+    only the summary columns are read; the stored settings aren't loaded or
+    deserialized
+    """
+    with session():
+        current_version = _current_version(db)
+        rows = select(
+            (config.version, config.class_name, config.created, len(config.json))
+            for config in db.ConfigEntity
+        ).order_by(1)[:]
+    return [
+        ConfigVersion(
+            version=version,
+            class_name=class_name,
+            created=created,
+            size=size,
+            current=version == current_version,
         )
-        return settings_class.parse_raw(config_entity.json)
+        for version, class_name, created, size in rows
+    ]
+
+
+def current_config_version(db: Database) -> Optional[int]:
+    "the version of the settings in use, or None if none have been saved"
+    with session():
+        return _current_version(db)
+
+
+def get_config_version(db: Database, version: int) -> CommonSettings:
+    "retrieves and deserializes a particular version of the settings"
+    with session():
+        config_entity = db.ConfigEntity.get(version=version)
+        if not config_entity:
+            raise ValueError(f"no config version {version}")
+        return _parse_config(config_entity)
+
+
+def diff_config_versions(
+    db: Database, old_version: int, new_version: int
+) -> Dict[str, Tuple[object, object]]:
+    """
+    the settings that differ between two versions, as
+    {name: (old value, new value)}
+
+    the stored JSON is compared directly, without building settings objects
+    """
+    with session():
+        old_config = db.ConfigEntity.get(version=old_version)
+        new_config = db.ConfigEntity.get(version=new_version)
+        if not old_config or not new_config:
+            missing = old_version if not old_config else new_version
+            raise ValueError(f"no config version {missing}")
+        old_values = orjson.loads(old_config.json)
+        new_values = orjson.loads(new_config.json)
+
+    missing_value = None
+    return {
+        name: (old_values.get(name, missing_value), new_values.get(name, missing_value))
+        for name in sorted(set(old_values) | set(new_values))
+        if old_values.get(name, missing_value) != new_values.get(name, missing_value)
+    }
+
+
+def rollback_config(db: Database, version: int) -> CommonSettings:
+    """
+    makes a previously saved version of the settings current again
+
+    only the pointer row changes, in a single transaction, so the history is
+    kept and every reader sees either the old or the new settings
+    """
+    with session():
+        config_entity = db.ConfigEntity.get(version=version)
+        if not config_entity:
+            raise ValueError(f"no config version {version}")
+        # make sure the stored settings are still usable before switching
+        rolled_back_settings = _parse_config(config_entity)
+        _point_current_at(db, version)
+
+    clear_config_cache(db)
+    return rolled_back_settings
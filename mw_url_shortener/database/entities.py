@@ -1,21 +1,91 @@
-print(f"imported mw_url_shortener.database.entities as {__name__}")
-from pony.orm import Database, PrimaryKey, Required
+from datetime import datetime
+
+from pony.orm import Database, Optional, PrimaryKey, Required, Set, composite_index
+
+from ..utils import DEFAULT_HOST, normalize_key, uri_hash
 
 
 def get_db() -> Database:
     db = Database()
 
     class RedirectEntity(db.Entity):
-        key = PrimaryKey(str)
-        uri = Required(str)
+        # each domain the server answers for has its own keys
+        host = Required(str, default=DEFAULT_HOST)
+        key = Required(str)
+        PrimaryKey(host, key)
+        # empty when the uri is long, and stored in a LongUriEntity instead
+        uri = Optional(str)
+        long_uri_id = Optional(int)
+        # the fully normalized key, so that variants of a key can be found
+        # with one indexed lookup
+        normalized_key = Optional(str)
+        composite_index(host, normalized_key)
+        # so that the redirects for a URI can be found without comparing every
+        # URI
+        uri_hash = Optional(int, size=64, index=True)
+        # in UTC; indexed so that expired redirects can be swept in batches
+        expires_at = Optional(datetime, index=True)
+        # keys are still unique across all users, since the redirect server
+        # only gets a host and a key; the index lets one user's redirects be
+        # paged through, and counted, in order
+        owner = Optional("UserEntity")
+        composite_index(owner, host, key)
+
+        def before_insert(self) -> None:
+            "keys can't change, so normalized_key only needs to be set here"
+            self.normalized_key = normalize_key(self.key)
+            # the uri_hash of a long uri is set when it's stored
+            if self.long_uri_id is None:
+                self.uri_hash = uri_hash(self.uri)
+
+        def before_update(self) -> None:
+            if self.long_uri_id is None:
+                self.uri_hash = uri_hash(self.uri)
+
+    class LongUriEntity(db.Entity):
+        "a long uri, kept out of the redirect table, and usually compressed"
+        id = PrimaryKey(int, auto=True)
+        data = Required(bytes)
+        compressed = Required(bool)
+        # the preset dictionary the data was compressed with, if any
+        dictionary_id = Optional(int)
+
+    class UriDictionaryEntity(db.Entity):
+        "a zlib preset dictionary, made from the uris in the database"
+        id = PrimaryKey(int, auto=True)
+        data = Required(bytes)
+        created = Required(datetime, default=datetime.utcnow)
+
+    class RedirectChangeEntity(db.Entity):
+        "append-only log of the changes made to redirects, for caches to follow"
+        # AUTOINCREMENT numbers are never reused, and writes to SQLite are
+        # serialized, so changes are numbered in the order they're committed
+        sequence = PrimaryKey(int, auto=True)
+        operation = Required(str)
+        host = Required(str)
+        key = Required(str)
+        # the redirect after the change; NULL for deletes
+        uri = Optional(str, nullable=True)
+        expires_at = Optional(datetime)
+        created = Required(datetime, default=datetime.utcnow)
 
     class UserEntity(db.Entity):
         username = PrimaryKey(str)
         hashed_password = Required(str)
+        # how many unexpired redirects the user can own; no limit if empty
+        redirect_quota = Optional(int)
+        redirects = Set("RedirectEntity")
 
     class ConfigEntity(db.Entity):
-        version = PrimaryKey(str)
+        "append-only history of saved settings"
+        version = PrimaryKey(int, auto=True)
         class_name = Required(str)
         json = Required(str)
+        created = Required(datetime, default=datetime.utcnow)
+
+    class CurrentConfigEntity(db.Entity):
+        "a single row, pointing at the version of the settings in use"
+        name = PrimaryKey(str)
+        version = Required(int)
 
     return db
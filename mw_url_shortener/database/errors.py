@@ -1,13 +1,14 @@
-print(f"imported mw_url_shortener.database.errors as {__name__}")
 """
 collection of errors reported by the database interface
 """
 __all__ = [
+    "BackupError",
     "BadConfigInDBError",
     "DatabaseError",
     "DuplicateKeyError",
     "DuplicateThresholdError",
     "RedirectNotFoundError",
+    "RedirectQuotaError",
     "UserAlreadyExistsError",
     "UserNotFoundError",
 ]
@@ -40,3 +41,11 @@ class DuplicateKeyError(DatabaseError):
 
 class DuplicateThresholdError(DatabaseError):
     pass
+
+
+class RedirectQuotaError(DatabaseError):
+    pass
+
+
+class BackupError(DatabaseError):
+    pass
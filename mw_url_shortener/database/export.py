@@ -0,0 +1,350 @@
+"""
+streams redirects and users out of the database, to move them to another
+instance, or into analytics
+
+rows are read chunk_size at a time, in primary key order, and each chunk is
+encoded and written before the next one is fetched, so memory use doesn't
+depend on the size of the tables; each chunk is read in its own short
+db_session, starting after the last key of the one before, so the export never
+holds a read lock on the database for longer than one chunk takes, and the
+server can keep writing while a big table is exported
+
+the export isn't a snapshot: a row written while it runs is exported if its
+key comes after the chunks already read; back up the database first, and
+export from the backup, when that matters
+
+JSON lines are encoded with orjson; JSON lines and CSV files can be compressed
+with gzip, bz2, or xz as they're written
+
+a SQLite export is a database, with the newest tables, that a server can use;
+long uris are stored in the redirect table, and the compress-uris subcommand
+can move them out again
+
+exported users include their hashed passwords, so they can log in to the
+instance they're moved to
+"""
+import bz2
+import csv
+import gzip
+import io
+import lzma
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+from pony.converting import str2datetime
+from pony.orm import Database
+
+from ..types import Compression, ExportFormat, SPath
+from ..utils import normalize_key, uri_hash
+from . import uris
+from .entities import get_db
+from .interface import session, setup_db
+
+__all__ = [
+    "CHUNK_SIZE",
+    "REDIRECT_FIELDS",
+    "USER_FIELDS",
+    "guess_format",
+    "export_redirects",
+    "export_users",
+]
+
+# How many rows are fetched from the cursor, and written, at a time
+CHUNK_SIZE = 5_000
+
+REDIRECT_FIELDS = ("host", "key", "uri", "expires_at", "owner")
+USER_FIELDS = ("username", "hashed_password", "redirect_quota")
+
+# Rows are read in primary key order, a chunk at a time, and long uris are
+# joined in, so each redirect is complete without another query; {after} is
+# left out for the first chunk, and filled in with the *_AFTER condition, which
+# starts after the last key read, for the rest
+REDIRECTS_QUERY = """
+SELECT r."host", r."key", r."uri", l."data", l."compressed", l."dictionary_id",
+       r."expires_at", r."owner"
+FROM "RedirectEntity" r LEFT JOIN "LongUriEntity" l ON l."id" = r."long_uri_id"
+{after}
+ORDER BY r."host", r."key" LIMIT $limit
+"""
+REDIRECTS_AFTER = 'WHERE r."host" > $host OR (r."host" = $host AND r."key" > $key)'
+REDIRECTS_KEY = ("host", "key")
+USERS_QUERY = """
+SELECT "username", "hashed_password", "redirect_quota"
+FROM "UserEntity" {after} ORDER BY "username" LIMIT $limit
+"""
+USERS_AFTER = 'WHERE "username" > $username'
+USERS_KEY = ("username",)
+
+_OPENERS: Dict[Compression, Callable[..., BinaryIO]] = {
+    Compression.none: open,
+    Compression.gzip: gzip.open,
+    Compression.bz2: bz2.open,
+    Compression.xz: lzma.open,
+}
+_COMPRESSION_SUFFIXES = {
+    ".gz": Compression.gzip,
+    ".bz2": Compression.bz2,
+    ".xz": Compression.xz,
+}
+_FORMAT_SUFFIXES = {
+    ".jsonl": ExportFormat.jsonl,
+    ".json": ExportFormat.jsonl,
+    ".csv": ExportFormat.csv,
+    ".sqlite": ExportFormat.sqlite,
+    ".sqlitedb": ExportFormat.sqlite,
+    ".db": ExportFormat.sqlite,
+}
+
+Row = Tuple[Any, ...]
+
+
+def guess_format(path: SPath) -> Tuple[ExportFormat, Compression]:
+    """
+    the format and compression a file's suffixes ask for, like
+    redirects.jsonl.gz; JSON lines, uncompressed, if they don't say
+    """
+    suffixes = Path(path).suffixes
+    compression = Compression.none
+    if suffixes and suffixes[-1] in _COMPRESSION_SUFFIXES:
+        compression = _COMPRESSION_SUFFIXES[suffixes.pop()]
+    export_format = ExportFormat.jsonl
+    if suffixes and suffixes[-1] in _FORMAT_SUFFIXES:
+        export_format = _FORMAT_SUFFIXES[suffixes[-1]]
+    return export_format, compression
+
+
+def _chunks(
+    db: Database,
+    query: str,
+    after: str,
+    key_columns: Tuple[str, ...],
+    chunk_size: int,
+    convert: Callable[[List[Row]], List[Row]] = list,
+) -> Iterator[List[Row]]:
+    """
+    the rows a query returns, chunk_size at a time, each read, and passed
+    through convert, in its own db_session; the first columns of each row are
+    its key_columns
+    """
+    position: Dict[str, Any] = {}
+    while True:
+        with session():
+            rows = db.execute(
+                query.format(after=after if position else ""),
+                globals={},
+                locals={**position, "limit": chunk_size},
+            ).fetchall()
+            if not rows:
+                return
+            position = dict(zip(key_columns, rows[-1]))
+            chunk = convert(rows)
+        # yielded outside the session, so it isn't held while the chunk is
+        # written
+        yield chunk
+
+
+def _redirect_chunks(db: Database, chunk_size: int) -> Iterator[List[Row]]:
+    "the redirects, as REDIRECT_FIELDS, with their full uris"
+
+    def convert(rows: List[Row]) -> List[Row]:
+        return [
+            (
+                host,
+                key,
+                uri
+                if data is None
+                else uris.unpack_uri(db, data, compressed, dictionary_id),
+                None if expires_at is None else str2datetime(expires_at),
+                owner,
+            )
+            for host, key, uri, data, compressed, dictionary_id, expires_at, owner in rows
+        ]
+
+    return _chunks(
+        db, REDIRECTS_QUERY, REDIRECTS_AFTER, REDIRECTS_KEY, chunk_size, convert
+    )
+
+
+def _write_jsonl(
+    chunks: Iterator[List[Row]], fields: Tuple[str, ...], file: BinaryIO
+) -> int:
+    written = 0
+    for rows in chunks:
+        file.write(
+            b"".join(
+                orjson.dumps(dict(zip(fields, row)), option=orjson.OPT_APPEND_NEWLINE)
+                for row in rows
+            )
+        )
+        written += len(rows)
+    return written
+
+
+def _csv_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _write_csv(
+    chunks: Iterator[List[Row]], fields: Tuple[str, ...], file: BinaryIO
+) -> int:
+    written = 0
+    # the csv module needs text, and leaves line endings to the writer
+    text_file = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    writer = csv.writer(text_file)
+    writer.writerow(fields)
+    for rows in chunks:
+        writer.writerows([tuple(map(_csv_value, row)) for row in rows])
+        written += len(rows)
+    text_file.flush()
+    # the file is closed by whoever opened it
+    text_file.detach()
+    return written
+
+
+def _export_to_file(
+    db: Database,
+    output: Path,
+    chunks: Callable[[], Iterator[List[Row]]],
+    fields: Tuple[str, ...],
+    export_format: ExportFormat,
+    compression: Compression,
+) -> int:
+    write = _write_csv if export_format == ExportFormat.csv else _write_jsonl
+    with _OPENERS[compression](output, "wb") as file:
+        return write(chunks(), fields, file)
+
+
+def _sqlite_destination(output: Path) -> sqlite3.Connection:
+    "makes the newest tables in the database at output, if they're missing"
+    destination_db = setup_db(db=get_db(), filename=output, create_tables=True)
+    destination_db.disconnect()
+    return sqlite3.connect(str(output))
+
+
+def _export_to_sqlite(
+    db: Database,
+    output: Path,
+    chunks: Callable[[], Iterator[List[Row]]],
+    insert: str,
+    to_columns: Callable[[Row], Row],
+) -> int:
+    destination = _sqlite_destination(output)
+    written = 0
+    try:
+        for rows in chunks():
+            # each chunk is its own transaction
+            with destination:
+                destination.executemany(insert, map(to_columns, rows))
+            written += len(rows)
+    finally:
+        destination.close()
+    return written
+
+
+def _redirect_columns(row: Row) -> Row:
+    "a redirect's values, with the columns pony would fill in"
+    host, key, uri, expires_at, owner = row
+    return (
+        host,
+        key,
+        uri,
+        normalize_key(key),
+        uri_hash(uri),
+        None if expires_at is None else str(expires_at),
+        owner,
+    )
+
+
+def _check_options(
+    output: SPath,
+    export_format: Optional[ExportFormat],
+    compression: Optional[Compression],
+    chunk_size: int,
+) -> Tuple[Path, ExportFormat, Compression]:
+    "fills in the format and compression from output's suffixes"
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    output = Path(output).resolve()
+    guessed_format, guessed_compression = guess_format(output)
+    export_format = export_format or guessed_format
+    compression = compression or guessed_compression
+    if export_format == ExportFormat.sqlite and compression != Compression.none:
+        raise ValueError("SQLite exports can't be compressed")
+    return output, export_format, compression
+
+
+def export_redirects(
+    db: Database,
+    output: SPath,
+    export_format: Optional[ExportFormat] = None,
+    compression: Optional[Compression] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """
+    writes every redirect, including expired ones, to output, and returns how
+    many were written
+
+    the format and compression are guessed from output's suffixes unless
+    they're given; a SQLite export can go into a database that other
+    redirects or users have been exported into, and a redirect that's already
+    there, with the same host and key, is replaced
+    """
+    output, export_format, compression = _check_options(
+        output, export_format, compression, chunk_size
+    )
+
+    def chunks() -> Iterator[List[Row]]:
+        return _redirect_chunks(db, chunk_size)
+
+    if export_format == ExportFormat.sqlite:
+        return _export_to_sqlite(
+            db,
+            output,
+            chunks,
+            'INSERT OR REPLACE INTO "RedirectEntity" '
+            "(host, key, uri, normalized_key, uri_hash, expires_at, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            _redirect_columns,
+        )
+    return _export_to_file(
+        db, output, chunks, REDIRECT_FIELDS, export_format, compression
+    )
+
+
+def export_users(
+    db: Database,
+    output: SPath,
+    export_format: Optional[ExportFormat] = None,
+    compression: Optional[Compression] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """
+    writes every user to output, and returns how many were written
+
+    the format and compression are guessed from output's suffixes unless
+    they're given; in a SQLite export, a user that's already there, with the
+    same username, is replaced
+    """
+    output, export_format, compression = _check_options(
+        output, export_format, compression, chunk_size
+    )
+
+    def chunks() -> Iterator[List[Row]]:
+        return _chunks(db, USERS_QUERY, USERS_AFTER, USERS_KEY, chunk_size)
+
+    if export_format == ExportFormat.sqlite:
+        return _export_to_sqlite(
+            db,
+            output,
+            chunks,
+            'INSERT OR REPLACE INTO "UserEntity" '
+            "(username, hashed_password, redirect_quota) "
+            "VALUES (?, ?, ?)",
+            tuple,
+        )
+    return _export_to_file(db, output, chunks, USER_FIELDS, export_format, compression)
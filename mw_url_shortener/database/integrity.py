@@ -0,0 +1,178 @@
+"""
+checks that a database file is usable, without reading all of it every time
+
+pragma quick_check reads every page, so it takes longer the bigger the
+database is; by default, only the header, and the schema version, are
+checked, and the thorough checks are done when asked for, or on a schedule
+
+the result of a thorough check is saved in a file next to the database,
+along with the database's modification time and size, so it isn't repeated
+until the database changes
+"""
+import sqlite3
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+import orjson
+
+from ..types import IntegrityCheck, SPath
+
+__all__ = [
+    "SQLITE_HEADER",
+    "CheckResult",
+    "check_header",
+    "run_check",
+    "cached_result",
+    "check_database_file",
+]
+
+# Every SQLite database file starts with this
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# The pragma each thorough check runs
+_PRAGMAS = {
+    IntegrityCheck.quick: "quick_check",
+    IntegrityCheck.full: "integrity_check",
+}
+
+
+class CheckResult(NamedTuple):
+    "the result of a thorough check, and the file it was made on"
+    level: IntegrityCheck
+    ok: bool
+    mtime_ns: int
+    size: int
+
+
+def _cache_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.check")
+
+
+def check_header(path: Path) -> bool:
+    """
+    whether a file looks like an SQLite database; an empty file is one that
+    hasn't been written to yet
+    """
+    with path.open("rb") as file:
+        header = file.read(100)
+    if not header:
+        return True
+    if len(header) < 100 or not header.startswith(SQLITE_HEADER):
+        return False
+    # stored big-endian at offset 16, with 1 meaning 65536
+    page_size = int.from_bytes(header[16:18], "big")
+    return page_size == 1 or (
+        512 <= page_size <= 32768 and not page_size & (page_size - 1)
+    )
+
+
+def _busy(err: sqlite3.Error) -> bool:
+    "whether an error only means another connection was using the database"
+    message = str(err).lower()
+    return isinstance(err, sqlite3.OperationalError) and (
+        "locked" in message or "busy" in message
+    )
+
+
+def _run_check(path: Path, level: IntegrityCheck) -> Tuple[bool, bool]:
+    """
+    runs a check, and returns whether the database passed it, and whether
+    that's SQLite's verdict on the file, which is worth saving
+
+    the database being locked, or busy, says nothing about the file, so that
+    error is raised instead
+    """
+    try:
+        # not read-only, so that a journal left by a crash can be rolled back,
+        # but the file isn't made if it's missing
+        connection = sqlite3.connect(f"{path.as_uri()}?mode=rw", uri=True)
+    except sqlite3.Error:
+        return False, False
+    try:
+        # reading the schema version makes SQLite parse the header and schema
+        connection.execute("pragma schema_version").fetchone()
+        if level == IntegrityCheck.header:
+            return True, True
+        result = connection.execute(f"pragma {_PRAGMAS[level]}").fetchone()[0]
+        return result == "ok", True
+    except sqlite3.Error as err:
+        if _busy(err):
+            raise
+        return False, False
+    finally:
+        connection.close()
+
+
+def run_check(path: Path, level: IntegrityCheck) -> bool:
+    """
+    opens the database, and runs the check, without using the saved results
+
+    sqlite3.OperationalError is raised if the database is locked or busy
+    """
+    return _run_check(path, level)[0]
+
+
+def cached_result(path: Path) -> Optional[CheckResult]:
+    """
+    the last thorough check made on the database, if it hasn't changed since
+    """
+    try:
+        result = CheckResult(**orjson.loads(_cache_path(path).read_bytes()))
+        stat = path.stat()
+    except (OSError, ValueError, TypeError):
+        return None
+    if (result.mtime_ns, result.size) != (stat.st_mtime_ns, stat.st_size):
+        return None
+    return result._replace(level=IntegrityCheck(result.level))
+
+
+def _save_result(path: Path, result: CheckResult) -> None:
+    cache_path = _cache_path(path)
+    temporary_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    try:
+        temporary_path.write_bytes(orjson.dumps(result._asdict()))
+        temporary_path.replace(cache_path)
+    except OSError:
+        # the check just happens again next time
+        pass
+
+
+def check_database_file(
+    filename: SPath, level: IntegrityCheck = IntegrityCheck.header
+) -> bool:
+    """
+    checks a database file as thoroughly as level asks for
+
+    a thorough check is skipped if one at least as thorough was already made,
+    and the file hasn't changed since
+
+    sqlite3.OperationalError is raised if the database is locked or busy, and
+    nothing is saved
+    """
+    path = Path(filename).resolve()
+    if not path.is_file():
+        return False
+    if not check_header(path):
+        return False
+    if path.stat().st_size == 0:
+        return True
+    if level == IntegrityCheck.header:
+        return run_check(path, level)
+
+    cached = cached_result(path)
+    if cached is not None and (
+        not cached.ok or cached.level == level or cached.level == IntegrityCheck.full
+    ):
+        return cached.ok
+
+    stat = path.stat()
+    ok, conclusive = _run_check(path, level)
+    # a check that couldn't run is tried again next time
+    if conclusive:
+        _save_result(
+            path,
+            CheckResult(
+                level=level, ok=ok, mtime_ns=stat.st_mtime_ns, size=stat.st_size
+            ),
+        )
+    return ok
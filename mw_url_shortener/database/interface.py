@@ -1,50 +1,63 @@
-print(f"imported mw_url_shortener.database.interface as {__name__}")
+from datetime import datetime
+from itertools import islice
 from pathlib import Path
-from sqlite3 import DatabaseError
 from typing import List, Optional, Union
 
 from fastapi import Depends
-from pony.orm import Database, db_session
-from pony.orm.dbapiprovider import DBException
-
-from ..types import HashedPassword, Key, SPath, Uri, Username
-from ..utils import unsafe_random_chars
-from . import get_db
+from pony.orm import Database, count, db_session, raw_sql, select
+from pony.orm.core import DBSessionContextManager, Entity
+
+from .. import metrics
+from ..metrics import DATABASE_SECONDS, timed
+from ..profiling import profiled
+from ..types import (
+    ChangeOperation,
+    HashedPassword,
+    IntegrityCheck,
+    Key,
+    KeyNormalization,
+    SPath,
+    Uri,
+    Username,
+)
+from ..utils import DEFAULT_HOST, normalize_key, safe_key_chars, uri_hash
+from . import get_db, integrity, migrations, uris
 from .errors import (
     DatabaseError,
     DuplicateKeyError,
     DuplicateThresholdError,
     RedirectNotFoundError,
+    RedirectQuotaError,
     UserAlreadyExistsError,
     UserNotFoundError,
 )
-from .models import RedirectModel, UserModel
+from .models import (
+    NewRedirectModel,
+    RedirectChangeModel,
+    RedirectModel,
+    UserModel,
+)
 
+# How many taken keys new_redirect_key tries after the first, before giving up
+DUPLICATE_THRESHOLD = 10
 
-def valid_database_file(filename: SPath) -> bool:
-    "Opens a connection to a database file, and runs a quick database check"
-    path = Path(filename).resolve()
-    if not path.is_file():
-        return False
 
-    temp_db = Database()
-    try:
-        temp_db.bind(provider="sqlite", filename=str(path), create_db=False)
-        # From:
-        # https://stackoverflow.com/a/21146372
-        with db_session:
-            schema_version = temp_db.execute("pragma schema_version;").fetchone()[0]
-            quick_check = temp_db.execute("pragma quick_check;").fetchone()[0]
-    # NOTE:FEATURE::DATABASE update with exceptions from other database drivers
-    except (DatabaseError, DBException) as err:
-        return False
-    finally:
-        temp_db.disconnect()
+def session() -> DBSessionContextManager:
+    "a pony db_session, counted in the metrics each time one is entered"
+    metrics.DATABASE_SESSIONS.inc()
+    return db_session
 
-    if quick_check != "ok":
-        return False
 
-    return True
+def valid_database_file(
+    filename: SPath, check: IntegrityCheck = IntegrityCheck.header
+) -> bool:
+    """
+    checks that a database file is usable, as thoroughly as check asks for
+
+    the default only reads the header and schema, so it's quick however big
+    the database is; see database.integrity
+    """
+    return integrity.check_database_file(filename, level=check)
 
 
 def create_database_file(filename: SPath) -> None:
@@ -65,9 +78,12 @@ def create_database_file(filename: SPath) -> None:
 # If so, how would the entities in entities.py be declared without a
 # Database() object?
 # NOTE:FEATURE::DATABASE Currently, only a SQLite database is supported
-def set_database_file_and_connect(db: Database, filename: SPath) -> Database:
+def set_database_file_and_connect(
+    db: Database, filename: SPath, check: IntegrityCheck = IntegrityCheck.header
+) -> Database:
     """
-    Connects pony's database engine to a physical file on disk
+    Connects pony's database engine to a physical file on disk, after checking
+    it as thoroughly as check asks for
     """
     path = Path(filename).resolve()
     if not path.exists():
@@ -75,7 +91,7 @@ def set_database_file_and_connect(db: Database, filename: SPath) -> Database:
     elif path.exists() and not path.is_file():
         raise ValueError(f"expected database file, '{path}' is not a file")
 
-    if not valid_database_file(filename=path):
+    if not valid_database_file(filename=path, check=check):
         raise ValueError(f"'{path}' is not a valid database file")
 
     db.bind(provider="sqlite", filename=str(path), create_db=False)
@@ -92,44 +108,169 @@ def generate_mapping(db: Database, create_tables: bool = True) -> Database:
     return db
 
 
-def setup_db(db: Database, filename: SPath, create_tables: bool = True) -> Database:
+def setup_db(
+    db: Database,
+    filename: SPath,
+    create_tables: bool = True,
+    migrate: bool = True,
+    check: IntegrityCheck = IntegrityCheck.header,
+) -> Database:
     """
-    convencience function combining set_database_file_and_connect and
-    generate_mapping
+    convencience function combining set_database_file_and_connect,
+    migrations.migrate, and generate_mapping
     """
-    set_database_file_and_connect(db=db, filename=filename)
+    set_database_file_and_connect(db=db, filename=filename, check=check)
+    if migrate:
+        migrations.migrate(db=db)
     return generate_mapping(db=db, create_tables=create_tables)
 
 
-def get_redirect(key: Key, db: Database = Depends(get_db)) -> RedirectModel:
-    with db_session:
-        redirect = db.RedirectEntity.get(key=str(key))
+@profiled
+@timed(DATABASE_SECONDS)
+def get_redirect(
+    key: Key,
+    db: Database = Depends(get_db),
+    normalization: KeyNormalization = KeyNormalization.exact,
+    host: str = DEFAULT_HOST,
+    fallback_host: Optional[str] = None,
+) -> RedirectModel:
+    """
+    looks up a redirect by its host and key; the host should be normalized
+    already, the way RedirectModel stores it
+
+    unless normalization is exact, variants of a key are matched too, as long
+    as only one redirect matches; an exact match always wins
+
+    if nothing matches on host, the key is looked up on fallback_host, if
+    it's given; a server with domains falls back to DEFAULT_HOST, where the
+    redirects made before it had domains are
+
+    expired redirects are treated as if they don't exist
+    """
+    with session():
+        redirect = _find_redirect(db, key, normalization, host)
+        if not redirect and fallback_host is not None and fallback_host != host:
+            redirect = _find_redirect(db, key, normalization, fallback_host)
         if not redirect:
             raise RedirectNotFoundError(f"no redirect found with key '{key}'")
 
-        return RedirectModel.from_orm(redirect)
+        return uris.to_model(db, redirect)
 
 
+def _find_redirect(
+    db: Database, key: Key, normalization: KeyNormalization, host: str
+) -> Optional[Entity]:
+    "the unexpired redirect a key refers to on a host; needs a db_session"
+    if normalization == KeyNormalization.exact:
+        redirect = db.RedirectEntity.get(host=host, key=str(key))
+    else:
+        redirect = _find_normalized_redirect(db, key, normalization, host)
+    if not redirect or _expired(redirect):
+        return None
+    return redirect
+
+
+def _taken_on(host: str) -> Optional[str]:
+    """
+    the host whose keys new keys for host shouldn't reuse: a key made for a
+    domain would hide the redirect with the same key on DEFAULT_HOST, which
+    the domain falls back to
+    """
+    return None if host == DEFAULT_HOST else DEFAULT_HOST
+
+
+def _expired(redirect: Entity, now: Optional[datetime] = None) -> bool:
+    "whether a redirect has expired"
+    return redirect.expires_at is not None and redirect.expires_at <= (
+        now or datetime.utcnow()
+    )
+
+
+def _find_normalized_redirect(
+    db: Database, key: Key, normalization: KeyNormalization, host: str
+) -> Optional[Entity]:
+    "finds the redirect a variant of a key refers to; needs a db_session"
+    exact_key = str(key)
+    normalized_key = normalize_key(exact_key)
+    # one query, using both the primary key and the normalized_key index
+    now = datetime.utcnow()
+    candidates = [
+        candidate
+        for candidate in select(
+            redirect
+            for redirect in db.RedirectEntity
+            if (redirect.host == host and redirect.key == exact_key)
+            or (redirect.host == host and redirect.normalized_key == normalized_key)
+        )
+        if not _expired(candidate, now)
+    ]
+    for candidate in candidates:
+        if candidate.key == exact_key:
+            return candidate
+
+    if normalization == KeyNormalization.lenient:
+        case_sensitive_key = normalize_key(exact_key, casefold=False)
+        candidates = [
+            candidate
+            for candidate in candidates
+            if normalize_key(candidate.key, casefold=False) == case_sensitive_key
+        ]
+    # keys that only differ in ways normalization ignores are ambiguous
+    return candidates[0] if len(candidates) == 1 else None
+
+
+@profiled
+@timed(DATABASE_SECONDS)
 def create_redirect(
     redirect: Optional[RedirectModel] = None,
     uri: Optional[Uri] = None,
     db: Database = Depends(get_db),
+    reuse_existing: bool = False,
+    expires_at: Optional[datetime] = None,
+    owner: Optional[Username] = None,
+    host: str = DEFAULT_HOST,
 ) -> RedirectModel:
-    "add a redirect to the database, and verify that it's represented correctly"
+    """
+    add a redirect to the database, and verify that it's represented correctly
+
+    if only a uri is given and reuse_existing is True, an existing redirect to
+    the same uri, on the same host, with the same owner, that expires no
+    earlier, is returned instead of making a new one
+
+    the key of an expired redirect can be reused; the expired redirect is
+    replaced
+
+    if the redirect has an owner, they must exist, and be under their
+    redirect_quota
+    """
     if redirect is None and uri is None:
         raise TypeError("need exactly one of either uri or redirect")
     if redirect and uri:
         raise TypeError("need exactly one of either uri or redirect")
 
     if not redirect:
+        if reuse_existing:
+            for existing_redirect in find_by_uri(db=db, uri=uri, host=host):
+                if existing_redirect.owner == owner and (
+                    existing_redirect.expires_at is None
+                    or (
+                        expires_at is not None
+                        and existing_redirect.expires_at >= expires_at
+                    )
+                ):
+                    return existing_redirect
         new_redirect: RedirectModel = RedirectModel(
-            key=new_redirect_key(db=db), uri=uri
+            host=host,
+            key=new_redirect_key(db=db, host=host),
+            uri=uri,
+            expires_at=expires_at,
+            owner=owner,
         )
     else:
         new_redirect = redirect
 
     try:
-        get_redirect(db=db, key=new_redirect.key)
+        get_redirect(db=db, key=new_redirect.key, host=new_redirect.host)
     except RedirectNotFoundError as err:
         pass
     else:
@@ -137,64 +278,447 @@ def create_redirect(
             f"a redirect with key '{new_redirect.key}' already exists"
         )
 
-    with db_session:
-        created_redirect = RedirectModel.from_orm(
-            db.RedirectEntity(key=new_redirect.key, uri=new_redirect.uri)
+    with session():
+        existing_redirect = db.RedirectEntity.get(
+            host=new_redirect.host, key=new_redirect.key
+        )
+        if existing_redirect and not _expired(existing_redirect):
+            # made since the check above
+            raise DuplicateKeyError(
+                f"a redirect with key '{new_redirect.key}' already exists"
+            )
+        # everything that can go wrong is checked before anything is written,
+        # so create_redirects can carry on in the same transaction
+        owner = _owner_with_room(db, new_redirect.owner)
+        if existing_redirect:
+            uris.delete_uri(db, existing_redirect)
+            existing_redirect.delete()
+            db.flush()
+        created_redirect = uris.to_model(
+            db,
+            db.RedirectEntity(
+                host=new_redirect.host,
+                key=new_redirect.key,
+                expires_at=new_redirect.expires_at,
+                owner=owner,
+                **uris.uri_columns(db, new_redirect.uri),
+            ),
         )
+        # replacing an expired redirect is logged as a create, which caches
+        # apply the same way as an update
+        _log_change(db, ChangeOperation.create, created_redirect)
     assert created_redirect == new_redirect, "Database mutated data"
     return new_redirect
 
 
+@profiled
+@timed(DATABASE_SECONDS)
+def create_redirects(
+    new_redirects: List[NewRedirectModel],
+    db: Database = Depends(get_db),
+    key_length: int = 3,
+) -> List[Union[RedirectModel, DatabaseError]]:
+    """
+    adds many redirects in one transaction; those without a key are given a
+    new one, key_length characters long
+
+    each result is the redirect that was made, or the error that stopped it
+    from being made, in the same order, so one bad redirect doesn't stop the
+    others
+    """
+    results: List[Union[RedirectModel, DatabaseError]] = []
+    with session():
+        for new_redirect in new_redirects:
+            try:
+                key = new_redirect.key or new_redirect_key(
+                    length=key_length, db=db, host=new_redirect.host
+                )
+                results.append(
+                    create_redirect(
+                        db=db,
+                        redirect=RedirectModel(**{**new_redirect.dict(), "key": key}),
+                    )
+                )
+            except (
+                DuplicateKeyError,
+                DuplicateThresholdError,
+                RedirectQuotaError,
+                UserNotFoundError,
+            ) as err:
+                results.append(err)
+    return results
+
+
+def _log_change(
+    db: Database,
+    operation: ChangeOperation,
+    redirect: RedirectModel,
+) -> None:
+    """
+    appends a change to the change log; it's made in the same db_session as
+    the change itself, so it's committed, or rolled back, along with it
+    """
+    deleted = operation == ChangeOperation.delete
+    db.RedirectChangeEntity(
+        operation=operation.value,
+        host=redirect.host,
+        key=redirect.key,
+        uri=None if deleted else redirect.uri,
+        expires_at=None if deleted else redirect.expires_at,
+    )
+
+
+def _owned_redirects(db: Database, owner: Entity, now: datetime) -> int:
+    "counts an owner's unexpired redirects, using the (owner, key) index"
+    return count(
+        redirect
+        for redirect in db.RedirectEntity
+        if redirect.owner == owner
+        and (redirect.expires_at is None or redirect.expires_at > now)
+    )
+
+
+def _owner_with_room(db: Database, username: Optional[Username]) -> Optional[Entity]:
+    """
+    the UserEntity that's going to own a new redirect, after checking they
+    can own another one
+    """
+    if username is None:
+        return None
+    owner = db.UserEntity.get(username=username)
+    if not owner:
+        raise UserNotFoundError(f"no user found with username '{username}'")
+    if (
+        owner.redirect_quota is not None
+        and _owned_redirects(db, owner, datetime.utcnow()) >= owner.redirect_quota
+    ):
+        raise RedirectQuotaError(
+            f"user '{username}' already has {owner.redirect_quota} redirects"
+        )
+    return owner
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def count_redirects(username: Username, db: Database = Depends(get_db)) -> int:
+    "how many unexpired redirects a user owns"
+    with session():
+        owner = db.UserEntity.get(username=username)
+        if not owner:
+            raise UserNotFoundError(f"no user found with username '{username}'")
+        return _owned_redirects(db, owner, datetime.utcnow())
+
+
+@profiled
+@timed(DATABASE_SECONDS)
 def update_redirect(
-    key: Key, updated_redirect: RedirectModel, db: Database = Depends(get_db)
+    key: Key,
+    updated_redirect: RedirectModel,
+    db: Database = Depends(get_db),
+    host: str = DEFAULT_HOST,
 ) -> RedirectModel:
-    "updates a redirect"
-    with db_session:
-        old_redirect_entity = db.RedirectEntity.get(key=key)
+    """
+    updates a redirect; it can be moved to another key, or another host
+
+    expired redirects that haven't been deleted yet can be updated, so they
+    can be given a new expiry time
+
+    moving a redirect is logged as a create, then a delete of the old one; the
+    old one is deleted before the new one is made, so it doesn't count against
+    its owner's redirect_quota
+    """
+    with session():
+        old_redirect_entity = db.RedirectEntity.get(host=host, key=key)
 
         if not old_redirect_entity:
             raise RedirectNotFoundError(f"no redirect found with key '{key}'")
 
-        if old_redirect_entity.key != updated_redirect.key:
-            create_redirect(db=db, redirect=updated_redirect)
+        if (
+            old_redirect_entity.key != updated_redirect.key
+            or old_redirect_entity.host != updated_redirect.host
+        ):
+            taken = db.RedirectEntity.get(
+                host=updated_redirect.host, key=updated_redirect.key
+            )
+            if taken and not _expired(taken):
+                raise DuplicateKeyError(
+                    f"a redirect with key '{updated_redirect.key}' already exists"
+                )
+            old_redirect = uris.to_model(db, old_redirect_entity)
+            uris.delete_uri(db, old_redirect_entity)
             old_redirect_entity.delete()
-        else:
-            old_redirect_entity.uri = updated_redirect.uri
-
-        return RedirectModel.from_orm(db.RedirectEntity.get(key=updated_redirect.key))
-
-
+            db.flush()
+            # if this raises, the session is rolled back, and the old redirect
+            # is kept
+            create_redirect(db=db, redirect=updated_redirect)
+            _log_change(db, ChangeOperation.delete, old_redirect)
+            return uris.to_model(
+                db,
+                db.RedirectEntity.get(
+                    host=updated_redirect.host, key=updated_redirect.key
+                ),
+            )
+
+        uris.set_uri(db, old_redirect_entity, updated_redirect.uri)
+        old_redirect_entity.expires_at = updated_redirect.expires_at
+        old_owner = old_redirect_entity.owner
+        if updated_redirect.owner != (old_owner.username if old_owner else None):
+            old_redirect_entity.owner = _owner_with_room(db, updated_redirect.owner)
+        new_redirect = uris.to_model(db, old_redirect_entity)
+        _log_change(db, ChangeOperation.update, new_redirect)
+        return new_redirect
+
+
+@profiled
+@timed(DATABASE_SECONDS)
 def delete_redirect(redirect: RedirectModel, db: Database = Depends(get_db)) -> None:
     "deletes a redirect; the redirect must exist"
-    with db_session:
-        redirect_entity = db.RedirectEntity.get(key=redirect.key)
+    with session():
+        redirect_entity = db.RedirectEntity.get(host=redirect.host, key=redirect.key)
 
         if not redirect_entity:
             raise RedirectNotFoundError(f"no redirect found with key '{redirect.key}'")
 
+        uris.delete_uri(db, redirect_entity)
         redirect_entity.delete()
+        _log_change(db, ChangeOperation.delete, redirect)
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def list_redirects(
+    db: Database = Depends(get_db),
+    owner: Optional[Username] = None,
+    after: Optional[Key] = None,
+    limit: Optional[int] = None,
+    host: Optional[str] = None,
+    after_host: Optional[str] = None,
+) -> List[RedirectModel]:
+    """
+    returns a list of the current redirects in the database, in order of their
+    hosts, then keys, leaving out expired ones
+
+    if an owner or a host are given, only their redirects are listed; an
+    owner's use the (owner, host, key) index
+
+    to page through the redirects of one host, pass the key of the last
+    redirect on one page as after, to get the redirects on the next one; to
+    page through every host, pass its host as after_host too
+
+    returned list may be empty
+    """
+    now = datetime.utcnow()
+    with session():
+        redirects = select(
+            redirect
+            for redirect in db.RedirectEntity
+            if redirect.expires_at is None or redirect.expires_at > now
+        )
+        if owner is not None:
+            owner_entity = db.UserEntity.get(username=owner)
+            if not owner_entity:
+                raise UserNotFoundError(f"no user found with username '{owner}'")
+            redirects = redirects.where(lambda redirect: redirect.owner == owner_entity)
+        if host is not None:
+            redirects = redirects.where(lambda redirect: redirect.host == host)
+        if after is not None and after_host is not None:
+            after_key = str(after)
+            redirects = redirects.where(
+                lambda redirect: redirect.host > after_host
+                or (redirect.host == after_host and redirect.key > after_key)
+            )
+        elif after is not None:
+            if host is None:
+                raise TypeError("after needs a host, since keys repeat across hosts")
+            after_key = str(after)
+            redirects = redirects.where(lambda redirect: redirect.key > after_key)
+        redirects = redirects.order_by(lambda redirect: (redirect.host, redirect.key))
+        if limit is not None:
+            redirects = redirects.limit(limit)
+        return [uris.to_model(db, redirect) for redirect in redirects]
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def list_changes(
+    after: int = 0,
+    limit: Optional[int] = None,
+    db: Database = Depends(get_db),
+) -> List[RedirectChangeModel]:
+    """
+    returns the changes made to redirects after the one numbered after, oldest
+    first
+
+    a cache that has applied every change up to a sequence number passes it as
+    after, to get only the ones it hasn't seen; starting from 0 replays every
+    change, which rebuilds every redirect made since the change log was added
 
+    redirects deleted by delete_expired_redirects aren't logged, since caches
+    already know when each redirect expires
 
-def list_redirects(db: Database = Depends(get_db)) -> List[RedirectModel]:
+    returned list may be empty
+    """
+    with session():
+        changes = select(
+            change for change in db.RedirectChangeEntity if change.sequence > after
+        ).order_by(lambda change: change.sequence)
+        if limit is not None:
+            changes = changes.limit(limit)
+        return [RedirectChangeModel.from_orm(change) for change in changes]
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def last_change_sequence(db: Database = Depends(get_db)) -> int:
+    """
+    the sequence number of the newest change in the change log, or 0 if it's
+    empty
+    """
+    with session():
+        return select(change.sequence for change in db.RedirectChangeEntity).max() or 0
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def find_by_uri(
+    uri: Uri,
+    db: Database = Depends(get_db),
+    limit: Optional[int] = None,
+    host: Optional[str] = None,
+) -> List[RedirectModel]:
     """
-    returns a list of all current redirects in the database
+    returns the unexpired redirects to a uri, on any host unless one is given,
+    in order of their hosts, then keys, using the uri_hash index
 
     returned list may be empty
     """
-    with db_session:
+    hashed_uri = uri_hash(uri)
+    now = datetime.utcnow()
+    with session():
+        redirects = select(
+            redirect
+            for redirect in db.RedirectEntity
+            if redirect.uri_hash == hashed_uri
+            and (redirect.expires_at is None or redirect.expires_at > now)
+        )
+        if host is not None:
+            redirects = redirects.where(lambda redirect: redirect.host == host)
+        redirects = redirects.order_by(lambda redirect: (redirect.host, redirect.key))
+        # long uris aren't in the table, so the uris are compared here, which
+        # also rules out different uris with the same hash
+        found_redirects = (uris.to_model(db, redirect) for redirect in redirects)
         return list(
-            RedirectModel.from_orm(redirect) for redirect in db.RedirectEntity.select()
+            islice(
+                (found for found in found_redirects if found.uri == uri),
+                limit,
+            )
         )
 
 
+@profiled
+@timed(DATABASE_SECONDS)
+def delete_expired_redirects(
+    batch_size: int = 500,
+    max_batches: Optional[int] = None,
+    db: Database = Depends(get_db),
+) -> int:
+    """
+    deletes redirects that have expired, using the expires_at index
+
+    each batch is committed separately, so the write lock is only held
+    briefly, and lookups can happen in between; at most max_batches are
+    deleted, if it's given
+
+    returns how many were deleted
+    """
+    now = datetime.utcnow()
+    deleted = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with session():
+            expired_redirects = select(
+                redirect for redirect in db.RedirectEntity if redirect.expires_at <= now
+            )[:batch_size]
+            for redirect in expired_redirects:
+                uris.delete_uri(db, redirect)
+                redirect.delete()
+        deleted += len(expired_redirects)
+        batches += 1
+        if len(expired_redirects) < batch_size:
+            break
+    return deleted
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def train_uri_dictionary(
+    sample_size: int = 2000, db: Database = Depends(get_db)
+) -> Optional[int]:
+    """
+    trains a preset dictionary on a random sample of the long uris, and makes
+    it the one new long uris are compressed with
+
+    uris that are already stored keep using the dictionary they were
+    compressed with
+
+    returns the id of the new dictionary, or None if the uris had nothing in
+    common to make one from
+    """
+    with session():
+        sample = select(
+            redirect
+            for redirect in db.RedirectEntity
+            if redirect.long_uri_id is not None or raw_sql(uris.LONG_URI_SQL)
+        ).random(sample_size)
+        dictionary = uris.train_dictionary(
+            uris.load_uri(db, redirect) for redirect in sample
+        )
+        if not dictionary:
+            return None
+        dictionary_entity = db.UriDictionaryEntity(data=dictionary)
+        db.flush()
+        return int(dictionary_entity.id)
+
+
+@profiled
+@timed(DATABASE_SECONDS)
+def compress_long_uris(batch_size: int = 500, db: Database = Depends(get_db)) -> int:
+    """
+    moves long uris that are stored in the redirect table, like those added
+    before long uris were stored separately, into LongUriEntity
+
+    each batch is committed separately, so the database isn't locked for long
+
+    returns how many were moved
+    """
+    moved = 0
+    while True:
+        with session():
+            redirects = select(
+                redirect
+                for redirect in db.RedirectEntity
+                if redirect.long_uri_id is None and raw_sql(uris.LONG_URI_SQL)
+            )[:batch_size]
+            for redirect in redirects:
+                uris.set_uri(db, redirect, redirect.uri)
+        moved += len(redirects)
+        if len(redirects) < batch_size:
+            return moved
+
+
+@profiled
+@timed(DATABASE_SECONDS)
 def new_redirect_key(
-    length: int = 3, duplicate_threshold: int = 10, db: Database = Depends(get_db)
+    length: int = 3,
+    duplicate_threshold: int = DUPLICATE_THRESHOLD,
+    db: Database = Depends(get_db),
+    host: str = DEFAULT_HOST,
 ):
     count = 0
     while count <= duplicate_threshold:
-        new_key = Key(unsafe_random_chars(length))
+        new_key = Key(safe_key_chars(length))
         try:
-            get_redirect(db=db, key=new_key)
+            get_redirect(db=db, key=new_key, host=host, fallback_host=_taken_on(host))
         except RedirectNotFoundError as err:
             return new_key
 
@@ -205,9 +729,11 @@ def new_redirect_key(
     )
 
 
+@profiled
+@timed(DATABASE_SECONDS)
 def get_user(username: Username, db: Database = Depends(get_db)) -> UserModel:
     "Looks up user in the database, and builds a User model"
-    with db_session:
+    with session():
         user = db.UserEntity.get(username=username)
         if not user:
             raise UserNotFoundError(f"no user found with username '{username}'")
@@ -215,6 +741,8 @@ def get_user(username: Username, db: Database = Depends(get_db)) -> UserModel:
         return UserModel.from_orm(user)
 
 
+@profiled
+@timed(DATABASE_SECONDS)
 def create_user(user: UserModel, db: Database = Depends(get_db)) -> UserModel:
     "adds a user to the database"
     try:
@@ -225,25 +753,33 @@ def create_user(user: UserModel, db: Database = Depends(get_db)) -> UserModel:
         raise UserAlreadyExistsError(
             f"a user with username '{user.username}' already exists"
         )
-    with db_session:
+    with session():
         return UserModel.from_orm(
-            db.UserEntity(username=user.username, hashed_password=user.hashed_password)
+            db.UserEntity(
+                username=user.username,
+                hashed_password=user.hashed_password,
+                redirect_quota=user.redirect_quota,
+            )
         )
 
 
+@profiled
+@timed(DATABASE_SECONDS)
 def list_users(db: Database = Depends(get_db)) -> List[UserModel]:
     """
     returns a list of all the current users in the database
 
     the list may be empty
     """
-    with db_session:
+    with session():
         return list(UserModel.from_orm(user) for user in db.UserEntity.select())
 
 
+@profiled
+@timed(DATABASE_SECONDS)
 def delete_user(user: UserModel, db: Database = Depends(get_db)) -> None:
     "deletes a user"
-    with db_session:
+    with session():
         user_entity = db.UserEntity.get(username=user.username)
         if not user_entity:
             raise UserNotFoundError(f"no user found with username '{user.username}'")
@@ -251,11 +787,13 @@ def delete_user(user: UserModel, db: Database = Depends(get_db)) -> None:
         user_entity.delete()
 
 
+@profiled
+@timed(DATABASE_SECONDS)
 def update_user(
     username: Username, updated_user: UserModel, db: Database = Depends(get_db)
 ) -> UserModel:
     "updates a user in the database using the new user data"
-    with db_session:
+    with session():
         old_user_entity = db.UserEntity.get(username=username)
 
         if not old_user_entity:
@@ -263,8 +801,13 @@ def update_user(
 
         if old_user_entity.username != updated_user.username:
             create_user(db=db, user=updated_user)
+            # the redirects would lose their owner otherwise
+            db.UserEntity[updated_user.username].redirects.add(
+                old_user_entity.redirects
+            )
             old_user_entity.delete()
         else:
             old_user_entity.hashed_password = updated_user.hashed_password
+            old_user_entity.redirect_quota = updated_user.redirect_quota
 
         return UserModel.from_orm(db.UserEntity.get(username=updated_user.username))
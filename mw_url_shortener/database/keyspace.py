@@ -0,0 +1,214 @@
+"""
+measures how full each key length is, and plans when to raise key_length
+
+new_redirect_key picks random keys of one length from KEY_CHARACTERS, and
+gives up with DuplicateThresholdError after duplicate_threshold + 1 of them are
+already taken; if a fraction p of the keys of that length are taken, that
+happens with probability p ** (duplicate_threshold + 1)
+
+the keys are read in a single streamed pass, in batches straight from the
+database cursor, and counted per batch with collections.Counter, so neither
+the redirects nor a list of every key is held in memory at once
+
+each host has its own keys, so each is analyzed separately; a domain's new
+keys also skip the keys on DEFAULT_HOST, which it falls back to, so those are
+counted as taken on the domain too, once each
+"""
+import math
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from pony.orm import Database
+
+from ..utils import DEFAULT_HOST, KEY_CHARACTERS
+from .interface import DUPLICATE_THRESHOLD, _taken_on, session
+
+__all__ = [
+    "LengthOccupancy",
+    "KeyspaceReport",
+    "count_keys",
+    "failure_probability",
+    "analyze_keyspace",
+    "report_dict",
+]
+
+# How many keys are fetched from the cursor at a time
+BATCH_SIZE = 10_000
+
+# Raising key_length is recommended once new_redirect_key is more likely than
+# this to raise DuplicateThresholdError
+MAX_FAILURE_PROBABILITY = 1e-6
+
+
+class LengthOccupancy(NamedTuple):
+    "how full the keys of one length are"
+    length: int
+    # keys made only of the alphabet, which new_redirect_key could generate
+    used: int
+    # keys with other characters, which were chosen by hand
+    other: int
+    capacity: int
+    occupancy: float
+    # the chance that one random key is already taken
+    collision_probability: float
+    # the chance that new_redirect_key raises DuplicateThresholdError
+    failure_probability: float
+    # None when every key is taken
+    expected_attempts: Optional[float]
+    # how many more keys can be generated before failure_probability is
+    # higher than the maximum
+    remaining: int
+
+
+class KeyspaceReport(NamedTuple):
+    "the occupancy of every key length in use, and a recommended key_length"
+    alphabet: str
+    total: int
+    key_length: int
+    duplicate_threshold: int
+    max_failure_probability: float
+    lengths: List[LengthOccupancy]
+    recommended_key_length: int
+
+    @property
+    def raise_key_length(self) -> bool:
+        "whether key_length should be raised"
+        return self.recommended_key_length > self.key_length
+
+
+def count_keys(
+    db: Database,
+    alphabet: str = KEY_CHARACTERS,
+    batch_size: int = BATCH_SIZE,
+    host: str = DEFAULT_HOST,
+) -> Tuple[Dict[int, int], Dict[int, int]]:
+    """
+    counts the keys of each length new keys on a host can't use, split into
+    those made only of the alphabet, and the rest
+    """
+    # deletes every character of the alphabet, so only the others are left
+    outside_alphabet = str.maketrans("", "", alphabet)
+    in_alphabet_lengths: Counter = Counter()
+    other_lengths: Counter = Counter()
+    entity = db.RedirectEntity
+    quote = db.provider.quote_name
+    query = (
+        f"SELECT {quote(entity.key.column)} FROM {quote(entity._table_)} "
+        f"WHERE {quote(entity.host.column)} = $host"
+    )
+    fallback_host = _taken_on(host)
+    if fallback_host is not None:
+        # UNION leaves out the keys that are on both
+        query += (
+            f" UNION SELECT {quote(entity.key.column)} FROM {quote(entity._table_)} "
+            f"WHERE {quote(entity.host.column)} = $fallback_host"
+        )
+    with session():
+        cursor = db.execute(query)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            keys = [row[0] for row in rows]
+            others = [key for key in keys if key.translate(outside_alphabet)]
+            in_alphabet_lengths.update(map(len, keys))
+            other_lengths.update(map(len, others))
+
+    in_alphabet_lengths.subtract(other_lengths)
+    return (
+        {length: n for length, n in in_alphabet_lengths.items() if n > 0},
+        dict(other_lengths),
+    )
+
+
+def failure_probability(
+    used: int, capacity: int, duplicate_threshold: int = DUPLICATE_THRESHOLD
+) -> float:
+    "the chance that new_redirect_key raises DuplicateThresholdError"
+    return (used / capacity) ** (duplicate_threshold + 1)
+
+
+def _occupancy(
+    length: int,
+    used: int,
+    other: int,
+    alphabet_size: int,
+    duplicate_threshold: int,
+    max_failure_probability: float,
+) -> LengthOccupancy:
+    capacity = alphabet_size ** length
+    occupancy = used / capacity
+    # the most keys there can be before failure_probability is too high
+    max_used = math.floor(
+        capacity * max_failure_probability ** (1 / (duplicate_threshold + 1))
+    )
+    return LengthOccupancy(
+        length=length,
+        used=used,
+        other=other,
+        capacity=capacity,
+        occupancy=occupancy,
+        collision_probability=occupancy,
+        failure_probability=failure_probability(used, capacity, duplicate_threshold),
+        expected_attempts=1 / (1 - occupancy) if occupancy < 1 else None,
+        remaining=max(0, max_used - used),
+    )
+
+
+def analyze_keyspace(
+    db: Database,
+    key_length: int,
+    duplicate_threshold: int = DUPLICATE_THRESHOLD,
+    max_failure_probability: float = MAX_FAILURE_PROBABILITY,
+    alphabet: str = KEY_CHARACTERS,
+    host: str = DEFAULT_HOST,
+) -> KeyspaceReport:
+    """
+    reports the occupancy of each key length on a host, and recommends the
+    shortest key_length, no shorter than the current one, at which
+    new_redirect_key is unlikely to fail
+    """
+    if key_length < 1:
+        raise ValueError("key_length must be a positive integer")
+    if not 0 < max_failure_probability < 1:
+        raise ValueError("max_failure_probability must be between 0 and 1")
+
+    used, other = count_keys(db, alphabet=alphabet, host=host)
+
+    def occupancy(length: int) -> LengthOccupancy:
+        return _occupancy(
+            length=length,
+            used=used.get(length, 0),
+            other=other.get(length, 0),
+            alphabet_size=len(alphabet),
+            duplicate_threshold=duplicate_threshold,
+            max_failure_probability=max_failure_probability,
+        )
+
+    lengths = [occupancy(length) for length in sorted({*used, *other, key_length})]
+
+    recommended_key_length = key_length
+    # terminates, since lengths longer than any key are empty
+    while (
+        occupancy(recommended_key_length).failure_probability > max_failure_probability
+    ):
+        recommended_key_length += 1
+
+    return KeyspaceReport(
+        alphabet=alphabet,
+        total=sum(used.values()) + sum(other.values()),
+        key_length=key_length,
+        duplicate_threshold=duplicate_threshold,
+        max_failure_probability=max_failure_probability,
+        lengths=lengths,
+        recommended_key_length=recommended_key_length,
+    )
+
+
+def report_dict(report: KeyspaceReport) -> Dict[str, Any]:
+    "the report as plain data, for encoding as JSON"
+    return {
+        **report._asdict(),
+        "lengths": [length._asdict() for length in report.lengths],
+        "raise_key_length": report.raise_key_length,
+    }
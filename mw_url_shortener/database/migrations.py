@@ -0,0 +1,388 @@
+"""
+upgrades the tables of databases made by earlier versions
+
+generate_mapping(create_tables=True) makes tables and indexes that are
+missing, but never changes a table that's already there, so those changes are
+made here, before the mapping is generated
+
+the schema version is kept in the database, in SQLite's user_version, and each
+migration raises it by one, once it's done; a new database is made with the
+newest tables, so it starts at the newest version
+
+adding a column only changes the schema, so it's quick, but filling in a new
+column, or rebuilding a table to change its primary key, touches every row;
+that's done in batches, each in its own transaction, so the database is never
+locked for long, and other connections can keep using it in between
+
+every migration can be run again from the start if it's interrupted
+"""
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from pony.orm import Database, db_session
+
+from ..utils import normalize_key, uri_hash
+from .entities import get_db
+
+__all__ = [
+    "Migration",
+    "MIGRATIONS",
+    "LATEST_VERSION",
+    "BATCH_SIZE",
+    "schema_version",
+    "pending_migrations",
+    "migrate",
+]
+
+logger = logging.getLogger(__name__)
+
+# How many rows are changed in each transaction
+BATCH_SIZE = 1000
+
+
+class Migration(NamedTuple):
+    "one change to the schema"
+    version: int
+    description: str
+    apply: Callable[[Database, int], None]
+
+
+def schema_version(db: Database) -> int:
+    "the version of the schema the database has; needs a db_session"
+    return int(db.execute("PRAGMA user_version").fetchone()[0])
+
+
+def _set_schema_version(db: Database, version: int) -> None:
+    # PRAGMA statements can't take parameters
+    db.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def _tables(db: Database) -> List[str]:
+    return [
+        name
+        for name in db.select("SELECT name FROM sqlite_master WHERE type = 'table'")
+        if not name.startswith("sqlite_")
+    ]
+
+
+def _columns(db: Database, table: str) -> List[str]:
+    "the names of the columns in a table, or nothing if it doesn't exist"
+    quote = db.provider.quote_name
+    return [row[1] for row in db.execute(f"PRAGMA table_info({quote(table)})")]
+
+
+def _newest_tables() -> Dict[str, str]:
+    """
+    the CREATE TABLE statements for the tables as they're declared now, as
+    made by pony
+    """
+    newest_db = get_db()
+    newest_db.bind(provider="sqlite", filename=":memory:")
+    newest_db.generate_mapping(create_tables=True)
+    with db_session:
+        tables = dict(
+            newest_db.select("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+        )
+    newest_db.disconnect()
+    return tables
+
+
+def _add_column(db: Database, table: str, column: str, definition: str) -> None:
+    "adds a column to a table, if the table's there, and the column isn't"
+    with db_session:
+        columns = _columns(db, table)
+        if columns and column not in columns:
+            quote = db.provider.quote_name
+            db.execute(
+                f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {definition}"
+            )
+
+
+def _backfill(
+    db: Database,
+    table: str,
+    column: str,
+    source_column: str,
+    function: Callable[[str], object],
+    batch_size: int,
+) -> None:
+    "sets an empty column to function(source_column), batch_size rows at a time"
+    quote = db.provider.quote_name
+    while True:
+        with db_session:
+            if column not in _columns(db, table):
+                return
+            rows = db.select(
+                f"SELECT rowid, {quote(source_column)} FROM {quote(table)} "
+                f"WHERE {quote(column)} IS NULL LIMIT {int(batch_size)}"
+            )
+            for rowid, value in rows:
+                new_value = function(value)
+                db.execute(
+                    f"UPDATE {quote(table)} SET {quote(column)} = $new_value "
+                    "WHERE rowid = $rowid"
+                )
+        if len(rows) < batch_size:
+            return
+
+
+def _copy_batch(
+    db: Database,
+    old_table: str,
+    new_table: str,
+    columns: str,
+    values: str,
+    after_rowid: int,
+    batch_size: int,
+) -> Optional[int]:
+    """
+    copies the next batch of rows to the new table, and returns the rowid of
+    the last one, or None if there were none left
+    """
+    quote = db.provider.quote_name
+    with db_session:
+        last_rowid = db.execute(
+            f"SELECT max(rowid) FROM (SELECT rowid FROM {quote(old_table)} "
+            f"WHERE rowid > $after_rowid ORDER BY rowid LIMIT {int(batch_size)})"
+        ).fetchone()[0]
+        if last_rowid is None:
+            return None
+        # rows the triggers have already copied are newer, so they're kept
+        db.execute(
+            f"INSERT OR IGNORE INTO {quote(new_table)} ({columns}) "
+            f"SELECT {values} FROM {quote(old_table)} "
+            "WHERE rowid > $after_rowid AND rowid <= $last_rowid"
+        )
+    return int(last_rowid)
+
+
+def _rebuild_table(
+    db: Database,
+    table: str,
+    batch_size: int,
+    defaults: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    rebuilds a table as it's declared now, which is the only way to change
+    things like its primary key
+
+    the rows are copied to a new table in batches; while that happens,
+    triggers copy every change made to the old table, so nothing written in
+    the meantime is lost; the old table is then swapped for the new one in a
+    single, short transaction
+
+    columns that are new get the SQL expression in defaults, or NULL, and
+    pony makes the indexes when the mapping is generated
+    """
+    quote = db.provider.quote_name
+    defaults = defaults or {}
+    new_table = f"{table}_migrating"
+    create_new_table = _newest_tables()[table].replace(
+        f"CREATE TABLE {quote(table)}", f"CREATE TABLE {quote(new_table)}", 1
+    )
+
+    with db_session:
+        old_columns = _columns(db, table)
+        # starts again if an earlier attempt was interrupted
+        db.execute(f"DROP TABLE IF EXISTS {quote(new_table)}")
+        db.execute(create_new_table)
+        new_columns = _columns(db, new_table)
+
+        def values(row: str) -> str:
+            return ", ".join(
+                f"{row}{quote(column)}"
+                if column in old_columns
+                else defaults.get(column, "NULL")
+                for column in new_columns
+            )
+
+        columns = ", ".join(map(quote, new_columns))
+        primary_key = [
+            info[1]
+            for info in sorted(
+                db.execute(f"PRAGMA table_info({quote(new_table)})"),
+                key=lambda info: info[5],
+            )
+            if info[5] > 0
+        ]
+        matches_old_row = " AND ".join(
+            f"{quote(column)} = "
+            + (
+                f"OLD.{quote(column)}"
+                if column in old_columns
+                else defaults.get(column, "NULL")
+            )
+            for column in primary_key
+        )
+        copy_new_row = (
+            f"INSERT OR REPLACE INTO {quote(new_table)} ({columns}) "
+            f"VALUES ({values('NEW.')});"
+        )
+        delete_old_row = f"DELETE FROM {quote(new_table)} WHERE {matches_old_row};"
+        for event, body in [
+            ("INSERT", copy_new_row),
+            ("UPDATE", delete_old_row + " " + copy_new_row),
+            ("DELETE", delete_old_row),
+        ]:
+            trigger = quote(f"{new_table}_{event.lower()}")
+            db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            db.execute(
+                f"CREATE TRIGGER {trigger} AFTER {event} ON {quote(table)} "
+                f"BEGIN {body} END"
+            )
+
+    after_rowid = 0
+    copied_values = values("")
+    while True:
+        last_rowid = _copy_batch(
+            db,
+            old_table=table,
+            new_table=new_table,
+            columns=columns,
+            values=copied_values,
+            after_rowid=after_rowid,
+            batch_size=batch_size,
+        )
+        if last_rowid is None:
+            break
+        after_rowid = last_rowid
+
+    with db_session:
+        # dropping the old table drops its triggers and indexes too
+        db.execute(f"DROP TABLE {quote(table)}")
+        db.execute(f"ALTER TABLE {quote(new_table)} RENAME TO {quote(table)}")
+
+
+def _config_history(db: Database, batch_size: int) -> None:
+    "settings were kept in one row, and now every saved version is kept"
+    tables = _newest_tables()
+    with db_session:
+        columns = _columns(db, "ConfigEntity")
+        if not columns or "created" in columns:
+            return
+        saved = db.select(
+            "SELECT class_name, json FROM \"ConfigEntity\" WHERE version = 'current'"
+        )
+        db.execute('DROP TABLE "ConfigEntity"')
+        db.execute(tables["ConfigEntity"])
+        db.execute(
+            tables["CurrentConfigEntity"].replace("TABLE", "TABLE IF NOT EXISTS", 1)
+        )
+        created = str(datetime.utcnow())
+        for class_name, json in saved:
+            version = db.insert(
+                "ConfigEntity",
+                class_name=class_name,
+                json=json,
+                created=created,
+                returning="version",
+            )
+            db.execute(
+                'INSERT OR REPLACE INTO "CurrentConfigEntity" (name, version) '
+                "VALUES ('current', $version)"
+            )
+
+
+def _normalized_keys(db: Database, batch_size: int) -> None:
+    "variants of keys are found through normalized_key"
+    _add_column(db, "RedirectEntity", "normalized_key", "TEXT")
+    _backfill(db, "RedirectEntity", "normalized_key", "key", normalize_key, batch_size)
+
+
+def _uri_hashes(db: Database, batch_size: int) -> None:
+    "redirects to a uri are found through uri_hash"
+    _add_column(db, "RedirectEntity", "uri_hash", "BIGINT")
+    # only uris stored in the redirect table can be missing their hash
+    _backfill(db, "RedirectEntity", "uri_hash", "uri", uri_hash, batch_size)
+
+
+def _long_uris(db: Database, batch_size: int) -> None:
+    """
+    long uris can be stored in LongUriEntity, which pony makes; moving the
+    ones already in the redirect table is left to the compress-uris
+    subcommand
+    """
+    _add_column(db, "RedirectEntity", "long_uri_id", "INTEGER")
+
+
+def _expiry(db: Database, batch_size: int) -> None:
+    "redirects can expire"
+    _add_column(db, "RedirectEntity", "expires_at", "DATETIME")
+
+
+def _owners(db: Database, batch_size: int) -> None:
+    "redirects can have an owner, who can have a quota"
+    _add_column(
+        db,
+        "RedirectEntity",
+        "owner",
+        'TEXT REFERENCES "UserEntity" ("username") ON DELETE SET NULL',
+    )
+    _add_column(db, "UserEntity", "redirect_quota", "INTEGER")
+
+
+def _hosts(db: Database, batch_size: int) -> None:
+    "the primary key of redirects is (host, key), instead of just key"
+    with db_session:
+        columns = _columns(db, "RedirectEntity")
+    if columns and "host" not in columns:
+        # DEFAULT_HOST, as it was when hosts were added
+        _rebuild_table(db, "RedirectEntity", batch_size, defaults={"host": "'*'"})
+
+
+MIGRATIONS = [
+    Migration(1, "keep a history of saved settings", _config_history),
+    Migration(2, "add normalized keys", _normalized_keys),
+    Migration(3, "add uri hashes", _uri_hashes),
+    Migration(4, "store long uris separately", _long_uris),
+    Migration(5, "add expiry times", _expiry),
+    Migration(6, "add owners and quotas", _owners),
+    Migration(7, "make (host, key) the primary key of redirects", _hosts),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def pending_migrations(db: Database) -> List[Migration]:
+    """
+    the migrations a database still needs; a database without any tables
+    doesn't need any
+    """
+    with db_session:
+        if not _tables(db):
+            return []
+        version = schema_version(db)
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def migrate(db: Database, batch_size: int = BATCH_SIZE) -> List[Migration]:
+    """
+    brings the tables of a bound database up to date, before the mapping is
+    generated, and returns the migrations that were applied
+
+    a database without any tables is only marked as up to date, since
+    generating the mapping makes the newest tables
+    """
+    with db_session:
+        if not _tables(db):
+            _set_schema_version(db, LATEST_VERSION)
+            return []
+        version = schema_version(db)
+    if version > LATEST_VERSION:
+        raise ValueError(
+            f"the database schema is version {version}, which is newer than "
+            f"this version of mw_url_shortener understands ({LATEST_VERSION})"
+        )
+
+    applied = []
+    for migration in pending_migrations(db):
+        logger.info(
+            "migrating database to version %d: %s",
+            migration.version,
+            migration.description,
+        )
+        migration.apply(db, batch_size)
+        with db_session:
+            _set_schema_version(db, migration.version)
+        applied.append(migration)
+    return applied
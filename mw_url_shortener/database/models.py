@@ -1,8 +1,16 @@
-print(f"imported mw_url_shortener.database.models as {__name__}")
-from pydantic import AnyUrl, BaseModel, Field
+from datetime import datetime, timezone
+from typing import List, Optional
 
-from ..types import HashedPassword, Key, Uri, Username
-from ..utils import orjson_dumps, orjson_loads, unsafe_random_chars
+from pydantic import AnyUrl, BaseModel, Field, validator
+
+from ..types import ChangeOperation, HashedPassword, Key, Uri, Username
+from ..utils import (
+    DEFAULT_HOST,
+    normalize_host,
+    orjson_dumps,
+    orjson_loads,
+    unsafe_random_chars,
+)
 
 
 def key_factory() -> Key:
@@ -14,10 +22,29 @@ def key_factory() -> Key:
 
 
 class RedirectModel(BaseModel):
+    # the domain the redirect is served on
+    host: str = DEFAULT_HOST
     key: Key = Field(default_factory=key_factory)
     # NOTE:BUG should use pydantic.AnyUrl, or modify it to include data URIs
     # https://pydantic-docs.helpmanual.io/usage/types/#urls
     uri: Uri
+    # after this time, in UTC, the redirect is treated as if it doesn't exist
+    expires_at: Optional[datetime] = None
+    owner: Optional[Username] = None
+
+    @validator("host")
+    def normalized_host(cls, value: str) -> str:
+        "hosts are stored the way Host headers are compared"
+        if value == DEFAULT_HOST:
+            return value
+        return normalize_host(value)
+
+    @validator("expires_at")
+    def naive_utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        "the database stores naive datetimes, in UTC"
+        if value is None or value.tzinfo is None:
+            return value
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
 
     class Config:
         orm_mode = True
@@ -29,9 +56,63 @@ class RedirectModel(BaseModel):
         allow_mutation = False
 
 
+class NewRedirectModel(RedirectModel):
+    "a redirect to make, which is given a new key if it doesn't have one"
+    key: Optional[Key] = None
+
+
+class BulkResultModel(BaseModel):
+    "what happened to one of the redirects in a bulk create"
+    # 200 if the redirect was made, or the status creating it alone would
+    # have had
+    status: int
+    redirect: Optional[RedirectModel] = None
+    detail: Optional[str] = None
+
+    class Config:
+        json_loads = orjson_loads
+        json_dumps = orjson_dumps
+        allow_mutation = False
+
+
+class RedirectChangeModel(BaseModel):
+    "one entry in the change log"
+    # a cache that has applied this change can ask for the ones after it
+    sequence: int
+    operation: ChangeOperation
+    host: str
+    key: Key
+    # the redirect after the change; None for deletes
+    uri: Optional[Uri] = None
+    expires_at: Optional[datetime] = None
+    # when the change was made, in UTC
+    created: datetime
+
+    class Config:
+        orm_mode = True
+        json_loads = orjson_loads
+        json_dumps = orjson_dumps
+        allow_mutation = False
+
+
+class RedirectSnapshotModel(BaseModel):
+    "one page of every current redirect, for a new cache to start from"
+    # the newest change made before the page was read; a cache that has the
+    # whole snapshot follows the change log from the first page's sequence
+    sequence: int
+    redirects: List[RedirectModel]
+
+    class Config:
+        json_loads = orjson_loads
+        json_dumps = orjson_dumps
+        allow_mutation = False
+
+
 class UserModel(BaseModel):
     username: Username
     hashed_password: HashedPassword
+    # how many unexpired redirects the user can own; None means no limit
+    redirect_quota: Optional[int] = None
 
     class Config:
         orm_mode = True
@@ -1,4 +1,3 @@
-print(f"imported mw_url_shortener.database.redirect as {__name__}")
 """
 This file exists purely to export an organized namespace
 """
@@ -8,11 +7,22 @@ from .errors import (
     DuplicateKeyError,
     DuplicateThresholdError,
     RedirectNotFoundError,
+    RedirectQuotaError,
 )
+from .interface import count_redirects as count
 from .interface import create_redirect as create
+from .interface import create_redirects as create_many
+from .interface import delete_expired_redirects as delete_expired
 from .interface import delete_redirect as delete
+from .interface import find_by_uri
 from .interface import get_redirect as get
+from .interface import last_change_sequence as last_change
+from .interface import list_changes as changes
 from .interface import list_redirects as list
 from .interface import new_redirect_key as new_key
 from .interface import update_redirect as update
+from .models import BulkResultModel as BulkResult
+from .models import NewRedirectModel as NewModel
+from .models import RedirectChangeModel as ChangeModel
 from .models import RedirectModel as Model
+from .models import RedirectSnapshotModel as SnapshotModel
@@ -0,0 +1,165 @@
+"""
+keeps long uris out of the redirect table
+
+most uris are short, and are stored in RedirectEntity.uri, but some are
+multi-kilobyte tracking URLs or data URIs, which would make the rows every
+lookup reads spill onto overflow pages
+
+uris longer than LONG_URI_THRESHOLD bytes are stored in LongUriEntity instead,
+compressed with zlib, using the newest preset dictionary trained on the uris
+already in the database; if compressing doesn't make a uri smaller, it's
+stored as it is
+
+all of these need a db_session
+"""
+import re
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+from pony.orm import Database, select
+from pony.orm.core import Entity
+
+from ..types import Key, Uri
+from ..utils import uri_hash
+from .models import RedirectModel
+
+# Uris longer than this many bytes are stored in LongUriEntity
+LONG_URI_THRESHOLD = 512
+
+# zlib only uses the last 32KiB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+
+# Hosts, path segments, and query parameters, with the character after them
+URI_PIECE_RE = re.compile(r"[^/?&=#;]+[/?&=#;]?")
+
+# Dictionaries are never changed once they're saved, so they're cached forever
+_dictionaries: "WeakKeyDictionary[Database, Dict[int, bytes]]" = WeakKeyDictionary()
+
+
+def train_dictionary(uris: Iterable[str], size: int = DICTIONARY_SIZE) -> bytes:
+    """
+    makes a zlib preset dictionary from the pieces uris have in common
+
+    each piece is scored by how many uris it's in, times its length, and only
+    pieces in more than one uri are used; zlib finds matches near the end of
+    the dictionary more cheaply, so the best pieces go last
+    """
+    counts: Counter = Counter()
+    for uri in uris:
+        counts.update({piece for piece in URI_PIECE_RE.findall(uri) if len(piece) > 2})
+
+    chosen = []
+    total_size = 0
+    for piece, count in sorted(
+        counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True
+    ):
+        if count < 2:
+            continue
+        encoded_piece = piece.encode("utf-8")
+        if total_size + len(encoded_piece) > size:
+            continue
+        chosen.append(encoded_piece)
+        total_size += len(encoded_piece)
+    return b"".join(reversed(chosen))
+
+
+def _dictionary(db: Database, dictionary_id: int) -> bytes:
+    cache = _dictionaries.setdefault(db, {})
+    if dictionary_id not in cache:
+        cache[dictionary_id] = db.UriDictionaryEntity[dictionary_id].data
+    return cache[dictionary_id]
+
+
+def current_dictionary_id(db: Database) -> Optional[int]:
+    "the newest preset dictionary, if one has been trained"
+    return select(dictionary.id for dictionary in db.UriDictionaryEntity).max()
+
+
+def _pack(db: Database, uri: str) -> Tuple[bytes, bool, Optional[int]]:
+    "compresses a uri, if that makes it smaller"
+    raw_uri = uri.encode("utf-8")
+    dictionary_id = current_dictionary_id(db)
+    if dictionary_id is None:
+        compressor = zlib.compressobj(level=9)
+    else:
+        compressor = zlib.compressobj(level=9, zdict=_dictionary(db, dictionary_id))
+    data = compressor.compress(raw_uri) + compressor.flush()
+    if len(data) >= len(raw_uri):
+        return raw_uri, False, None
+    return data, True, dictionary_id
+
+
+def is_long_uri(uri: str) -> bool:
+    "whether a uri is long enough to be stored in LongUriEntity"
+    return len(uri.encode("utf-8")) > LONG_URI_THRESHOLD
+
+
+# The same test, for the uri column of a RedirectEntity named redirect in a
+# query; SQLite's length() counts characters, unless it's given bytes
+LONG_URI_SQL = f'length(CAST("redirect"."uri" AS BLOB)) > {LONG_URI_THRESHOLD}'
+
+
+def uri_columns(db: Database, uri: str) -> Dict[str, Any]:
+    """
+    the RedirectEntity attributes to store a uri with, storing it in a
+    LongUriEntity if it's long
+    """
+    if not is_long_uri(uri):
+        return {"uri": uri, "long_uri_id": None}
+
+    data, compressed, dictionary_id = _pack(db, uri)
+    long_uri = db.LongUriEntity(
+        data=data, compressed=compressed, dictionary_id=dictionary_id
+    )
+    db.flush()
+    return {"uri": "", "long_uri_id": long_uri.id, "uri_hash": uri_hash(uri)}
+
+
+def load_uri(db: Database, redirect: Entity) -> Uri:
+    "a redirect's uri, wherever it's stored"
+    if redirect.long_uri_id is None:
+        return Uri(redirect.uri)
+
+    long_uri = db.LongUriEntity[redirect.long_uri_id]
+    return unpack_uri(db, long_uri.data, long_uri.compressed, long_uri.dictionary_id)
+
+
+def unpack_uri(
+    db: Database, data: bytes, compressed: bool, dictionary_id: Optional[int]
+) -> Uri:
+    "the uri stored in the columns of a LongUriEntity"
+    if not compressed:
+        return Uri(data.decode("utf-8"))
+    if dictionary_id is None:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = zlib.decompressobj(zdict=_dictionary(db, dictionary_id))
+    raw_uri = decompressor.decompress(data) + decompressor.flush()
+    return Uri(raw_uri.decode("utf-8"))
+
+
+def set_uri(db: Database, redirect: Entity, uri: str) -> None:
+    "changes the uri of a redirect"
+    old_long_uri_id = redirect.long_uri_id
+    redirect.set(**uri_columns(db, uri))
+    if old_long_uri_id is not None:
+        db.LongUriEntity[old_long_uri_id].delete()
+
+
+def delete_uri(db: Database, redirect: Entity) -> None:
+    "removes a redirect's long uri, if it has one, before it's deleted"
+    if redirect.long_uri_id is not None:
+        db.LongUriEntity[redirect.long_uri_id].delete()
+
+
+def to_model(db: Database, redirect: Entity) -> RedirectModel:
+    "builds a RedirectModel, with the full uri"
+    return RedirectModel(
+        host=redirect.host,
+        key=Key(redirect.key),
+        uri=load_uri(db, redirect),
+        expires_at=redirect.expires_at,
+        owner=redirect.owner.username if redirect.owner else None,
+    )
@@ -1,4 +1,3 @@
-print(f"imported mw_url_shortener.database.user as {__name__}")
 """
 This file exists purely to export an organized namespace
 """
@@ -0,0 +1,350 @@
+"""
+a load generator for finding where the redirect server saturates
+
+it starts a local server with the server subcommand, then drives it with an
+asyncio HTTP/1.1 client (one keep-alive connection per simulated client),
+requesting keys following a Zipf distribution, so that a few keys are very
+popular and most are rarely requested, like real short links
+
+the concurrency is raised step by step, and for each step the latency
+percentiles and throughput are reported
+"""
+import asyncio
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+from argparse import Namespace
+from itertools import accumulate
+from pathlib import Path
+from time import perf_counter, sleep
+from typing import IO, Callable, List, NamedTuple, Optional, Sequence, Set
+from urllib.parse import quote
+
+from .types import Key, SPath, Uri
+from .utils import safe_key_chars, safe_keys, unsafe_random_chars
+
+# Latency is measured per request, so the client's own overhead (choosing a
+# key, formatting the request) is kept out of the loop by sampling keys ahead
+SAMPLE_SIZE = 100_000
+
+
+class LevelResult(NamedTuple):
+    "what was measured at one concurrency level"
+    concurrency: int
+    requests: int
+    errors: int
+    duration: float
+    throughput: float
+    p50: float
+    p99: float
+    p999: float
+
+
+def zipf_sampler(keys: Sequence[Key], s: float) -> Callable[[int], List[Key]]:
+    """
+    returns a function that draws a number of keys, where the key at rank k
+    (counting from 1) is drawn with probability proportional to 1 / k**s
+    """
+    if not keys:
+        raise ValueError("need at least one key")
+    if s <= 0:
+        raise ValueError("the Zipf exponent must be positive")
+    ranked = list(keys)
+    random.shuffle(ranked)
+    cum_weights = list(accumulate(1 / rank ** s for rank in range(1, len(ranked) + 1)))
+
+    def sample(number: int) -> List[Key]:
+        return random.choices(ranked, cum_weights=cum_weights, k=number)
+
+    return sample
+
+
+def percentile(ordered: Sequence[float], fraction: float) -> float:
+    "nearest-rank percentile of an already-sorted sequence"
+    if not ordered:
+        return float("nan")
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def http_get(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str
+) -> int:
+    "sends one GET request over a keep-alive connection and returns the status"
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("server closed the connection")
+    status = int(status_line.split(b" ", 2)[1])
+
+    content_length = 0
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            content_length = int(value.strip())
+        elif name == b"transfer-encoding":
+            chunked = b"chunked" in value.lower()
+
+    if chunked:
+        while True:
+            chunk_size = int((await reader.readline()).split(b";")[0], 16)
+            # each chunk, including the final empty one, ends with a CRLF
+            await reader.readexactly(chunk_size + 2)
+            if chunk_size == 0:
+                break
+    elif content_length:
+        await reader.readexactly(content_length)
+    return status
+
+
+async def run_level(
+    host: str,
+    port: int,
+    keys: Sequence[Key],
+    concurrency: int,
+    duration: float,
+    expected_status: int = 307,
+) -> LevelResult:
+    "runs concurrency clients against the server for duration seconds"
+    # keys can have any characters, but a request line is ASCII
+    paths = [f"/{quote(key)}" for key in keys]
+    latencies: List[float] = []
+    errors = 0
+    started = perf_counter()
+    deadline = started + duration
+
+    async def client(offset: int) -> None:
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+        index = offset
+        try:
+            while perf_counter() < deadline:
+                path = paths[index % len(paths)]
+                index += concurrency
+                start = perf_counter()
+                try:
+                    status = await http_get(reader, writer, host, path)
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    errors += 1
+                    writer.close()
+                    reader, writer = await asyncio.open_connection(host, port)
+                    continue
+                latencies.append(perf_counter() - start)
+                if status != expected_status:
+                    errors += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client(offset) for offset in range(concurrency)))
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+    return LevelResult(
+        concurrency=concurrency,
+        requests=len(latencies),
+        errors=errors,
+        duration=elapsed,
+        throughput=len(latencies) / elapsed,
+        p50=percentile(latencies, 0.50),
+        p99=percentile(latencies, 0.99),
+        p999=percentile(latencies, 0.999),
+    )
+
+
+def populate_database(filename: SPath, number: int, key_length: int = 6) -> List[Key]:
+    "creates a database with a number of random redirects, in one transaction"
+    # NOTE: import here so the database isn't set up when this module is
+    # imported
+    from .database import get_db
+    from .database.interface import session, setup_db
+
+    db = setup_db(db=get_db(), filename=filename, create_tables=True)
+    unique_keys: Set[str] = set()
+    while len(unique_keys) < number:
+        unique_keys.update(safe_keys(key_length, number - len(unique_keys)))
+    keys = [Key(key) for key in unique_keys]
+    with session():
+        for key in keys:
+            db.RedirectEntity(
+                key=key, uri=Uri(f"https://example.com/{unsafe_random_chars(20)}")
+            )
+    db.disconnect()
+    return keys
+
+
+def existing_keys(filename: SPath) -> List[Key]:
+    """
+    reads the keys of every redirect in an existing database, without changing
+    its tables
+    """
+    from .database import get_db
+    from .database.interface import list_redirects, setup_db
+
+    db = setup_db(db=get_db(), filename=filename, create_tables=False, migrate=False)
+    keys = [redirect.key for redirect in list_redirects(db=db)]
+    db.disconnect()
+    return keys
+
+
+def free_port(host: str) -> int:
+    "asks the operating system for an unused port"
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return int(sock.getsockname()[1])
+
+
+# How much of the end of the server's output is shown when it fails to start
+SERVER_OUTPUT_TAIL = 4_000
+
+
+def start_server(
+    database_file: Path, host: str, port: int, stderr: Optional[IO[bytes]] = None
+) -> "subprocess.Popen[bytes]":
+    """
+    starts the server subcommand in a separate process
+
+    its errors are written to stderr, if it's given; this should be a file,
+    since a pipe that isn't read would stop the server once it's full
+    """
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            str(database_file),
+            "server",
+            "--api-key",
+            safe_key_chars(10),
+            "--host",
+            host,
+            "--port",
+            str(port),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=stderr or subprocess.DEVNULL,
+    )
+
+
+def _server_output(stderr: Optional[IO[bytes]]) -> str:
+    "the end of what the server has written to stderr, if it was kept"
+    if stderr is None:
+        return ""
+    stderr.flush()
+    stderr.seek(0)
+    output = stderr.read()[-SERVER_OUTPUT_TAIL:].decode("utf-8", errors="replace")
+    return f"; the server wrote:\n{output}" if output.strip() else ""
+
+
+def wait_for_server(
+    host: str,
+    port: int,
+    timeout: float = 30.0,
+    server: "Optional[subprocess.Popen[bytes]]" = None,
+    stderr: Optional[IO[bytes]] = None,
+) -> None:
+    """
+    waits until the server accepts connections
+
+    if the server process is given, this stops waiting as soon as it exits;
+    either way, the errors include what it wrote to stderr, if that was kept
+    """
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(
+                f"server exited with status {server.returncode} before "
+                f"listening on {host}:{port}{_server_output(stderr)}"
+            )
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError(
+        f"server did not start listening on {host}:{port}{_server_output(stderr)}"
+    )
+
+
+def format_result(result: LevelResult) -> str:
+    "one line of the report"
+    return (
+        f"{result.concurrency:>11} {result.requests:>9} {result.errors:>7} "
+        f"{result.throughput:>12.1f} {result.p50 * 1000:>9.2f} "
+        f"{result.p99 * 1000:>9.2f} {result.p999 * 1000:>9.2f}"
+    )
+
+
+REPORT_HEADER = (
+    f"{'concurrency':>11} {'requests':>9} {'errors':>7} {'requests/s':>12} "
+    f"{'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}"
+)
+
+
+def saturation_point(results: Sequence[LevelResult]) -> Optional[LevelResult]:
+    """
+    the lowest concurrency level reaching at least 95% of the best throughput;
+    raising the concurrency beyond it only adds latency
+    """
+    if not results:
+        return None
+    best = max(result.throughput for result in results)
+    return next(result for result in results if result.throughput >= 0.95 * best)
+
+
+def loadtest_run(args: Namespace) -> List[LevelResult]:
+    "the loadtest subcommand"
+    host: str = args.host
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_file: Optional[Path] = getattr(args, "database_file", None)
+        if database_file:
+            keys = existing_keys(database_file)
+        else:
+            database_file = Path(temp_dir) / "loadtest.sqlitedb"
+            keys = populate_database(database_file, args.redirects)
+        if not keys:
+            sys.exit("the database has no redirects to request")
+
+        sample = zipf_sampler(keys, args.zipf)(SAMPLE_SIZE)
+        port = args.port or free_port(host)
+        server_log = tempfile.TemporaryFile(dir=temp_dir)
+        server = start_server(database_file, host, port, stderr=server_log)
+        results: List[LevelResult] = []
+        loop = asyncio.new_event_loop()
+        try:
+            wait_for_server(host, port, server=server, stderr=server_log)
+            print(
+                f"{len(keys)} redirects, Zipf s={args.zipf}, "
+                f"{args.duration}s per level\n"
+            )
+            print(REPORT_HEADER)
+            for concurrency in concurrency_levels:
+                result = loop.run_until_complete(
+                    run_level(host, port, sample, concurrency, args.duration)
+                )
+                results.append(result)
+                print(format_result(result), flush=True)
+        finally:
+            loop.close()
+            server.terminate()
+            server.wait()
+            server_log.close()
+
+    saturated = saturation_point(results)
+    if saturated is not None:
+        print(
+            f"\nsaturates at concurrency {saturated.concurrency}: "
+            f"{saturated.throughput:.1f} requests/s, "
+            f"p99 {saturated.p99 * 1000:.2f} ms"
+        )
+    return results
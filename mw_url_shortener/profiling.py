@@ -0,0 +1,303 @@
+"""
+opt-in profiling hooks for the database interface and the request handlers
+
+nothing is recorded until enable() is called with one or more sinks; until
+then, a profiled function costs one extra function call and a truthiness check
+
+each profiled call produces a ProfileRecord with:
+- the wall time of the call
+- the number of SQL statements pony executed during the call
+- the number of rows SQLite reports as inserted, updated, or deleted
+
+a sampled fraction of the outermost calls (usually a request handler) are
+additionally run under cProfile, and the report is attached to the record
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+from typing import (
+    Callable,
+    Deque,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import orjson
+from pony.orm import Database
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python 3.6
+    ContextVar = None  # type: ignore
+
+__all__ = [
+    "ProfileRecord",
+    "Sink",
+    "LogSink",
+    "RingBufferSink",
+    "FileSink",
+    "enable",
+    "disable",
+    "profiled",
+    "profile_block",
+]
+
+Func = TypeVar("Func", bound=Callable)
+
+
+class ProfileRecord(NamedTuple):
+    "what was measured for one profiled call"
+    name: str
+    wall_time: float
+    statements: int
+    rows_changed: int
+    report: Optional[str] = None
+
+
+class Sink:
+    "receives every ProfileRecord"
+
+    def record(self, profile_record: ProfileRecord) -> None:
+        raise NotImplementedError
+
+
+class LogSink(Sink):
+    "writes each record to a logger"
+
+    def __init__(
+        self, logger: Optional[logging.Logger] = None, level: int = logging.INFO
+    ) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def record(self, profile_record: ProfileRecord) -> None:
+        self.logger.log(
+            self.level,
+            "%s took %.6fs, %d statements, %d rows changed",
+            profile_record.name,
+            profile_record.wall_time,
+            profile_record.statements,
+            profile_record.rows_changed,
+        )
+        if profile_record.report:
+            self.logger.log(self.level, "%s", profile_record.report)
+
+
+class RingBufferSink(Sink):
+    "keeps the most recent records in memory"
+
+    def __init__(self, maxlen: int = 1024) -> None:
+        self._records: Deque[ProfileRecord] = deque(maxlen=maxlen)
+
+    def record(self, profile_record: ProfileRecord) -> None:
+        # deque.append is atomic, so no lock is needed
+        self._records.append(profile_record)
+
+    def records(self) -> List[ProfileRecord]:
+        "a snapshot of the buffered records, oldest first"
+        return list(self._records)
+
+    def clear(self) -> None:
+        self._records.clear()
+
+
+class FileSink(Sink):
+    "appends each record to a file, as a line of JSON"
+
+    def __init__(self, filename: Union[str, Path]) -> None:
+        self.path = Path(filename).resolve()
+        self._lock = threading.Lock()
+
+    def record(self, profile_record: ProfileRecord) -> None:
+        line = orjson.dumps(profile_record._asdict()) + b"\n"
+        with self._lock:
+            with self.path.open(mode="ab") as file:
+                file.write(line)
+
+
+_sinks: Tuple[Sink, ...] = ()
+_sample_rate: float = 0.0
+# only one cProfile.Profile can be collecting at a time
+_cprofile_lock = threading.Lock()
+
+
+class _ThreadStack(threading.local):
+    "the part of ContextVar used here, per thread, for Python 3.6"
+    value: Optional[List[List[int]]] = None
+
+    def get(self) -> Optional[List[List[int]]]:
+        return self.value
+
+    def set(self, value: Optional[List[List[int]]]) -> Optional[List[List[int]]]:
+        previous, self.value = self.value, value
+        return previous
+
+    def reset(self, previous: Optional[List[List[int]]]) -> None:
+        self.value = previous
+
+
+# the totals of the profiled calls being made; a context variable instead of a
+# thread local, where there is one, so that coroutines sharing an event loop
+# each have their own
+_stack = ContextVar("_stack", default=None) if ContextVar else _ThreadStack()
+
+
+def enable(*sinks: Sink, sample_rate: float = 0.0) -> None:
+    """
+    starts sending records to the sinks
+
+    sample_rate is the fraction of outermost calls to run under cProfile
+    """
+    global _sinks, _sample_rate
+    if not sinks:
+        raise ValueError("need at least one sink")
+    if not 0.0 <= sample_rate <= 1.0:
+        raise ValueError("sample_rate must be between 0 and 1")
+    _sample_rate = sample_rate
+    _sinks = tuple(sinks)
+
+
+def disable() -> None:
+    "stops all recording"
+    global _sinks, _sample_rate
+    _sinks = ()
+    _sample_rate = 0.0
+
+
+def _counters(db: Optional[Database]) -> Optional[Tuple[int, int]]:
+    "the number of statements executed and rows changed so far in this thread"
+    if db is None:
+        return None
+    total_stat = db.local_stats.get(None)
+    statements = total_stat.db_count if total_stat is not None else 0
+    # NOTE:FEATURE::DATABASE Currently, only a SQLite database is supported
+    connection = getattr(db.provider.pool, "con", None)
+    rows = connection.total_changes if connection is not None else 0
+    return statements, rows
+
+
+def _report(profile: cProfile.Profile) -> str:
+    "formats the 25 most expensive functions by cumulative time"
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(25)
+    return stream.getvalue()
+
+
+@contextmanager
+def profile_block(
+    name: str, db: Optional[Database] = None, sample: bool = True
+) -> Iterator[None]:
+    """
+    profiles the with block
+
+    if db is not given, the statements and rows of profiled calls nested in
+    the block are summed instead
+
+    sample=False keeps the block from being run under cProfile, which would
+    also profile whatever else runs in the thread while the block is waiting
+    """
+    sinks = _sinks
+    if not sinks:
+        yield None
+        return
+
+    stack = _stack.get()
+    outermost = stack is None
+    if stack is None:
+        stack = []
+        token = _stack.set(stack)
+    profile: Optional[cProfile.Profile] = None
+    if (
+        sample
+        and not stack
+        and _sample_rate
+        and random.random() < _sample_rate
+        and _cprofile_lock.acquire(blocking=False)
+    ):
+        profile = cProfile.Profile()
+
+    # accumulates the statements and rows of nested calls
+    stack.append([0, 0])
+    before = _counters(db)
+    start = perf_counter()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield None
+    finally:
+        if profile is not None:
+            profile.disable()
+            _cprofile_lock.release()
+        wall_time = perf_counter() - start
+        nested = stack.pop()
+        if outermost:
+            _stack.reset(token)
+        after = _counters(db)
+        if before is not None and after is not None:
+            statements, rows = after[0] - before[0], after[1] - before[1]
+        else:
+            statements, rows = nested
+        if stack:
+            stack[-1][0] += statements
+            stack[-1][1] += rows
+
+        profile_record = ProfileRecord(
+            name=name,
+            wall_time=wall_time,
+            statements=statements,
+            rows_changed=rows,
+            report=_report(profile) if profile is not None else None,
+        )
+        for sink in sinks:
+            sink.record(profile_record)
+
+
+def profiled(func: Func) -> Func:
+    """
+    decorator that profiles each call, when profiling is enabled
+
+    the database is taken from the db argument, if there is one
+
+    the wrapper keeps the signature of the wrapped function, so FastAPI
+    dependencies declared on it still work, and coroutine functions stay
+    coroutine functions; they're never sampled with cProfile
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    if asyncio.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):  # type: ignore
+            if not _sinks:
+                return await func(*args, **kwargs)
+            with profile_block(name, sample=False):
+                return await func(*args, **kwargs)
+
+        return async_wrapper  # type: ignore
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):  # type: ignore
+        if not _sinks:
+            return func(*args, **kwargs)
+
+        db = kwargs.get("db")
+        if not isinstance(db, Database):
+            db = next((arg for arg in args if isinstance(arg, Database)), None)
+        with profile_block(name, db=db):
+            return func(*args, **kwargs)
+
+    return wrapper  # type: ignore
@@ -1,33 +1,418 @@
-print(f"imported mw_url_shortener.server as {__name__}")
 """
 Primarily uses https://fastapi.tiangolo.com/tutorial/
 """
-from typing import Union
+import asyncio
+import logging
+import signal
+from functools import lru_cache, partial
+from time import perf_counter
+from typing import FrozenSet, Optional
 
-from fastapi import APIRouter, Depends, FastAPI, HTTPException, status
-from starlette.responses import RedirectResponse, Response
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, status
+from pony.orm import Database
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import RedirectResponse
 
-from . import Key
-from .database.interface import get_redirect
+from .database.backup import backup_database
+from .database.config import get_config
+from .database.errors import BadConfigInDBError, RedirectNotFoundError
+from .database.integrity import check_database_file
+from .database.interface import delete_expired_redirects, get_redirect
+from .database.models import RedirectModel
+from .metrics import COALESCED_LOOKUPS, REDIRECT_REQUESTS, REDIRECT_SECONDS
+from .profiling import profiled
+from .settings import CommonSettings, ServerSettings
+from .types import IntegrityCheck, Key, KeyNormalization
+from .utils import DEFAULT_HOST, SingleFlight, normalize_host
 
-ResponseOrException = Union[Response, HTTPException]
+logger = logging.getLogger(__name__)
 
+# These are used when the server starts, and changing them in the database
+# has no effect until it's restarted
+RESTART_REQUIRED = (
+    "database_file",
+    "api_key",
+    "root_path",
+    "host",
+    "port",
+    "reload",
+    "metrics_port",
+    "integrity_check",
+    "read_only",
+    "settings_poll_interval",
+    "expiry_sweep_interval",
+    "integrity_check_interval",
+    "backup_interval",
+    "backup_directory",
+    "backup_keep",
+    "profile",
+    "profile_file",
+)
+
+# How many different Host headers have their domain remembered
+HOST_CACHE_SIZE = 1024
 
 app_router = APIRouter()
 
+# Concurrent lookups of the same redirect share one database query
+_redirect_lookups: SingleFlight[RedirectModel] = SingleFlight()
+
+
+def get_settings(request: Request) -> ServerSettings:
+    """
+    the settings currently in use
+
+    handlers should read the settings once per request, through this, so that
+    a request sees one consistent set of settings even if they're swapped
+    while it's being handled
+    """
+    return request.app.state.settings
+
+
+def get_app_db(request: Request) -> Database:
+    "the database the app was started with"
+    return request.app.state.db
+
+
+def _served_domains(app: FastAPI, settings: ServerSettings) -> FrozenSet[str]:
+    "the domains in settings, built once each time the settings are swapped"
+    served_domains = getattr(app.state, "served_domains", None)
+    if served_domains is None or served_domains[0] is not settings:
+        served_domains = (settings, frozenset(settings.domains))
+        app.state.served_domains = served_domains
+    return served_domains[1]
+
+
+@lru_cache(maxsize=HOST_CACHE_SIZE)
+def _resolve_host(host_header: str, domains: FrozenSet[str]) -> Optional[str]:
+    "the served domain a Host header is for, if it's one of them"
+    host = normalize_host(host_header)
+    return host if host in domains else None
+
+
+def get_host(request: Request, settings: ServerSettings = Depends(get_settings)) -> str:
+    """
+    the host whose redirects a request is for
+
+    requests for a domain that isn't served are rejected here, without
+    touching the database
+    """
+    if not settings.domains:
+        return DEFAULT_HOST
+    host = _resolve_host(
+        request.headers.get("host", ""), _served_domains(request.app, settings)
+    )
+    if host is None:
+        REDIRECT_REQUESTS.inc(str(status.HTTP_404_NOT_FOUND))
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown host",
+        )
+    return host
+
+
+def lookup_redirect(
+    db: Database, key: Key, normalization: KeyNormalization, host: str
+) -> RedirectModel:
+    """
+    get_redirect, with concurrent lookups of the same key sharing one query,
+    and its result, including RedirectNotFoundError
+
+    a newly shared link can get hundreds of requests at once, before any of
+    them has finished; without this, each would open its own db_session
+    """
+    redirect, shared = _redirect_lookups.do(
+        (id(db), host, key, normalization),
+        partial(
+            get_redirect,
+            db=db,
+            key=key,
+            normalization=normalization,
+            host=host,
+            # redirects made before the server had domains are on DEFAULT_HOST
+            fallback_host=DEFAULT_HOST,
+        ),
+    )
+    if shared:
+        COALESCED_LOOKUPS.inc()
+    return redirect
+
 
 @app_router.get("/{key:path}")
-def redirect(key: Key) -> ResponseOrException:
-    "returns a 30x redirect or 4xx error based on the given key"
+@profiled
+def redirect(
+    key: Key,
+    request: Request,
+    settings: ServerSettings = Depends(get_settings),
+    host: str = Depends(get_host),
+) -> RedirectResponse:
+    "returns a 30x redirect or 4xx error based on the given host and key"
+    start = perf_counter()
     try:
-        redirect = get_redirect(key)
-    except KeyError as err:
-        return HTTPException(
+        redirect = lookup_redirect(
+            db=request.app.state.db,
+            key=key,
+            normalization=settings.key_normalization,
+            host=host,
+        )
+    except RedirectNotFoundError as err:
+        REDIRECT_REQUESTS.inc(str(status.HTTP_404_NOT_FOUND))
+        raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No redirect found",
+        ) from err
+    finally:
+        REDIRECT_SECONDS.observe(perf_counter() - start)
+
+    response = RedirectResponse(url=redirect.uri)
+    REDIRECT_REQUESTS.inc(str(response.status_code))
+    return response
+
+
+def _saved_settings(app: FastAPI) -> Optional[CommonSettings]:
+    "the settings saved in the database, if there are any usable ones"
+    try:
+        return get_config(db=app.state.db, max_age=0)
+    except (ValueError, BadConfigInDBError) as err:
+        logger.debug("no usable settings in database: %s", err)
+        return None
+
+
+def reload_settings(app: FastAPI) -> bool:
+    """
+    swaps in the settings saved in the database if they've changed since they
+    were last seen, and returns whether they were swapped
+
+    the swap is a single attribute assignment, so requests already being
+    handled keep the settings they started with
+
+    settings in RESTART_REQUIRED keep the values the server is running with,
+    so app.state.settings always describes the running server
+    """
+    saved_settings = _saved_settings(app)
+    last_seen = getattr(app.state, "saved_settings", None)
+    if saved_settings is None or saved_settings is last_seen:
+        return False
+    app.state.saved_settings = saved_settings
+
+    if saved_settings == last_seen:
+        return False
+    if not isinstance(saved_settings, ServerSettings):
+        logger.warning(
+            "ignoring saved settings of type %s", type(saved_settings).__name__
+        )
+        return False
+
+    current_settings: ServerSettings = app.state.settings
+    changed = [
+        name
+        for name in RESTART_REQUIRED
+        if getattr(saved_settings, name) != getattr(current_settings, name)
+    ]
+    if changed:
+        logger.warning(
+            "these settings changed, but need a restart to apply: %s",
+            ", ".join(changed),
+        )
+        saved_settings = saved_settings.copy(
+            update={name: getattr(current_settings, name) for name in changed}
         )
+    app.state.settings = saved_settings
+    logger.info("reloaded settings")
+    return True
+
+
+async def _watch_settings(app: FastAPI, interval: float) -> None:
+    "periodically checks the database for new settings"
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(reload_settings, app)
+        except Exception:  # pylint: disable=broad-except
+            # a bad poll shouldn't stop future ones
+            logger.exception("could not reload settings")
+
+
+def install_settings_watcher(app: FastAPI) -> None:
+    """
+    makes the app pick up settings saved to the database while it's running
+
+    the database is checked every settings_poll_interval seconds, which is
+    cheap, since database.config.get_config only re-reads the settings when
+    SQLite reports that another connection has committed, and immediately on
+    SIGHUP
+    """
+
+    @app.on_event("startup")
+    async def start_watching_settings() -> None:
+        settings: Optional[ServerSettings] = getattr(app.state, "settings", None)
+        if settings is None or getattr(app.state, "db", None) is None:
+            return
+        # whatever is already saved was either used to start the server, or
+        # was overridden on the command line, so only later changes count
+        app.state.saved_settings = await run_in_threadpool(_saved_settings, app)
+
+        loop = asyncio.get_event_loop()
+        if hasattr(signal, "SIGHUP"):
+            try:
+                loop.add_signal_handler(
+                    signal.SIGHUP,
+                    lambda: loop.create_task(run_in_threadpool(reload_settings, app)),
+                )
+            except (NotImplementedError, RuntimeError, ValueError):
+                # not supported by this event loop, or not the main thread
+                pass
+        if settings.settings_poll_interval > 0:
+            app.state.settings_watcher = loop.create_task(
+                _watch_settings(app, settings.settings_poll_interval)
+            )
+
+    @app.on_event("shutdown")
+    async def stop_watching_settings() -> None:
+        watcher: Optional[asyncio.Task] = getattr(app.state, "settings_watcher", None)
+        if watcher is not None:
+            watcher.cancel()
+            app.state.settings_watcher = None
+
+
+async def _sweep_expired_redirects(app: FastAPI, interval: float) -> None:
+    "periodically deletes expired redirects"
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            deleted = await run_in_threadpool(delete_expired_redirects, db=app.state.db)
+        except Exception:  # pylint: disable=broad-except
+            # a failed sweep shouldn't stop future ones
+            logger.exception("could not delete expired redirects")
+        else:
+            if deleted:
+                logger.info("deleted %d expired redirects", deleted)
+
+
+def install_expiry_sweeper(app: FastAPI) -> None:
+    """
+    makes the app delete expired redirects every expiry_sweep_interval
+    seconds
+
+    expired redirects are already treated as missing, so this only frees the
+    space and the keys; it runs in a worker thread, and deletes in small
+    batches, each in its own transaction, so lookups aren't held up
+    """
+
+    @app.on_event("startup")
+    async def start_sweeping() -> None:
+        settings: Optional[ServerSettings] = getattr(app.state, "settings", None)
+        if settings is None or getattr(app.state, "db", None) is None:
+            return
+        # a mirror only changes when the sync agent applies changes
+        if settings.expiry_sweep_interval > 0 and not settings.read_only:
+            app.state.expiry_sweeper = asyncio.get_event_loop().create_task(
+                _sweep_expired_redirects(app, settings.expiry_sweep_interval)
+            )
+
+    @app.on_event("shutdown")
+    async def stop_sweeping() -> None:
+        sweeper: Optional[asyncio.Task] = getattr(app.state, "expiry_sweeper", None)
+        if sweeper is not None:
+            sweeper.cancel()
+            app.state.expiry_sweeper = None
+
+
+async def _check_integrity(app: FastAPI, interval: float) -> None:
+    "periodically runs a quick check on the database file"
+    while True:
+        await asyncio.sleep(interval)
+        settings: ServerSettings = app.state.settings
+        try:
+            ok = await run_in_threadpool(
+                check_database_file, settings.database_file, IntegrityCheck.quick
+            )
+        except Exception:  # pylint: disable=broad-except
+            # a failed check shouldn't stop future ones
+            logger.exception("could not check the database")
+            continue
+        app.state.database_ok = ok
+        if not ok:
+            logger.error("the database failed its quick check")
+
+
+def install_integrity_checker(app: FastAPI) -> None:
+    """
+    makes the app run a quick check on the database every
+    integrity_check_interval seconds, instead of when it starts
+
+    the check reads the whole database in a worker thread, on its own
+    connection; the result is saved next to the database, so the check is
+    skipped while the database hasn't changed
+    """
+
+    @app.on_event("startup")
+    async def start_checking() -> None:
+        settings: Optional[ServerSettings] = getattr(app.state, "settings", None)
+        if settings is None or not settings.database_file:
+            return
+        if settings.integrity_check_interval > 0:
+            app.state.integrity_checker = asyncio.get_event_loop().create_task(
+                _check_integrity(app, settings.integrity_check_interval)
+            )
+
+    @app.on_event("shutdown")
+    async def stop_checking() -> None:
+        checker: Optional[asyncio.Task] = getattr(app.state, "integrity_checker", None)
+        if checker is not None:
+            checker.cancel()
+            app.state.integrity_checker = None
+
+
+async def _take_backups(app: FastAPI, interval: float) -> None:
+    "periodically takes a snapshot of the database"
+    while True:
+        await asyncio.sleep(interval)
+        settings: ServerSettings = app.state.settings
+        try:
+            snapshot = await run_in_threadpool(
+                backup_database,
+                settings.database_file,
+                directory=settings.backup_directory,
+                keep=settings.backup_keep,
+            )
+        except Exception:  # pylint: disable=broad-except
+            # a failed backup shouldn't stop future ones
+            logger.exception("could not back up the database")
+        else:
+            logger.info("backed up the database to %s", snapshot)
+
+
+def install_backup_scheduler(app: FastAPI) -> None:
+    """
+    makes the app take a snapshot of the database every backup_interval
+    seconds
+
+    the snapshot is copied a few pages at a time, in a worker thread, with a
+    pause between each step, so redirects aren't held up; see
+    database.backup
+    """
+
+    @app.on_event("startup")
+    async def start_backups() -> None:
+        settings: Optional[ServerSettings] = getattr(app.state, "settings", None)
+        if settings is None or not settings.database_file:
+            return
+        if settings.backup_interval > 0:
+            app.state.backup_scheduler = asyncio.get_event_loop().create_task(
+                _take_backups(app, settings.backup_interval)
+            )
 
-    return RedirectResponse(url=redirect.url)
+    @app.on_event("shutdown")
+    async def stop_backups() -> None:
+        scheduler: Optional[asyncio.Task] = getattr(app.state, "backup_scheduler", None)
+        if scheduler is not None:
+            scheduler.cancel()
+            app.state.backup_scheduler = None
 
 
 app = FastAPI()
+install_settings_watcher(app)
+install_expiry_sweeper(app)
+install_integrity_checker(app)
+install_backup_scheduler(app)
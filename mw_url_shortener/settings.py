@@ -1,13 +1,12 @@
-print(f"imported mw_url_shortener.settings as {__name__}")
 import enum
 from enum import Enum
 from pathlib import Path
-from typing import Callable, Iterable, Optional, Union
+from typing import Callable, Iterable, List, Optional, Union
 
 from pydantic import BaseSettings, Extra, Field, validator
 
-from .types import Key
-from .utils import orjson_dumps, orjson_loads, unsafe_random_chars
+from .types import IntegrityCheck, Key, KeyNormalization, Username
+from .utils import normalize_host, orjson_dumps, orjson_loads, unsafe_random_chars
 
 
 class CommonSettings(BaseSettings):
@@ -65,8 +64,73 @@ class ServerSettings(ClientSettings, DatabaseSettings):
     # - What characters are allowed?
     # - Does the library to percent-encoding?
     root_path: Optional[str] = None
+    host: str = "127.0.0.1"
+    port: int = 8000
     reload: bool = False
     key_length: int = 3
+    # how closely a requested key has to match; lenient and casefold let
+    # variants of a key reach it
+    key_normalization: KeyNormalization = KeyNormalization.exact
+    # serves redirects from a mirror kept up to date by a sync agent, without
+    # the API, and without deleting expired redirects
+    read_only: bool = False
+    # how often, in seconds, to check the database for changed settings; 0
+    # turns this off
+    settings_poll_interval: float = 5.0
+    # how often, in seconds, to delete expired redirects; 0 turns this off
+    expiry_sweep_interval: float = 60.0
+    # how thoroughly the database is checked when the server starts
+    integrity_check: IntegrityCheck = IntegrityCheck.header
+    # how often, in seconds, to run a quick check on the database while the
+    # server is running; 0 turns this off
+    integrity_check_interval: float = 0.0
+    # how often, in seconds, to take a snapshot of the database; 0 turns this
+    # off
+    backup_interval: float = 0.0
+    # where snapshots are kept; by default, a backups directory next to the
+    # database
+    backup_directory: Optional[Path] = None
+    # how many snapshots are kept
+    backup_keep: int = 7
+    metrics_port: Optional[int] = None
+    profile: Optional[float] = None
+    profile_file: Optional[Path] = None
+    # the domains redirects are served on, each with its own keys; requests
+    # for any other domain are rejected, and if there are none, the Host
+    # header is ignored, and every request uses the same keys; keys a domain
+    # doesn't have are looked up on "*", where redirects made without a
+    # domain are
+    domains: List[str] = []
+    # the users that can read the change log, and through it every user's
+    # redirects; the usernames sync agents log in with
+    sync_users: List[Username] = []
+
+    @validator("domains", each_item=True)
+    def normalized_domain(cls, value: str) -> str:
+        "domains are compared the way Host headers are"
+        return normalize_host(value)
+
+
+class SyncSettings(ClientSettings, DatabaseSettings):
+    """
+    the settings for a sync agent, which mirrors a server's redirects into
+    database_file; username has to be one of the server's sync_users
+    """
+
+    # where the server is, without the api_key
+    server_url: str = "http://127.0.0.1:8000"
+    username: Username
+    # best set with the URL_SHORTENER_PASSWORD environment variable, so it's
+    # not on the command line
+    password: str
+    # how long to wait, in seconds, before asking for more changes, once the
+    # mirror has caught up
+    sync_poll_interval: float = 1.0
+    # how many changes to ask for, and apply, at a time
+    sync_batch_size: int = 1000
+    # how often, in seconds, to delete expired redirects from the mirror; 0
+    # turns this off
+    expiry_sweep_interval: float = 60.0
 
 
 _settings: Optional[CommonSettings] = None
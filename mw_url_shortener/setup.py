@@ -1,4 +1,3 @@
-print(f"imported mw_url_shortener.setup as {__name__}")
 """
 Primarily uses https://github.com/tmbo/questionary
 """
@@ -0,0 +1,240 @@
+"""
+mirrors a server's redirects into a local database file, which a read-only
+server on the same machine serves redirects from
+
+the sync agent follows the server's change log (see
+database.interface.list_changes) through the API; each batch of changes is
+applied to the local database in one transaction, along with the sequence
+number of the last change in it, so the agent can be stopped at any time, and
+picks up where it left off
+
+the local database is put in WAL mode, so the read-only server's lookups
+aren't blocked while a batch is written
+
+the server deletes expired redirects without logging it, so the agent deletes
+them from the mirror itself, every expiry_sweep_interval
+
+the change log only has the changes made since it was added, so a mirror
+that has never followed a server starts from a snapshot of every current
+redirect instead: the agent pages through the snapshot, then follows the
+change log from the newest change made before the snapshot's first page was
+read; changes made while it's paging are applied again afterwards, which
+leaves the redirects they touched as they would be anyway
+"""
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from pony.orm import Database
+
+from .client import ApiClient, ClientError
+from .database import uris
+from .database.interface import delete_expired_redirects, session
+from .database.models import RedirectChangeModel
+from .types import ChangeOperation, SPath
+
+__all__ = [
+    "BATCH_SIZE",
+    "POLL_INTERVAL",
+    "EXPIRY_SWEEP_INTERVAL",
+    "prepare_mirror",
+    "read_cursor",
+    "copy_snapshot",
+    "apply_changes",
+    "sync_once",
+    "run_agent",
+]
+
+logger = logging.getLogger(__name__)
+
+# How many changes are asked for, and applied, at a time
+BATCH_SIZE = 1000
+
+# How long to wait, in seconds, before asking for more changes, once the
+# mirror has caught up, or after the server couldn't be reached
+POLL_INTERVAL = 1.0
+
+# How often, in seconds, to delete expired redirects from the mirror
+EXPIRY_SWEEP_INTERVAL = 60.0
+
+# Where the sequence number of the last change applied is kept, for each
+# server the mirror has followed; pony doesn't map this table
+CURSOR_TABLE = "SyncCursor"
+
+
+def prepare_mirror(database_file: SPath) -> None:
+    """
+    puts the mirror in WAL mode, before it's used
+
+    this is kept in the database file, so the read-only server uses it too
+    """
+    connection = sqlite3.connect(str(Path(database_file).resolve()))
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+    finally:
+        connection.close()
+
+
+def _create_cursor_table(db: Database) -> None:
+    db.execute(
+        f'CREATE TABLE IF NOT EXISTS "{CURSOR_TABLE}" '
+        "(source TEXT NOT NULL PRIMARY KEY, sequence INTEGER NOT NULL)"
+    )
+
+
+def _stored_cursor(db: Database, source: str) -> Optional[int]:
+    "the cursor kept for a server, or None if the mirror has never followed it"
+    with session():
+        _create_cursor_table(db)
+        rows = db.select(
+            f'SELECT sequence FROM "{CURSOR_TABLE}" WHERE source = $source'
+        )
+    return int(rows[0]) if rows else None
+
+
+def read_cursor(db: Database, source: str) -> int:
+    "the sequence number of the last change applied from a server, or 0"
+    stored = _stored_cursor(db, source)
+    return 0 if stored is None else stored
+
+
+def _move_cursor(db: Database, source: str, sequence: int) -> None:
+    "needs a db_session"
+    db.execute(
+        f'INSERT OR REPLACE INTO "{CURSOR_TABLE}" (source, sequence) '
+        "VALUES ($source, $sequence)"
+    )
+
+
+def _put_redirect(
+    db: Database, host: str, key: str, uri: str, expires_at: Optional[datetime]
+) -> None:
+    "makes a redirect, or changes the one that has its host and key"
+    redirect = db.RedirectEntity.get(host=host, key=key)
+    if redirect:
+        uris.set_uri(db, redirect, uri)
+        redirect.expires_at = expires_at
+    else:
+        db.RedirectEntity(
+            host=host, key=key, expires_at=expires_at, **uris.uri_columns(db, uri)
+        )
+
+
+def _apply_change(db: Database, change: RedirectChangeModel) -> None:
+    if change.operation == ChangeOperation.delete:
+        redirect = db.RedirectEntity.get(host=change.host, key=change.key)
+        if redirect:
+            uris.delete_uri(db, redirect)
+            redirect.delete()
+            # the same key can be made again later in the batch
+            db.flush()
+    else:
+        _put_redirect(db, change.host, change.key, change.uri, change.expires_at)
+
+
+def apply_changes(
+    db: Database, source: str, changes: List[RedirectChangeModel]
+) -> None:
+    """
+    applies a batch of changes from a server, in order, and moves its cursor
+    past them, all in one transaction
+    """
+    if not changes:
+        return
+    sequence = changes[-1].sequence
+    with session():
+        _create_cursor_table(db)
+        for change in changes:
+            _apply_change(db, change)
+        _move_cursor(db, source, sequence)
+
+
+def copy_snapshot(db: Database, client: ApiClient, batch_size: int = BATCH_SIZE) -> int:
+    """
+    copies every current redirect from a server, a page at a time, each in its
+    own transaction, then starts the server's cursor at the newest change made
+    before the first page was read, and returns how many were copied
+
+    if it's stopped part way, the cursor isn't kept, so it starts again
+    """
+    source = client.server_url
+    snapshot = client.snapshot(limit=batch_size)
+    sequence = snapshot.sequence
+    copied = 0
+    while True:
+        redirects = snapshot.redirects
+        with session():
+            for redirect in redirects:
+                _put_redirect(
+                    db, redirect.host, redirect.key, redirect.uri, redirect.expires_at
+                )
+        copied += len(redirects)
+        if len(redirects) < batch_size:
+            break
+        last = redirects[-1]
+        snapshot = client.snapshot(
+            after_host=last.host, after=last.key, limit=batch_size
+        )
+    with session():
+        _create_cursor_table(db)
+        _move_cursor(db, source, sequence)
+    return copied
+
+
+def sync_once(db: Database, client: ApiClient, batch_size: int = BATCH_SIZE) -> int:
+    """
+    applies every change the server has that the mirror doesn't, a batch at a
+    time, and returns how many were applied; a mirror that has never followed
+    the server copies a snapshot of it first, and its redirects are counted
+    too
+    """
+    source = client.server_url
+    stored = _stored_cursor(db, source)
+    applied = 0
+    if stored is None:
+        applied += copy_snapshot(db, client, batch_size)
+    cursor = read_cursor(db, source)
+    while True:
+        changes = client.changes(after=cursor, limit=batch_size)
+        apply_changes(db, source, changes)
+        applied += len(changes)
+        if len(changes) < batch_size:
+            return applied
+        cursor = changes[-1].sequence
+
+
+def run_agent(
+    db: Database,
+    client: ApiClient,
+    poll_interval: float = POLL_INTERVAL,
+    batch_size: int = BATCH_SIZE,
+    stop: Optional[threading.Event] = None,
+    expiry_sweep_interval: float = EXPIRY_SWEEP_INTERVAL,
+) -> None:
+    """
+    keeps the mirror up to date until stop is set, or forever, and deletes
+    expired redirects from it every expiry_sweep_interval; 0 turns that off
+
+    if the server can't be reached, or refuses a request, the agent tries
+    again after poll_interval
+    """
+    stop = stop or threading.Event()
+    next_sweep = time.monotonic()
+    while not stop.is_set():
+        try:
+            applied = sync_once(db, client, batch_size)
+        except ClientError as err:
+            logger.warning("could not sync with %s: %s", client.server_url, err)
+        else:
+            if applied:
+                logger.info("applied %d changes from %s", applied, client.server_url)
+        if expiry_sweep_interval > 0 and time.monotonic() >= next_sweep:
+            deleted = delete_expired_redirects(db=db)
+            if deleted:
+                logger.info("deleted %d expired redirects", deleted)
+            next_sweep = time.monotonic() + expiry_sweep_interval
+        stop.wait(poll_interval)
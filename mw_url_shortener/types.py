@@ -1,7 +1,7 @@
-print(f"imported mw_url_shortener.types as {__name__}")
 """
 Holds all of the custom types used across the application
 """
+from enum import Enum
 from pathlib import Path
 from typing import NewType, Union
 
@@ -28,3 +28,50 @@ Key = NewType("Key", constr(min_length=1))
 Username = NewType("Username", constr(min_length=1))
 
 SPath = Union[str, Path]
+
+
+class KeyNormalization(str, Enum):
+    "how closely a requested key has to match a redirect's key"
+    # the key has to match exactly
+    exact = "exact"
+    # trailing slashes, percent-encoding, and unicode normalization forms are
+    # ignored
+    lenient = "lenient"
+    # like lenient, and case is also ignored
+    casefold = "casefold"
+
+
+class IntegrityCheck(str, Enum):
+    "how thoroughly a database file is checked before it's used"
+    # the file has to start with an SQLite header, and its schema has to be
+    # readable; this doesn't depend on the size of the database
+    header = "header"
+    # pragma quick_check, which reads every page
+    quick = "quick"
+    # pragma integrity_check, which also checks that indexes match their tables
+    full = "full"
+
+
+class ChangeOperation(str, Enum):
+    "what happened to a redirect, in the change log"
+    create = "create"
+    update = "update"
+    delete = "delete"
+
+
+class ExportFormat(str, Enum):
+    "what redirects and users are exported as"
+    # one JSON object per line
+    jsonl = "jsonl"
+    # comma-separated values, with a header row
+    csv = "csv"
+    # a database file the server can use
+    sqlite = "sqlite"
+
+
+class Compression(str, Enum):
+    "how exported JSON lines and CSV files are compressed"
+    none = "none"
+    gzip = "gzip"
+    bz2 = "bz2"
+    xz = "xz"
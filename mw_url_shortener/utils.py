@@ -1,28 +1,57 @@
-print(f"imported mw_url_shortener.utils as {__name__}")
 """
 module of utility functions
 
 all of these functions can be loaded independently of the rest of this library,
 except for the types
 """
+import hashlib
+import os
 import random
-import re
 import secrets
 import string
 import sys
+import threading
+import unicodedata
+from bisect import bisect_right
+from functools import lru_cache
 from itertools import islice
-from typing import Callable, Iterable
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Generic,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+from urllib.parse import unquote
 
 import orjson
-from passlib.context import CryptContext
 
 from mw_url_shortener.types import HashedPassword, Username
 
+if TYPE_CHECKING:
+    from passlib.context import CryptContext
+
 __all__ = [
     "orjson_dumps",
     "orjson_loads",
+    "KEY_CHARACTERS",
     "unsafe_random_chars",
     "safe_random_chars",
+    "safe_key_chars",
+    "safe_keys",
+    "normalize_key",
+    "DEFAULT_HOST",
+    "normalize_host",
+    "uri_hash",
+    "SingleFlight",
     "random_username",
     "unsafe_random_hashed_password",
 ]
@@ -40,20 +69,24 @@ def orjson_dumps(v, *, default):
 
 orjson_loads = orjson.loads
 
+# The characters generated keys are made from
+KEY_CHARACTERS = string.ascii_letters + string.digits
+
 
 def make_unsafe_random_characters() -> Callable[[int], str]:
     """
     Returns a function that produces strings of specified length,
     composed of random characters
     """
-    valid_chars = list(set(string.ascii_letters + string.digits))
+    valid_chars = list(set(KEY_CHARACTERS))
 
     def char_gen() -> Iterable[str]:
         "makes an infinite generator of random characters"
         while True:
             yield random.choice(valid_chars)
 
-    chars = char_gen()
+    # NOTE: made on first use, so importing this module has no side effects
+    chars: Optional[Iterator[str]] = None
 
     def unsafe(num: int) -> str:
         """
@@ -70,6 +103,9 @@ def make_unsafe_random_characters() -> Callable[[int], str]:
         if length < 1:
             raise ValueError(error_message)
 
+        nonlocal chars
+        if chars is None:
+            chars = iter(char_gen())
         return "".join(islice(chars, int(num)))
 
     return unsafe
@@ -92,31 +128,337 @@ def safe_random_chars(num_bytes: int) -> str:
     return secrets.token_hex(nbytes=length)
 
 
-def unsafe_word_characters_generator() -> Iterable[str]:
+def normalize_key(key: str, casefold: bool = True) -> str:
     """
-    returns an infinte generator of unicode word characters
+    removes the differences a key can pick up when a link is copied around:
+    percent-encoding, trailing slashes, and unicode normalization form, and
+    optionally, case
     """
-    word_characters_re = re.compile(r"^[\w]+$")
+    normalized = unicodedata.normalize("NFC", unquote(key)).rstrip("/")
+    return normalized.casefold() if casefold else normalized
 
-    def character_gen() -> Iterable[str]:
-        "iterates over range of unicode characters, filtering out unprintable ones"
-        while True:
-            character = chr(random.randint(0, sys.maxunicode))
-            if not word_characters_re.match(character):
-                continue
-            if len(repr(character)) != 3:
-                # the repr of a character should be the character,
-                # and the two quotation marks:
-                # repr("a")    -> 'a'
-                # repr("\x00") -> '\x00'
-                continue
 
-            yield character
+# The host redirects belong to when the server isn't given any domains, and
+# every request is answered from the same keys; it can't be a real hostname
+DEFAULT_HOST = "*"
+
+
+def normalize_host(host: str) -> str:
+    """
+    reduces a Host header or a domain name to the form domains are compared
+    in: lowercase, punycoded, without a port or a trailing dot
+    """
+    host = host.strip().lower()
+    if host.startswith("["):
+        # an IPv6 address, possibly followed by a port
+        return host[: host.find("]") + 1] if "]" in host else host
+    host = host.rsplit(":", 1)[0] if host.count(":") == 1 else host
+    host = host.rstrip(".")
+    try:
+        host.encode("ascii")
+    except UnicodeError:
+        try:
+            host = host.encode("idna").decode("ascii")
+        except UnicodeError:
+            pass
+    return host
+
+
+def uri_hash(uri: str) -> int:
+    """
+    a 64-bit hash of a URI, small enough to index cheaply
+
+    different URIs can have the same hash, so matches need to be checked
+    """
+    digest = hashlib.blake2b(uri.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+Result = TypeVar("Result")
+
+
+class _Flight(Generic[Result]):
+    "a call in progress, and what it returned or raised, once it's done"
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[Result] = None
+        self.error: Optional[BaseException] = None
+        # how many callers are sharing it, besides the one making it
+        self.followers = 0
+
+
+class SingleFlight(Generic[Result]):
+    """
+    makes concurrent calls for the same key share one call: the first caller
+    runs it, and the rest wait for it to finish and get what it returned, or
+    raised
+
+    nothing is kept once a call is done, so a call that starts afterwards
+    runs again; this isn't a cache, it only stops a burst of identical
+    lookups from each doing the same work
+
+    callers wait on a threading.Event, so this is for code running in
+    threads, like the handlers FastAPI runs in its threadpool
+    """
+
+    def __init__(self) -> None:
+        self._flights: Dict[Hashable, _Flight[Result]] = {}
+        self._lock = threading.Lock()
+
+    def waiting(self) -> int:
+        "how many callers are waiting for calls in progress to finish"
+        with self._lock:
+            return sum(flight.followers for flight in self._flights.values())
+
+    def do(self, key: Hashable, function: Callable[[], Result]) -> Tuple[Result, bool]:
+        """
+        calls function, unless a call for key is already in progress, and
+        returns its result, along with whether it was shared with that call
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True  # type: ignore
+
+        try:
+            flight.result = function()
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+# os.urandom is read this many bytes at a time
+ENTROPY_BLOCK_SIZE = 4096
+
+# Each random byte below the largest multiple of len(KEY_CHARACTERS) that fits
+# in a byte maps to one key character, and the rest are thrown away, so that
+# every character is equally likely
+_KEY_BYTE_LIMIT = 256 - 256 % len(KEY_CHARACTERS)
+_KEY_BYTE_TABLE = bytes(
+    ord(KEY_CHARACTERS[byte % len(KEY_CHARACTERS)]) for byte in range(256)
+)
+_REJECTED_KEY_BYTES = bytes(range(_KEY_BYTE_LIMIT, 256))
+
+
+class _KeyCharacterBuffer:
+    """
+    holds random key characters made from os.urandom
+
+    the random bytes are mapped, and the rejected ones deleted, a whole block
+    at a time with bytes.translate, instead of a character at a time
+    """
+
+    def __init__(self) -> None:
+        self._characters = ""
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, num: int) -> None:
+        "makes sure at least num characters are buffered; needs the lock"
+        characters = self._characters[self._offset :]
+        while len(characters) < num:
+            # on average, 248 of every 256 bytes are kept
+            block = os.urandom(max(ENTROPY_BLOCK_SIZE, (num - len(characters)) * 2))
+            characters += block.translate(_KEY_BYTE_TABLE, _REJECTED_KEY_BYTES).decode(
+                "ascii"
+            )
+        self._characters = characters
+        self._offset = 0
+
+    def take(self, num: int) -> str:
+        "removes num characters from the buffer"
+        with self._lock:
+            if len(self._characters) - self._offset < num:
+                self._refill(num)
+            start = self._offset
+            self._offset += num
+            return self._characters[start : self._offset]
+
+    def clear(self) -> None:
+        """
+        throws away the buffered characters, and replaces the lock, which may
+        have been held by a thread that doesn't exist in a forked child
+        """
+        self._characters = ""
+        self._offset = 0
+        self._lock = threading.Lock()
 
-    return character_gen()
 
+_key_character_buffer = _KeyCharacterBuffer()
 
-unsafe_word_characters = unsafe_word_characters_generator()
+# NOTE: a forked worker, like those of gunicorn or uvicorn --workers, would
+# otherwise hand out the same keys as its parent and its siblings, from the
+# characters buffered before the fork; os.register_at_fork is missing on
+# Windows, which can't fork, and on Python 3.6
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_key_character_buffer.clear)
+
+
+def safe_key_chars(num: int) -> str:
+    """
+    produces a url-safe string of length num, of random characters from
+    KEY_CHARACTERS
+
+    this is cryptographically safe
+    """
+    error_message = "safe_key_chars only takes positive integer values"
+    try:
+        length = int(num)
+    except (TypeError, ValueError) as err:
+        raise TypeError(error_message) from err
+
+    if length < 1:
+        raise ValueError(error_message)
+
+    return _key_character_buffer.take(length)
+
+
+def safe_keys(length: int, number: int) -> List[str]:
+    """
+    produces a number of random keys of the same length, using
+    safe_key_chars, for when many are needed at once
+
+    the keys are not guaranteed to be unique
+    """
+    error_message = "safe_keys only takes positive integer values"
+    try:
+        key_length, key_number = int(length), int(number)
+    except (TypeError, ValueError) as err:
+        raise TypeError(error_message) from err
+
+    if key_length < 1 or key_number < 1:
+        raise ValueError(error_message)
+
+    characters = _key_character_buffer.take(key_length * key_number)
+    return [
+        characters[start : start + key_length]
+        for start in range(0, len(characters), key_length)
+    ]
+
+
+# The unicode categories of the characters that print as something visible:
+# letters, marks, numbers, punctuation, and symbols
+PRINTABLE_CATEGORIES = frozenset(
+    "Lu Ll Lt Lm Lo Mn Mc Me Nd Nl No Pc Pd Ps Pe Pi Pf Po Sm Sc Sk So".split()
+)
+# The categories matched by the \w regular expression, along with "_"
+WORD_CATEGORIES = frozenset("Lu Ll Lt Lm Lo Nd Nl No".split())
+
+
+@lru_cache(maxsize=None)
+def _category_runs() -> Tuple[Tuple[int, str], ...]:
+    """
+    the first code point of each run of code points that share a unicode
+    category, along with that category
+
+    this looks at every code point once, so it's only done once per process
+    """
+    runs: List[Tuple[int, str]] = []
+    last_category = None
+    for code_point in range(sys.maxunicode + 1):
+        category = unicodedata.category(chr(code_point))
+        if category != last_category:
+            runs.append((code_point, category))
+            last_category = category
+    return tuple(runs)
+
+
+class CharacterTable:
+    """
+    a set of unicode characters, stored as ranges of code points, that can be
+    sampled from uniformly
+    """
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]]) -> None:
+        "ranges are (first, last) code points, in order and not overlapping"
+        self.starts: List[int] = []
+        self.lasts: List[int] = []
+        # how many characters come before each range
+        self.offsets: List[int] = []
+        self.size = 0
+        for first, last in ranges:
+            self.starts.append(first)
+            self.lasts.append(last)
+            self.offsets.append(self.size)
+            self.size += last - first + 1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[str]:
+        "every character, in code point order"
+        for first, last in zip(self.starts, self.lasts):
+            yield from map(chr, range(first, last + 1))
+
+    def __contains__(self, character: object) -> bool:
+        if not isinstance(character, str) or len(character) != 1:
+            return False
+        code_point = ord(character)
+        range_index = bisect_right(self.starts, code_point) - 1
+        return range_index >= 0 and code_point <= self.lasts[range_index]
+
+    def sample(self, num: int) -> str:
+        """
+        picks num characters, each equally likely
+
+        a character is chosen by its index across all of the ranges, so each
+        range is picked in proportion to its size, and then found with a
+        binary search, which is done in C
+        """
+        starts, offsets, size = self.starts, self.offsets, self.size
+        rand = random.random
+        characters = []
+        for _ in range(num):
+            index = int(rand() * size)
+            range_index = bisect_right(offsets, index) - 1
+            characters.append(chr(starts[range_index] + index - offsets[range_index]))
+        return "".join(characters)
+
+
+def _ranges(categories: FrozenSet[str]) -> List[Tuple[int, int]]:
+    "merges the runs of code points in these categories into ranges"
+    runs = _category_runs()
+    ranges: List[Tuple[int, int]] = []
+    ends = [start - 1 for start, _ in runs[1:]] + [sys.maxunicode]
+    for (start, category), end in zip(runs, ends):
+        if category not in categories:
+            continue
+        if ranges and ranges[-1][1] == start - 1:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+@lru_cache(maxsize=None)
+def printable_characters() -> CharacterTable:
+    "every unicode character that's printable and isn't whitespace"
+    return CharacterTable(_ranges(PRINTABLE_CATEGORIES))
+
+
+@lru_cache(maxsize=None)
+def word_characters() -> CharacterTable:
+    "every unicode character matched by the \\w regular expression"
+    ranges = _ranges(WORD_CATEGORIES)
+    underscore = ord("_")
+    # "_" is between "Z" and "a", in a range of its own
+    ranges.append((underscore, underscore))
+    return CharacterTable(sorted(ranges))
 
 
 def unsafe_random_string(num: int) -> str:
@@ -132,7 +474,7 @@ def unsafe_random_string(num: int) -> str:
     if length < 1:
         raise ValueError(error_message)
 
-    return "".join(islice(unsafe_word_characters, length))
+    return word_characters().sample(length)
 
 
 def random_username(num: int) -> Username:
@@ -143,7 +485,30 @@ def random_username(num: int) -> Username:
 # NOTE:DUP This needs to mirror the password context in authentication.py
 # It can't be imported, both because this module should be standalone, and
 # because I want to avoid import loops
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# NOTE: passlib and bcrypt are slow to import, so the context is only made
+# when it's first needed
+class _LazyCryptContext:
+    "stands in for a passlib CryptContext, which is made the first time it's used"
+
+    def __init__(self) -> None:
+        self._context: Optional["CryptContext"] = None
+        self._lock = threading.Lock()
+
+    def _get(self) -> "CryptContext":
+        if self._context is None:
+            with self._lock:
+                if self._context is None:
+                    from passlib.context import CryptContext
+
+                    self._context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        return self._context
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get(), name)
+
+
+# the password hashing context
+password_context: "CryptContext" = _LazyCryptContext()  # type: ignore
 
 
 def unsafe_random_hashed_password() -> HashedPassword:
@@ -159,27 +524,7 @@ def unsafe_random_hashed_password() -> HashedPassword:
 
 def printable_characters_generator() -> Iterable[str]:
     """
-    returns a generator that returns all printable unicode characters
-
-    this is very computationally slow, so as to avoid excessive memory use
+    returns a generator that returns all printable unicode characters, other
+    than whitespace
     """
-    non_whitespace_re = re.compile(r"^[\S]+$")
-    all_unicode_characters = (
-        chr(o) for o in range(sys.maxunicode + 1)
-    )  # +1 so that the end is included
-
-    def character_gen() -> Iterable[str]:
-        "iterates over range of unicode characters, filtering out unprintable ones"
-        # NOTE:BUG This doesn't do what it claims to
-        # It does not filter out all unicode control characters
-        # A better approach may be a list of range(start, end+1) of the unwanted
-        # parts of unicode
-        for character in all_unicode_characters:
-            if not non_whitespace_re.match(character):
-                continue
-            if len(repr(character)) != 3:
-                continue
-
-            yield character
-
-    return character_gen()
+    return iter(printable_characters())
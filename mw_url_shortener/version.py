@@ -1,13 +1,13 @@
-print(f"imported mw_url_shortener.version as {__name__}")
-from typing import Optional
-
-from pydantic import BaseSettings
+from typing import TYPE_CHECKING, Optional
 
 from . import __version__
 
+if TYPE_CHECKING:
+    from pydantic import BaseSettings
+
 
 # NOTE:FUTURE::DOCS Update docstring is the parameter is used
-def print_version(settings: Optional[BaseSettings] = None) -> str:
+def print_version(settings: Optional["BaseSettings"] = None) -> str:
     """
     prints and returns the current version
 
@@ -0,0 +1,174 @@
+"""
+a small benchmark harness, used by test_benchmarks.py through the benchmark
+fixture in conftest.py
+
+the benchmarks only run when a path for the results is given:
+
+pytest -p no:cacheprovider --no-cov --benchmark-json=results.json tests/test_benchmarks.py
+
+two result files, for example from two different commits, can be compared with:
+
+python -m tests.benchmark old.json new.json
+"""
+import argparse
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, TypeVar, Union
+
+import orjson
+
+Result = TypeVar("Result")
+Stats = Dict[str, Union[float, int]]
+
+
+def summarize(timings: List[float]) -> Stats:
+    "summary statistics of a list of timings, in seconds"
+    ordered = sorted(timings)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    median = statistics.median(ordered)
+    return {
+        "rounds": len(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "mean": statistics.mean(ordered),
+        "median": median,
+        "p95": ordered[p95_index],
+        "stddev": statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        "ops_per_second": 1 / median if median else 0.0,
+    }
+
+
+def git_commit() -> Optional[str]:
+    "the commit of the working tree the benchmarks were run against, if known"
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.strip()
+
+
+class BenchmarkResults:
+    "collects the results of every benchmark in a session"
+
+    def __init__(self) -> None:
+        self.benchmarks: Dict[str, Stats] = {}
+
+    def add(self, name: str, stats: Stats) -> None:
+        self.benchmarks[name] = stats
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "commit": git_commit(),
+            "datetime": datetime.now(timezone.utc).isoformat(),
+            "machine": {
+                "python": platform.python_version(),
+                "implementation": platform.python_implementation(),
+                "platform": platform.platform(),
+                "processor": platform.processor() or platform.machine(),
+            },
+            "benchmarks": self.benchmarks,
+        }
+
+    def write(self, path: Path) -> None:
+        path.write_bytes(
+            orjson.dumps(
+                self.as_dict(), option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+            )
+        )
+
+
+class Benchmark:
+    "times repeated calls of a function, and records the result under a name"
+
+    def __init__(self, name: str, results: BenchmarkResults) -> None:
+        self.name = name
+        self.results = results
+
+    def __call__(
+        self,
+        func: Callable[[], Result],
+        rounds: int = 100,
+        warmup: int = 3,
+        setup: Optional[Callable[[], None]] = None,
+    ) -> Result:
+        """
+        calls func warmup times without timing it, then rounds times, timing
+        each call separately
+
+        setup, if given, is called before every call to func, and is not timed
+        """
+        if rounds < 1:
+            raise ValueError("rounds must be at least 1")
+
+        for _ in range(warmup):
+            if setup is not None:
+                setup()
+            func()
+
+        timings: List[float] = []
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            start = perf_counter()
+            result = func()
+            timings.append(perf_counter() - start)
+
+        self.results.add(self.name, summarize(timings))
+        return result
+
+
+def compare(old_path: Path, new_path: Path, threshold: float) -> List[str]:
+    """
+    prints the change in the median time of every benchmark in both files,
+    and returns the names of those that slowed down by more than threshold
+    """
+    old = orjson.loads(old_path.read_bytes())["benchmarks"]
+    new = orjson.loads(new_path.read_bytes())["benchmarks"]
+    regressions: List[str] = []
+    for name in sorted(set(old) & set(new)):
+        old_median = old[name]["median"]
+        new_median = new[name]["median"]
+        change = (new_median - old_median) / old_median if old_median else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  <-- regression"
+        print(
+            f"{name:<60} {old_median * 1e6:>12.1f}us {new_median * 1e6:>12.1f}us "
+            f"{change:>+8.1%}{flag}"
+        )
+    for name in sorted(set(old) ^ set(new)):
+        print(f"{name:<60} only in {'old' if name in old else 'new'} results")
+    return regressions
+
+
+def main() -> None:
+    "compares two benchmark result files"
+    parser = argparse.ArgumentParser(description=compare.__doc__)
+    parser.add_argument("old", type=Path)
+    parser.add_argument("new", type=Path)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fractional slowdown of the median that counts as a regression",
+    )
+    args = parser.parse_args()
+    if compare(args.old, args.new, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,12 @@
 pytest fixtures and testing configuration
 """
 import os
+import socket
+import threading
+import time
 from pathlib import Path
 from random import randint
-from typing import Iterable, Tuple
+from typing import Iterable, List, NamedTuple, Tuple
 from unittest.mock import _SentinelObject as Sentinel
 from unittest.mock import patch, sentinel
 
@@ -15,10 +18,34 @@ from mw_url_shortener.database import get_db, user
 from mw_url_shortener.database.interface import setup_db
 from mw_url_shortener.settings import CommonSettings, DatabaseSettings
 from mw_url_shortener.types import HashedPassword, Username
-from mw_url_shortener.utils import random_username
+from mw_url_shortener.utils import random_username, safe_random_chars
 from mw_url_shortener.utils import unsafe_random_chars as random_string
 from mw_url_shortener.utils import unsafe_random_hashed_password
 
+from .benchmark import Benchmark, BenchmarkResults
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    "adds the option that enables the benchmarks"
+    parser.addoption(
+        "--benchmark-json",
+        metavar="PATH",
+        default=None,
+        help="run the benchmarks, and write their results to PATH as JSON",
+    )
+
+
+def pytest_collection_modifyitems(
+    config: pytest.Config, items: List[pytest.Item]
+) -> None:
+    "the benchmarks are slow, so they're skipped unless asked for"
+    if config.getoption("--benchmark-json"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="needs --benchmark-json to run")
+    for item in items:
+        if item.get_closest_marker("benchmark"):
+            item.add_marker(skip_benchmark)
+
 
 @pytest.fixture
 def database(tmp_path: Path) -> Database:
@@ -99,3 +126,81 @@ def clear_settings_cache() -> Iterable[None]:
     """
     with patch("mw_url_shortener.settings._settings", new=None):
         yield None
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(request: pytest.FixtureRequest) -> Iterable[BenchmarkResults]:
+    "collects the benchmark results, and writes them out at the end of the session"
+    results = BenchmarkResults()
+    yield results
+    path = request.config.getoption("--benchmark-json")
+    if path and results.benchmarks:
+        results.write(Path(path))
+
+
+@pytest.fixture
+def benchmark(
+    request: pytest.FixtureRequest, benchmark_results: BenchmarkResults
+) -> Benchmark:
+    "times a function, recording the result under the name of the test"
+    return Benchmark(name=request.node.name, results=benchmark_results)
+
+
+class LiveApi(NamedTuple):
+    "where a running API server is, and a user that can log in to it"
+    server_url: str
+    api_key: str
+    username: Username
+    password: str
+
+
+@pytest.fixture
+def live_api(database: Database) -> Iterable[LiveApi]:
+    """
+    runs the API, backed by the test database, on a free local port, for
+    clients that need a real socket
+    """
+    import uvicorn
+    from fastapi import Depends, FastAPI
+
+    from mw_url_shortener.api.authentication import authorize, hash_password
+    from mw_url_shortener.api.main import api_router_v1
+    from mw_url_shortener.settings import ServerSettings
+
+    password = safe_random_chars(8)
+    # basic authentication only encodes latin-1 usernames
+    username = Username("live_user")
+    user.create(
+        db=database,
+        user=user.Model(username=username, hashed_password=hash_password(password)),
+    )
+    api_key = safe_random_chars(8)
+    app = FastAPI()
+    app.state.db = database
+    with db_session:
+        database_file = database.provider.pool.filename
+    app.state.settings = ServerSettings(
+        database_file=database_file, api_key=api_key, sync_users=[username]
+    )
+    app.include_router(
+        api_router_v1, prefix=f"/{api_key}/v1", dependencies=[Depends(authorize)]
+    )
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield LiveApi(
+        server_url=f"http://127.0.0.1:{port}",
+        api_key=api_key,
+        username=username,
+        password=password,
+    )
+    server.should_exit = True
+    thread.join()
@@ -0,0 +1,199 @@
+"""
+tests the redirects part of the API
+"""
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pony.orm import Database
+
+from mw_url_shortener.api import redirects as redirects_api
+from mw_url_shortener.api.authentication import hash_password
+from mw_url_shortener.database import redirect, user
+from mw_url_shortener.settings import ServerSettings
+from mw_url_shortener.types import PlainPassword, Username
+
+from .utils import random_uri
+
+
+def test_owned_redirects(database: Database) -> None:
+    "are redirects made through the API owned by, and listed for, their user"
+    password = PlainPassword("password")
+    api_user = user.create(
+        db=database,
+        user=user.Model(
+            # basic authentication only encodes latin-1 usernames
+            username=Username("api_user"),
+            hashed_password=hash_password(password),
+            redirect_quota=3,
+        ),
+    )
+    redirect.create(db=database, uri=random_uri())
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(database_file=":memory:", api_key="apikey")
+    app.include_router(redirects_api.router_v1, prefix="/redirects")
+    client = TestClient(app)
+    client.auth = (api_user.username, password)
+
+    for key in ["c", "a", "b"]:
+        response = client.post("/redirects/", json={"key": key, "uri": random_uri()})
+        assert response.status_code == 200
+        assert response.json()["owner"] == api_user.username
+    response = client.post("/redirects/", json={"key": "d", "uri": random_uri()})
+    assert response.status_code == 403
+    response = client.post("/redirects/", json={"key": "a", "uri": random_uri()})
+    assert response.status_code == 409
+
+    first_page = client.get("/redirects/", params={"limit": 2}).json()
+    assert [found["key"] for found in first_page] == ["a", "b"]
+    next_page = client.get("/redirects/", params={"limit": 2, "after": "b"}).json()
+    assert [found["key"] for found in next_page] == ["c"]
+
+    client.auth = (api_user.username, "wrong")
+    assert client.get("/redirects/").status_code == 401
+
+
+def test_tail_changes(database: Database) -> None:
+    "can a cache follow the changes to redirects through the API"
+    password = PlainPassword("password")
+    sync_user = user.create(
+        db=database,
+        user=user.Model(
+            username=Username("sync_user"), hashed_password=hash_password(password)
+        ),
+    )
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(
+        database_file=":memory:", api_key="apikey", sync_users=[sync_user.username]
+    )
+    app.include_router(redirects_api.router_v1, prefix="/redirects")
+    client = TestClient(app)
+    client.auth = (sync_user.username, password)
+    created = [redirect.create(db=database, uri=random_uri()) for _ in range(3)]
+
+    cache = {}
+    cursor = 0
+    while True:
+        changes = client.get(
+            "/redirects/changes", params={"after": cursor, "limit": 2}
+        ).json()
+        if not changes:
+            break
+        for change in changes:
+            cache[(change["host"], change["key"])] = change["uri"]
+        cursor = changes[-1]["sequence"]
+    assert cache == {(found.host, found.key): found.uri for found in created}
+
+    redirect.delete(db=database, redirect=created[0])
+    (change,) = client.get("/redirects/changes", params={"after": cursor}).json()
+    assert change["operation"] == "delete"
+    assert change["key"] == created[0].key
+
+
+def test_changes_sync_users_only(database: Database) -> None:
+    "can a user that isn't a sync user not read other users' changes, or redirects"
+    password = PlainPassword("password")
+    first, second = [
+        user.create(
+            db=database,
+            user=user.Model(
+                username=Username(name), hashed_password=hash_password(password)
+            ),
+        )
+        for name in ["first_user", "second_user"]
+    ]
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(database_file=":memory:", api_key="apikey")
+    app.include_router(redirects_api.router_v1, prefix="/redirects")
+    client = TestClient(app)
+    client.auth = (first.username, password)
+    response = client.post("/redirects/", json={"key": "a", "uri": random_uri()})
+    assert response.status_code == 200
+
+    client.auth = (second.username, password)
+    response = client.get("/redirects/changes")
+    assert response.status_code == 403
+    assert "uri" not in response.text
+    assert client.get("/redirects/snapshot").status_code == 403
+    # not even for their own redirects
+    client.auth = (first.username, password)
+    assert client.get("/redirects/changes").status_code == 403
+    client.auth = (second.username, "wrong")
+    assert client.get("/redirects/changes").status_code == 401
+
+
+def test_bulk_create(database: Database) -> None:
+    "does each redirect in a bulk create get its own result"
+    password = PlainPassword("password")
+    api_user = user.create(
+        db=database,
+        user=user.Model(
+            username=Username("bulk_user"),
+            hashed_password=hash_password(password),
+            redirect_quota=3,
+        ),
+    )
+    taken = redirect.create(db=database, uri=random_uri())
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(database_file=":memory:", api_key="apikey")
+    app.include_router(redirects_api.router_v1, prefix="/redirects")
+    client = TestClient(app)
+    client.auth = (api_user.username, password)
+
+    new_redirects = [
+        {"key": "a", "uri": random_uri()},
+        {"key": taken.key, "uri": random_uri()},
+        {"uri": random_uri()},
+        {"key": "b", "uri": random_uri()},
+        {"key": "c", "uri": random_uri()},
+    ]
+    results = client.post("/redirects/bulk", json=new_redirects).json()
+    assert [result["status"] for result in results] == [200, 409, 200, 200, 403]
+    assert results[0]["redirect"]["owner"] == api_user.username
+    assert results[2]["redirect"]["key"]
+    assert results[1]["redirect"] is None and results[1]["detail"]
+    assert redirect.count(db=database, username=api_user.username) == 3
+
+    too_many = [{"uri": random_uri()}] * (redirects_api.MAX_BULK_CREATE + 1)
+    assert client.post("/redirects/bulk", json=too_many).status_code == 413
+
+
+def test_create_unserved_host(database: Database) -> None:
+    "are redirects only made on hosts the server answers for"
+    password = PlainPassword("password")
+    api_user = user.create(
+        db=database,
+        user=user.Model(
+            username=Username("host_user"), hashed_password=hash_password(password)
+        ),
+    )
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(
+        database_file=":memory:", api_key="apikey", domains=["a.test"]
+    )
+    app.include_router(redirects_api.router_v1, prefix="/redirects")
+    client = TestClient(app)
+    client.auth = (api_user.username, password)
+
+    for host, expected in [("c.test", 400), ("A.test", 200), ("*", 200)]:
+        response = client.post(
+            "/redirects/", json={"host": host, "key": "k", "uri": random_uri()}
+        )
+        assert response.status_code == expected, host
+    new_redirects = [
+        {"host": "c.test", "uri": random_uri()},
+        {"host": "a.test", "uri": random_uri()},
+    ]
+    results = client.post("/redirects/bulk", json=new_redirects).json()
+    assert [result["status"] for result in results] == [400, 200]
+    assert results[1]["redirect"]["host"] == "a.test"
+
+    # without domains, every request uses DEFAULT_HOST
+    app.state.settings = app.state.settings.copy(update={"domains": []})
+    response = client.post(
+        "/redirects/", json={"host": "a.test", "key": "j", "uri": random_uri()}
+    )
+    assert response.status_code == 400
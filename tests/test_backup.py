@@ -0,0 +1,140 @@
+"""
+tests snapshots of the live database
+"""
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from mw_url_shortener.database import backup, integrity
+from mw_url_shortener.database.backup import (
+    backup_database,
+    list_snapshots,
+    rotate_snapshots,
+)
+from mw_url_shortener.database.errors import BackupError
+from mw_url_shortener.types import IntegrityCheck
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(sqlite3.Connection, "backup"),
+    reason="the backup API needs Python 3.7 or later",
+)
+
+
+def make_database(path: Path, rows: int = 2000) -> Path:
+    "makes a database file spread over many pages"
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute("CREATE TABLE t (value TEXT)")
+        connection.executemany(
+            "INSERT INTO t VALUES (?)", [(f"value {n}" * 5,) for n in range(rows)]
+        )
+    connection.close()
+    return path
+
+
+def count_rows(path: Path) -> int:
+    "how many rows a database made by make_database has"
+    connection = sqlite3.connect(str(path))
+    (rows,) = connection.execute("SELECT count(*) FROM t").fetchone()
+    connection.close()
+    return int(rows)
+
+
+def test_backup(tmp_path: Path) -> None:
+    "is a snapshot, copied a few pages at a time, a complete database"
+    path = make_database(tmp_path / "live.sqlitedb")
+    snapshot = backup_database(path, pages_per_step=4, step_delay=0)
+
+    assert snapshot.parent == tmp_path / "backups"
+    assert snapshot.name.startswith("live-")
+    assert list_snapshots(path) == [snapshot]
+    assert count_rows(snapshot) == 2000
+    assert integrity.run_check(snapshot, IntegrityCheck.full)
+    assert not list(snapshot.parent.glob("*.partial"))
+
+
+def test_backup_during_writes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    "is a snapshot taken while the database is being written to consistent"
+    path = make_database(tmp_path / "live.sqlitedb")
+    writes = []
+
+    def write_between_steps(delay: float) -> None:
+        "adds a row from another connection, as a server would"
+        connection = sqlite3.connect(str(path))
+        with connection:
+            connection.execute("INSERT INTO t VALUES ('new')")
+        connection.close()
+        writes.append(delay)
+
+    monkeypatch.setattr(backup.time, "sleep", write_between_steps)
+    snapshot = backup_database(path, pages_per_step=4, max_restarts=2)
+
+    # each write started the backup over, until it gave up and copied the rest
+    assert len(writes) > 2
+    assert count_rows(snapshot) == count_rows(path)
+
+
+def test_rotate_snapshots(tmp_path: Path) -> None:
+    "are only the newest snapshots kept"
+    path = make_database(tmp_path / "live.sqlitedb", rows=10)
+    directory = tmp_path / "elsewhere"
+    snapshots = [
+        backup_database(path, directory=directory, keep=3, step_delay=0)
+        for _ in range(5)
+    ]
+    assert list_snapshots(path, directory) == snapshots[-3:]
+    assert rotate_snapshots(path, directory, keep=1) == snapshots[-3:-1]
+    assert list_snapshots(path, directory) == snapshots[-1:]
+    with pytest.raises(ValueError):
+        rotate_snapshots(path, directory, keep=0)
+
+
+def test_failed_verify(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    "is a snapshot that fails its check thrown away"
+    path = make_database(tmp_path / "live.sqlitedb", rows=10)
+    run_check = integrity.run_check
+
+    def failing_run_check(path: Path, level: IntegrityCheck) -> bool:
+        "only the live database passes"
+        return path.suffix != ".partial" and run_check(path, level)
+
+    monkeypatch.setattr(integrity, "run_check", failing_run_check)
+    with pytest.raises(BackupError):
+        backup_database(path, step_delay=0)
+    assert not list((tmp_path / "backups").iterdir())
+
+
+def test_not_a_database(tmp_path: Path) -> None:
+    "is a file that isn't a database refused"
+    path = tmp_path / "live.sqlitedb"
+    path.write_bytes(b"not a database")
+    with pytest.raises(BackupError):
+        backup_database(path)
+    assert not (tmp_path / "backups").exists()
+
+
+def test_backup_command(tmp_path: Path) -> None:
+    "does the backup subcommand print the path of a new snapshot"
+    path = make_database(tmp_path / "live.sqlitedb", rows=10)
+    directory = tmp_path / "snapshots"
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            str(path),
+            "backup",
+            "--directory",
+            str(directory),
+            "--verify",
+            "full",
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert list_snapshots(path, directory) == [Path(output.strip())]
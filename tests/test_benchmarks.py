@@ -0,0 +1,177 @@
+"""
+benchmarks for the hot paths: redirect lookup, creation, and authentication
+
+these are skipped unless --benchmark-json is given; see tests/benchmark.py
+"""
+import itertools
+import random
+import string
+from typing import Iterable, List
+
+import pytest
+from fastapi import FastAPI
+from fastapi.security import HTTPBasicCredentials
+from fastapi.testclient import TestClient
+from pony.orm import Database, db_session
+
+from mw_url_shortener.api.authentication import authorize, hash_password
+from mw_url_shortener.database import redirect, user
+from mw_url_shortener.server import app_router
+from mw_url_shortener.settings import DatabaseSettings, ServerSettings
+from mw_url_shortener.types import Key, KeyNormalization, PlainPassword
+from mw_url_shortener.utils import safe_key_chars, safe_keys
+
+from .benchmark import Benchmark
+from .utils import all_combinations, fake, random_redirect, random_uri, random_username
+
+pytestmark = pytest.mark.benchmark
+
+KEY_CHARACTERS = string.ascii_letters + string.digits
+
+
+@pytest.fixture(autouse=True)
+def seed_random() -> None:
+    "makes each benchmark use the same data on every run"
+    random.seed(0)
+    fake.seed_instance(0)
+
+
+def add_redirects(db: Database, number: int) -> List[redirect.Model]:
+    "adds a number of random redirects, in a single transaction"
+    redirects = [random_redirect() for _ in range(number)]
+    with db_session:
+        for new_redirect in redirects:
+            db.RedirectEntity(key=new_redirect.key, uri=new_redirect.uri)
+    return redirects
+
+
+def fill_keyspace(db: Database, length: int, fraction: float) -> int:
+    """
+    adds redirects for a fraction of all of the keys of a length, in a single
+    transaction, and returns the number added
+    """
+    all_keys = list(all_combinations(KEY_CHARACTERS, length))
+    chosen_keys = random.sample(all_keys, int(len(all_keys) * fraction))
+    uri = random_uri()
+    with db_session:
+        for key in chosen_keys:
+            db.RedirectEntity(key=key, uri=uri)
+    return len(chosen_keys)
+
+
+def test_get_redirect(database: Database, benchmark: Benchmark) -> None:
+    "looking up existing keys in a table of 1000 redirects"
+    keys = itertools.cycle([r.key for r in add_redirects(database, 1000)])
+    benchmark(lambda: redirect.get(db=database, key=next(keys)), rounds=1000)
+
+
+def test_get_redirect_missing(database: Database, benchmark: Benchmark) -> None:
+    "looking up keys that don't exist in a table of 1000 redirects"
+    add_redirects(database, 1000)
+
+    def get_missing() -> None:
+        with pytest.raises(redirect.RedirectNotFoundError):
+            redirect.get(db=database, key=Key("-missing-"))
+
+    benchmark(get_missing, rounds=1000)
+
+
+def test_create_redirect(database: Database, benchmark: Benchmark) -> None:
+    "creating redirects with a given key"
+    new_redirects = iter([random_redirect() for _ in range(210)])
+    benchmark(
+        lambda: redirect.create(db=database, redirect=next(new_redirects)),
+        rounds=200,
+    )
+
+
+def test_create_redirect_auto_key(database: Database, benchmark: Benchmark) -> None:
+    "creating redirects with a generated key"
+    uris = iter([random_uri() for _ in range(210)])
+    benchmark(lambda: redirect.create(db=database, uri=next(uris)), rounds=200)
+
+
+def test_get_redirect_variant(database: Database, benchmark: Benchmark) -> None:
+    "looking up keys with a trailing slash in a table of 1000 redirects"
+    keys = itertools.cycle([r.key for r in add_redirects(database, 1000)])
+    benchmark(
+        lambda: redirect.get(
+            db=database,
+            key=Key(f"{next(keys)}/"),
+            normalization=KeyNormalization.lenient,
+        ),
+        rounds=1000,
+    )
+
+
+def test_find_by_uri(database: Database, benchmark: Benchmark) -> None:
+    "finding the keys for a uri in a table of 1000 redirects"
+    uris = itertools.cycle([r.uri for r in add_redirects(database, 1000)])
+    benchmark(lambda: redirect.find_by_uri(db=database, uri=next(uris)), rounds=1000)
+
+
+@pytest.mark.parametrize("fraction", [0.0, 0.25, 0.5, 0.75, 0.9])
+def test_new_redirect_key(
+    database: Database, benchmark: Benchmark, fraction: float
+) -> None:
+    "generating a new two-character key, with a fraction of the keyspace taken"
+    fill_keyspace(database, length=2, fraction=fraction)
+    benchmark(
+        lambda: redirect.new_key(db=database, length=2, duplicate_threshold=10_000),
+        rounds=500,
+    )
+
+
+def test_safe_keys(benchmark: Benchmark) -> None:
+    "generating 1000 six-character keys at once"
+    benchmark(lambda: safe_keys(length=6, number=1000), rounds=200)
+
+
+def test_safe_key_chars(benchmark: Benchmark) -> None:
+    "generating one six-character key"
+    benchmark(lambda: safe_key_chars(6), rounds=10_000)
+
+
+@pytest.mark.parametrize("number", [10, 1000])
+def test_list_redirects(database: Database, benchmark: Benchmark, number: int) -> None:
+    "listing every redirect"
+    add_redirects(database, number)
+    redirects = benchmark(lambda: redirect.list(db=database), rounds=20)
+    assert len(redirects) == number
+
+
+def test_authorize(database: Database, benchmark: Benchmark) -> None:
+    "authenticating a user with the correct password"
+    password = PlainPassword(fake.password())
+    new_user = user.create(
+        db=database,
+        user=user.Model(
+            username=random_username(), hashed_password=hash_password(password)
+        ),
+    )
+    credentials = HTTPBasicCredentials(username=new_user.username, password=password)
+    found_user = benchmark(
+        lambda: authorize(db=database, credentials=credentials), rounds=10, warmup=1
+    )
+    assert found_user == new_user
+
+
+def test_get_key_end_to_end(
+    database: Database,
+    correct_database_settings: DatabaseSettings,
+    benchmark: Benchmark,
+) -> None:
+    "requesting GET /{key} from the redirect server, through an ASGI test client"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(
+        **correct_database_settings.dict(), api_key="benchmark"
+    )
+    app.include_router(app_router)
+    client = TestClient(app)
+    keys = itertools.cycle([r.key for r in add_redirects(database, 1000)])
+
+    response = benchmark(
+        lambda: client.get(f"/{next(keys)}", allow_redirects=False), rounds=500
+    )
+    assert response.status_code == 307
@@ -0,0 +1,185 @@
+"""
+tests the API client's connection pool, batching, and retries
+"""
+import asyncio
+import http.client
+import threading
+from typing import Any, List
+
+import pytest
+from pony.orm import Database
+
+from mw_url_shortener import client as client_module
+from mw_url_shortener.client import ApiClient, AsyncApiClient, ClientError, Retry
+from mw_url_shortener.database import redirect
+
+from .conftest import LiveApi
+from .utils import random_uri
+
+NO_WAIT = Retry(backoff=0)
+
+
+def api_client(live_api: LiveApi, **kwargs: Any) -> ApiClient:
+    return ApiClient(
+        server_url=live_api.server_url,
+        api_key=live_api.api_key,
+        username=live_api.username,
+        password=live_api.password,
+        **kwargs,
+    )
+
+
+def count_bulk_requests(monkeypatch: pytest.MonkeyPatch) -> List[int]:
+    "records the size of each bulk create a client sends"
+    sizes: List[int] = []
+    create_batch = ApiClient._create_batch
+
+    def counting(self: ApiClient, new_redirects: List[Any]) -> Any:
+        sizes.append(len(new_redirects))
+        return create_batch(self, new_redirects)
+
+    monkeypatch.setattr(ApiClient, "_create_batch", counting)
+    return sizes
+
+
+def test_connections_reused(live_api: LiveApi) -> None:
+    "do requests in a row share one connection"
+    with api_client(live_api) as client:
+        for _ in range(5):
+            assert client.list_redirects() == []
+        assert len(client._pool._idle) == 1
+
+
+def test_create_many(database: Database, live_api: LiveApi) -> None:
+    "are redirects made in chunks, with a result for each"
+    taken = redirect.create(db=database, uri=random_uri())
+    new_redirects = [redirect.NewModel(uri=random_uri()) for _ in range(4)] + [
+        redirect.NewModel(key=taken.key, uri=random_uri())
+    ]
+    with api_client(live_api, batch_size=2) as client:
+        results = client.create_many(new_redirects)
+    assert [result.status for result in results] == [200, 200, 200, 200, 409]
+    assert all(result.redirect.owner == live_api.username for result in results[:4])
+    assert len(redirect.list(db=database)) == 5
+
+
+def test_shorten_batches(
+    database: Database, live_api: LiveApi, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    "are shorten() calls from many threads sent together"
+    sizes = count_bulk_requests(monkeypatch)
+    uris = [random_uri() for _ in range(20)]
+    created = {}
+    with api_client(live_api, batch_size=8, max_delay=0.05) as client:
+
+        def shorten(uri: str) -> None:
+            created[uri] = client.shorten(uri)
+
+        threads = [threading.Thread(target=shorten, args=(uri,)) for uri in uris]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with pytest.raises(ClientError) as error:
+            client.shorten(random_uri(), key=created[uris[0]].key)
+    assert error.value.status == 409
+    assert sum(sizes) == 21
+    assert len(sizes) < 10
+    assert {uri: found.uri for uri, found in created.items()} == {
+        uri: uri for uri in uris
+    }
+    assert len(redirect.list(db=database)) == 20
+
+
+def test_async_client(database: Database, live_api: LiveApi) -> None:
+    "does the async client batch shorten() calls from many tasks"
+
+    async def run() -> List[Any]:
+        async with AsyncApiClient(
+            server_url=live_api.server_url,
+            api_key=live_api.api_key,
+            username=live_api.username,
+            password=live_api.password,
+            batch_size=5,
+        ) as client:
+            created = await asyncio.gather(
+                *(client.shorten(random_uri()) for _ in range(12))
+            )
+            listed = await client.list_redirects(limit=1000)
+            changes = await client.changes()
+        return [created, listed, changes]
+
+    created, listed, changes = asyncio.get_event_loop().run_until_complete(run())
+    assert sorted(created, key=lambda found: found.key) == listed
+    assert len(changes) == 12
+    assert len(redirect.list(db=database)) == 12
+
+
+def test_retry_unavailable(live_api: LiveApi, monkeypatch: pytest.MonkeyPatch) -> None:
+    "are requests retried while the server is briefly unavailable"
+    responses = [(503, b'{"detail": "busy"}'), (502, b"")]
+    request = client_module.ConnectionPool.request
+
+    def flaky(self: Any, *args: Any) -> Any:
+        if responses:
+            return responses.pop(0)
+        return request(self, *args)
+
+    monkeypatch.setattr(client_module.ConnectionPool, "request", flaky)
+    with api_client(live_api, retry=NO_WAIT) as client:
+        assert client.changes() == []
+
+        responses.extend([(502, b"")])
+        # the server may have made the redirects
+        with pytest.raises(ClientError) as error:
+            client.create_many([redirect.NewModel(uri=random_uri())])
+        assert error.value.status == 502
+
+        responses.extend([(503, b"")] * 4)
+        with pytest.raises(ClientError) as error:
+            client.changes()
+        assert error.value.status == 503
+
+
+def test_retry_stale_connection(live_api: LiveApi) -> None:
+    "is a create retried on a new connection when an idle one was closed"
+    with api_client(live_api, retry=NO_WAIT) as client:
+        client.list_redirects()
+        (idle,) = client._pool._idle
+        # as if the server had closed it
+        idle.sock.close()
+        (result,) = client.create_many([redirect.NewModel(uri=random_uri())])
+    assert result.status == 200
+
+
+def test_unreachable() -> None:
+    "is a server that isn't running reported"
+    with pytest.raises(ClientError) as error:
+        with ApiClient(
+            "http://127.0.0.1:1", "key", "user", "password", retry=NO_WAIT
+        ) as client:
+            client.changes()
+    assert error.value.status is None
+    with pytest.raises(ValueError):
+        ApiClient("ftp://127.0.0.1", "key", "user", "password")
+
+
+def test_pool_limit(live_api: LiveApi) -> None:
+    "are no more connections opened than allowed"
+    opened = []
+    connection_class = http.client.HTTPConnection
+
+    class Counting(connection_class):  # type: ignore
+        def connect(self) -> None:
+            opened.append(self)
+            super().connect()
+
+    with api_client(live_api, max_connections=2) as client:
+        client._pool._connection_class = Counting
+        threads = [threading.Thread(target=client.list_redirects) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert 1 <= len(opened) <= 2
@@ -196,7 +196,7 @@ def test_write_dotenv_no_args(
     config.write_dotenv()
     # Delete settings from the database
     with db_session:
-        database.ConfigEntity["current"].delete()
+        database.CurrentConfigEntity["current"].delete()
         database.commit()
     # Delete settings from the environment
     del os.environ[env_names.class_name]
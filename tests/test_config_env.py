@@ -118,6 +118,17 @@ def test_set_and_get_env(
     assert returned_settings == correct_settings
 
 
+def test_get_env_cached(correct_settings: CommonSettings) -> None:
+    "is the environment only parsed again when it changes"
+    config.set_env(correct_settings)
+    first_settings = config.get_env()
+    assert config.get_env() is first_settings
+
+    changed_settings = correct_settings.copy(update={"env_file": None})
+    config.set_env(changed_settings)
+    assert config.get_env() == changed_settings
+
+
 @pytest.mark.xfail
 def test_set_env_bad_types(monkeypatch: pytest.MonkeyPatch) -> None:
     "does set_env raise an error when the arguments are the wrong types"
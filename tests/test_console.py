@@ -0,0 +1,60 @@
+"""
+tests the command-line interface
+"""
+import subprocess
+import sys
+from typing import Set
+
+# These take most of the startup time, and aren't needed to parse arguments
+HEAVY_MODULES = ["pydantic", "pony", "fastapi", "passlib", "uvicorn", "questionary"]
+
+
+def imported_modules(code: str) -> Set[str]:
+    "the top-level packages imported by running code in a new interpreter"
+    completed = subprocess.run(
+        [sys.executable, "-c", code + "\nimport sys; print(' '.join(sys.modules))"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return {name.split(".")[0] for name in completed.stdout.split()}
+
+
+def test_console_skips_heavy_imports() -> None:
+    "does importing the command-line interface leave the heavy libraries alone"
+    loaded = imported_modules("import mw_url_shortener.console")
+    for module in HEAVY_MODULES:
+        assert module not in loaded, f"{module} is imported by console"
+
+
+def test_lazy_password_context() -> None:
+    "is passlib only imported once the password context is used"
+    assert "passlib" not in imported_modules("import mw_url_shortener.utils")
+    loaded = imported_modules(
+        "from mw_url_shortener.utils import password_context\n"
+        "assert password_context.identify(password_context.hash('a')) == 'bcrypt'"
+    )
+    assert "passlib" in loaded
+
+
+def test_version_skips_heavy_imports() -> None:
+    "does --version avoid importing the libraries only subcommands need"
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.argv = ['mw_url_shortener', '--version']\n"
+            "from mw_url_shortener.console import main\n"
+            "try:\n"
+            "    main()\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(' '.join(sys.modules))",
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    loaded = {name.split(".")[0] for name in completed.stdout.split()}
+    for module in HEAVY_MODULES:
+        assert module not in loaded, f"{module} is imported by --version"
@@ -4,8 +4,18 @@ import pydantic
 import pytest
 from pony.orm import Database, db_session
 
-from mw_url_shortener.database.config import get_config, save_config
+from mw_url_shortener.database import get_db
+from mw_url_shortener.database.config import (
+    current_config_version,
+    diff_config_versions,
+    get_config,
+    get_config_version,
+    list_config_versions,
+    rollback_config,
+    save_config,
+)
 from mw_url_shortener.database.errors import BadConfigInDBError
+from mw_url_shortener.database.interface import setup_db
 from mw_url_shortener.settings import CommonSettings
 
 from .utils import random_json
@@ -35,10 +45,11 @@ def test_load_bad_config(database: Database) -> None:
         CommonSettings.parse_raw(example_bad_json)
 
     with db_session:
-        database.ConfigEntity(
-            version="current", json=example_bad_json, class_name=CommonSettings.__name__
+        bad_config = database.ConfigEntity(
+            json=example_bad_json, class_name=CommonSettings.__name__
         )
-        database.commit()
+        database.flush()
+        database.CurrentConfigEntity(name="current", version=bad_config.version)
 
     with pytest.raises(BadConfigInDBError) as err:
         get_config(db=database)
@@ -72,3 +83,98 @@ def test_save_bad_config_bad_types() -> None:
 def test_get_bad_class_name() -> None:
     "is an error raised when the class name is not a settings class"
     raise NotImplementedError
+
+
+def test_config_cached(database: Database, correct_settings: CommonSettings) -> None:
+    "is the same settings object returned while nothing has changed"
+    save_config(db=database, new_settings=correct_settings)
+    first_settings = get_config(db=database)
+    assert get_config(db=database) is first_settings
+    assert get_config(db=database, max_age=0) is first_settings
+
+
+def test_config_cache_sees_other_connections(
+    database: Database, correct_settings: CommonSettings
+) -> None:
+    "are changes committed by a different connection picked up"
+    save_config(db=database, new_settings=correct_settings)
+    assert get_config(db=database) == correct_settings
+
+    with db_session:
+        database_file_name = database.provider.pool.filename
+    other_database = setup_db(db=get_db(), filename=database_file_name)
+    changed_settings = correct_settings.copy(update={"env_file": None})
+    assert changed_settings != correct_settings
+    with db_session:
+        current_version = other_database.CurrentConfigEntity["current"].version
+        other_database.ConfigEntity[current_version].json = changed_settings.json()
+
+    # max_age=0 makes get_config check data_version on every call
+    assert get_config(db=database, max_age=0) == changed_settings
+
+
+def test_config_cache_cleared_on_save(
+    database: Database, correct_settings: CommonSettings
+) -> None:
+    "does saving settings clear the cached settings"
+    save_config(db=database, new_settings=correct_settings)
+    get_config(db=database)
+    changed_settings = correct_settings.copy(update={"env_file": None})
+    save_config(db=database, new_settings=changed_settings)
+    assert get_config(db=database) == changed_settings
+
+
+def test_config_history(database: Database, correct_settings: CommonSettings) -> None:
+    "is every saved config kept as a new version"
+    assert list_config_versions(db=database) == []
+    assert current_config_version(db=database) is None
+
+    save_config(db=database, new_settings=correct_settings)
+    changed_settings = correct_settings.copy(update={"env_file": None})
+    save_config(db=database, new_settings=changed_settings)
+
+    first, second = list_config_versions(db=database)
+    assert first.version < second.version
+    assert not first.current and second.current
+    assert first.class_name == second.class_name == CommonSettings.__name__
+    assert first.size == len(correct_settings.json())
+    assert current_config_version(db=database) == second.version
+    assert get_config_version(db=database, version=first.version) == correct_settings
+    assert get_config(db=database) == changed_settings
+
+
+def test_diff_config_versions(
+    database: Database, correct_settings: CommonSettings
+) -> None:
+    "are only the changed settings reported"
+    first = save_config(db=database, new_settings=correct_settings)
+    save_config(db=database, new_settings=first.copy(update={"env_file": None}))
+    old_version, new_version = [v.version for v in list_config_versions(db=database)]
+
+    diff = diff_config_versions(
+        db=database, old_version=old_version, new_version=new_version
+    )
+    assert diff == {"env_file": (str(correct_settings.env_file), None)}
+    assert diff_config_versions(db=database, old_version=1, new_version=1) == {}
+
+    with pytest.raises(ValueError) as err:
+        diff_config_versions(db=database, old_version=old_version, new_version=100)
+    assert "no config version 100" in str(err.value)
+
+
+def test_rollback_config(database: Database, correct_settings: CommonSettings) -> None:
+    "does rolling back make an old version current, without losing history"
+    save_config(db=database, new_settings=correct_settings)
+    changed_settings = correct_settings.copy(update={"env_file": None})
+    save_config(db=database, new_settings=changed_settings)
+    assert get_config(db=database) == changed_settings
+
+    first, second = list_config_versions(db=database)
+    assert rollback_config(db=database, version=first.version) == correct_settings
+    assert get_config(db=database) == correct_settings
+    assert [v.current for v in list_config_versions(db=database)] == [True, False]
+
+    with pytest.raises(ValueError) as err:
+        rollback_config(db=database, version=second.version + 1)
+    assert f"no config version {second.version + 1}" in str(err.value)
+    assert get_config(db=database) == correct_settings
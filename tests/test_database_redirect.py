@@ -2,20 +2,32 @@
 tests the redirect part of the database interface
 """
 import string
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 
 import pytest
-from pony.orm import Database
+from pony.orm import Database, db_session, select
 
-from mw_url_shortener.database import redirect
+from mw_url_shortener.database import redirect, user
 from mw_url_shortener.database.redirect import (
     DuplicateKeyError,
     DuplicateThresholdError,
     Key,
     RedirectNotFoundError,
+    RedirectQuotaError,
     Uri,
 )
-
-from .utils import all_combinations, random_key, random_redirect, random_uri
+from mw_url_shortener.types import ChangeOperation, KeyNormalization, Username
+from mw_url_shortener.utils import DEFAULT_HOST, KEY_CHARACTERS
+
+from .utils import (
+    all_combinations,
+    random_key,
+    random_redirect,
+    random_uri,
+    random_user,
+    random_username,
+)
 
 
 def test_create_redirect(database: Database) -> None:
@@ -72,6 +84,20 @@ def test_new_key_full(database: Database) -> None:
     assert "duplicate threshold of 10 reached" in str(err.value)
 
 
+@pytest.mark.timeout(5)
+def test_new_key_skips_default_host(database: Database) -> None:
+    "are new keys for a domain kept from hiding the keys on DEFAULT_HOST"
+    characters = string.ascii_letters + string.digits
+    example_uri: Uri = random_uri()
+    for character in characters:
+        redirect.create(
+            db=database, redirect=redirect.Model(key=Key(character), uri=example_uri)
+        )
+
+    with pytest.raises(DuplicateThresholdError):
+        redirect.new_key(db=database, length=1, host="sho.rt")
+
+
 @pytest.mark.xfail
 def test_new_key_switch_algorithms() -> None:
     """
@@ -270,3 +296,454 @@ def test_delete_nonmatching_redirect() -> None:
     match what's in the database
     """
     raise NotImplementedError
+
+
+def test_normalized_key_stored(database: Database) -> None:
+    "is the normalized key filled in, however a redirect is added"
+    uri = random_uri()
+    redirect.create(db=database, redirect=redirect.Model(key="Abc/", uri=uri))
+    with db_session:
+        database.RedirectEntity(key="D%45f", uri=uri)
+    with db_session:
+        assert database.RedirectEntity[DEFAULT_HOST, "Abc/"].normalized_key == "abc"
+        assert database.RedirectEntity[DEFAULT_HOST, "D%45f"].normalized_key == "def"
+
+
+@pytest.mark.parametrize(
+    "normalization,found",
+    [
+        (KeyNormalization.exact, {"Abc": "Abc"}),
+        (KeyNormalization.lenient, {"Abc": "Abc", "Abc/": "Abc", "%41bc": "Abc"}),
+        (
+            KeyNormalization.casefold,
+            {"Abc": "Abc", "Abc/": "Abc", "%41bc": "Abc", "ABC/": "Abc", "abc": "Abc"},
+        ),
+    ],
+)
+def test_get_normalized(
+    database: Database, normalization: KeyNormalization, found: dict
+) -> None:
+    "are variants of a key found, depending on the normalization"
+    redirect.create(db=database, redirect=redirect.Model(key="Abc", uri=random_uri()))
+    variants = ["Abc", "Abc/", "%41bc", "ABC/", "abc", "Ab"]
+    for variant in variants:
+        if variant in found:
+            returned_redirect = redirect.get(
+                db=database, key=Key(variant), normalization=normalization
+            )
+            assert returned_redirect.key == found[variant]
+        else:
+            with pytest.raises(RedirectNotFoundError):
+                redirect.get(db=database, key=Key(variant), normalization=normalization)
+
+
+def test_get_normalized_ambiguous(database: Database) -> None:
+    "is a variant that matches more than one redirect not found"
+    for key in ["abc", "ABC"]:
+        redirect.create(db=database, redirect=redirect.Model(key=key, uri=random_uri()))
+    casefold = KeyNormalization.casefold
+
+    # exact matches still win
+    assert (
+        redirect.get(db=database, key=Key("ABC"), normalization=casefold).key == "ABC"
+    )
+    assert (
+        redirect.get(
+            db=database, key=Key("abc/"), normalization=KeyNormalization.lenient
+        ).key
+        == "abc"
+    )
+    with pytest.raises(RedirectNotFoundError):
+        redirect.get(db=database, key=Key("Abc"), normalization=casefold)
+
+
+def test_find_by_uri(database: Database) -> None:
+    "are all of the redirects to a uri found, and only those"
+    uri, other_uri = random_uri(), random_uri()
+    for key in ["b", "a", "c"]:
+        redirect.create(db=database, redirect=redirect.Model(key=key, uri=uri))
+    redirect.create(db=database, redirect=redirect.Model(key="d", uri=other_uri))
+
+    assert [found.key for found in redirect.find_by_uri(db=database, uri=uri)] == [
+        "a",
+        "b",
+        "c",
+    ]
+    assert [r.key for r in redirect.find_by_uri(db=database, uri=uri, limit=1)] == ["a"]
+    assert redirect.find_by_uri(db=database, uri=Uri(f"{uri}/missing")) == []
+
+
+def test_find_by_uri_hash_collision(database: Database) -> None:
+    "are redirects whose uri only shares a hash left out"
+    uri, other_uri = random_uri(), random_uri()
+    redirect.create(db=database, redirect=redirect.Model(key="a", uri=uri))
+    redirect.create(db=database, redirect=redirect.Model(key="b", uri=other_uri))
+    with db_session:
+        # pretend the two uris hash the same; the entity hooks would set it
+        # back, so this is done with SQL
+        uri_hash = database.RedirectEntity[DEFAULT_HOST, "a"].uri_hash
+        database.execute(
+            "UPDATE RedirectEntity SET uri_hash = $uri_hash WHERE key = 'b'"
+        )
+
+    assert [r.key for r in redirect.find_by_uri(db=database, uri=uri)] == ["a"]
+
+
+def test_find_by_uri_after_update(database: Database) -> None:
+    "is a redirect found by its new uri after it's updated"
+    old_redirect = redirect.create(db=database, redirect=random_redirect())
+    new_uri = random_uri()
+    redirect.update(
+        db=database,
+        key=old_redirect.key,
+        updated_redirect=redirect.Model(key=old_redirect.key, uri=new_uri),
+    )
+    assert redirect.find_by_uri(db=database, uri=old_redirect.uri) == []
+    assert redirect.find_by_uri(db=database, uri=new_uri)[0].key == old_redirect.key
+
+
+def test_create_reuse_existing(database: Database) -> None:
+    "does creating a redirect to a known uri return the existing key, if asked"
+    uri = random_uri()
+    first_redirect = redirect.create(db=database, uri=uri, reuse_existing=True)
+    assert redirect.create(db=database, uri=uri, reuse_existing=True) == first_redirect
+
+    new_redirect = redirect.create(db=database, uri=uri)
+    assert new_redirect.key != first_redirect.key
+    assert len(redirect.find_by_uri(db=database, uri=uri)) == 2
+
+
+def past() -> datetime:
+    "a time that's already gone"
+    return datetime.utcnow() - timedelta(minutes=1)
+
+
+def future() -> datetime:
+    "a time that hasn't come yet"
+    return datetime.utcnow() + timedelta(hours=1)
+
+
+def test_expired_redirect_missing(database: Database) -> None:
+    "are expired redirects treated as if they don't exist"
+    uri = random_uri()
+    redirect.create(
+        db=database, redirect=redirect.Model(key="old", uri=uri, expires_at=past())
+    )
+    unexpired = redirect.create(
+        db=database, redirect=redirect.Model(key="new", uri=uri, expires_at=future())
+    )
+    with pytest.raises(RedirectNotFoundError):
+        redirect.get(db=database, key=Key("old"))
+    with pytest.raises(RedirectNotFoundError):
+        redirect.get(
+            db=database, key=Key("OLD"), normalization=KeyNormalization.casefold
+        )
+    assert redirect.get(db=database, key=Key("new")) == unexpired
+    assert redirect.list(db=database) == [unexpired]
+    assert redirect.find_by_uri(db=database, uri=uri) == [unexpired]
+
+
+def test_expired_key_reused(database: Database) -> None:
+    "can the key of an expired redirect be used again"
+    redirect.create(
+        db=database,
+        redirect=redirect.Model(key="a", uri=random_uri(), expires_at=past()),
+    )
+    new_redirect = redirect.Model(key="a", uri=random_uri())
+    assert redirect.create(db=database, redirect=new_redirect) == new_redirect
+    assert redirect.get(db=database, key=Key("a")) == new_redirect
+
+    with pytest.raises(DuplicateKeyError):
+        redirect.create(db=database, redirect=redirect.Model(key="a", uri=random_uri()))
+
+
+def test_new_key_expired(database: Database) -> None:
+    "are the keys of expired redirects handed out again"
+    with db_session:
+        for key in KEY_CHARACTERS:
+            database.RedirectEntity(key=key, uri=random_uri(), expires_at=past())
+    assert len(redirect.new_key(db=database, length=1, duplicate_threshold=0)) == 1
+
+
+def test_reuse_existing_expiry(database: Database) -> None:
+    "is an existing redirect only reused if it lasts long enough"
+    uri = random_uri()
+    soon = datetime.utcnow() + timedelta(minutes=1)
+    existing = redirect.create(db=database, uri=uri, expires_at=soon)
+    assert (
+        redirect.create(db=database, uri=uri, reuse_existing=True, expires_at=soon)
+        == existing
+    )
+    later = redirect.create(
+        db=database, uri=uri, reuse_existing=True, expires_at=future()
+    )
+    assert later.key != existing.key
+    assert redirect.create(db=database, uri=uri, reuse_existing=True).key not in (
+        existing.key,
+        later.key,
+    )
+
+
+def test_update_expiry(database: Database) -> None:
+    "can an expired redirect be given a new expiry time"
+    expired = redirect.create(
+        db=database,
+        redirect=redirect.Model(key="a", uri=random_uri(), expires_at=past()),
+    )
+    renewed = expired.copy(update={"expires_at": future()})
+    assert (
+        redirect.update(db=database, key=Key("a"), updated_redirect=renewed) == renewed
+    )
+    assert redirect.get(db=database, key=Key("a")) == renewed
+
+
+def test_aware_expiry_time() -> None:
+    "are expiry times with a timezone stored as naive UTC"
+    expires_at = datetime(2030, 1, 1, 12, tzinfo=timezone(timedelta(hours=2)))
+    model = redirect.Model(key="a", uri=random_uri(), expires_at=expires_at)
+    assert model.expires_at == datetime(2030, 1, 1, 10)
+
+
+def test_delete_expired(database: Database) -> None:
+    "are expired redirects deleted in batches, and unexpired ones kept"
+    with db_session:
+        for number in range(5):
+            database.RedirectEntity(
+                key=f"old{number}", uri=random_uri(), expires_at=past()
+            )
+        database.RedirectEntity(key="new", uri=random_uri(), expires_at=future())
+        database.RedirectEntity(key="forever", uri=random_uri())
+
+    assert redirect.delete_expired(db=database, batch_size=2, max_batches=1) == 2
+    assert redirect.delete_expired(db=database, batch_size=2) == 3
+    assert redirect.delete_expired(db=database) == 0
+    with db_session:
+        assert sorted(select(r.key for r in database.RedirectEntity)) == [
+            "forever",
+            "new",
+        ]
+
+
+def add_owner(database: Database, redirect_quota: Optional[int] = None) -> Username:
+    "adds a user that can own redirects"
+    owner = user.create(
+        db=database, user=random_user().copy(update={"redirect_quota": redirect_quota})
+    )
+    return owner.username
+
+
+def test_owned_redirects(database: Database) -> None:
+    "are an owner's redirects listed in pages, in order of their keys"
+    owner = add_owner(database)
+    other_owner = add_owner(database)
+    keys = [f"k{number:02}" for number in range(7)]
+    for key in reversed(keys):
+        redirect.create(
+            db=database, redirect=redirect.Model(key=key, uri=random_uri(), owner=owner)
+        )
+    redirect.create(
+        db=database,
+        redirect=redirect.Model(key="k", uri=random_uri(), owner=other_owner),
+    )
+    redirect.create(db=database, uri=random_uri())
+
+    pages = []
+    after = None
+    while True:
+        page = redirect.list(
+            db=database, owner=owner, host=DEFAULT_HOST, after=after, limit=3
+        )
+        if not page:
+            break
+        pages.append([found.key for found in page])
+        after = page[-1].key
+    assert pages == [keys[:3], keys[3:6], keys[6:]]
+    assert redirect.count(db=database, username=owner) == 7
+    assert len(redirect.list(db=database)) == 9
+    assert redirect.get(db=database, key=Key("k")).owner == other_owner
+
+    with pytest.raises(user.UserNotFoundError):
+        redirect.list(db=database, owner=random_username())
+    with pytest.raises(user.UserNotFoundError):
+        redirect.create(db=database, uri=random_uri(), owner=random_username())
+
+
+def test_owner_index_used(database: Database) -> None:
+    "does listing an owner's redirects use the (owner, host, key) index"
+    owner = add_owner(database)
+    with db_session:
+        entity = database.RedirectEntity
+        quote = database.provider.quote_name
+        plan = " ".join(
+            str(row[-1])
+            for row in database.execute(
+                f"EXPLAIN QUERY PLAN SELECT {quote(entity.key.column)} "
+                f"FROM {quote(entity._table_)} "
+                f"WHERE {quote(entity.owner.column)} = $owner "
+                f"AND {quote(entity.host.column)} = $DEFAULT_HOST "
+                f"ORDER BY {quote(entity.key.column)}"
+            )
+        )
+    assert "USING" in plan and "INDEX" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_redirect_quota(database: Database) -> None:
+    "can an owner only have as many unexpired redirects as their quota"
+    owner = add_owner(database, redirect_quota=2)
+    expiring = redirect.create(
+        db=database,
+        uri=random_uri(),
+        owner=owner,
+        expires_at=datetime.utcnow() + timedelta(seconds=1),
+    )
+    redirect.create(db=database, uri=random_uri(), owner=owner)
+    with pytest.raises(RedirectQuotaError):
+        redirect.create(db=database, uri=random_uri(), owner=owner)
+
+    # handing a redirect to someone who's full is checked too
+    unowned = redirect.create(db=database, uri=random_uri())
+    with pytest.raises(RedirectQuotaError):
+        redirect.update(
+            db=database,
+            key=unowned.key,
+            updated_redirect=unowned.copy(update={"owner": owner}),
+        )
+
+    # expired redirects don't count
+    redirect.update(
+        db=database,
+        key=expiring.key,
+        updated_redirect=expiring.copy(update={"expires_at": past()}),
+    )
+    assert redirect.count(db=database, username=owner) == 1
+    redirect.create(db=database, uri=random_uri(), owner=owner)
+
+
+def test_move_at_quota(database: Database) -> None:
+    "can an owner at their quota move a redirect to another key, or host"
+    owner = add_owner(database, redirect_quota=1)
+    created = redirect.create(
+        db=database, redirect=redirect.Model(key="a", uri=random_uri(), owner=owner)
+    )
+    renamed = redirect.update(
+        db=database, key=Key("a"), updated_redirect=created.copy(update={"key": "b"})
+    )
+    assert renamed == created.copy(update={"key": "b"})
+    moved = redirect.update(
+        db=database,
+        key=Key("b"),
+        updated_redirect=renamed.copy(update={"host": "a.test"}),
+    )
+    assert moved.host == "a.test"
+    assert redirect.list(db=database) == [moved]
+    assert redirect.count(db=database, username=owner) == 1
+
+    # a move that fails leaves the redirect where it was
+    taken = redirect.create(
+        db=database, redirect=redirect.Model(host="a.test", key="c", uri=random_uri())
+    )
+    with pytest.raises(DuplicateKeyError):
+        redirect.update(
+            db=database,
+            key=Key("b"),
+            host="a.test",
+            updated_redirect=moved.copy(update={"key": taken.key}),
+        )
+    with pytest.raises(RedirectQuotaError):
+        redirect.update(
+            db=database,
+            key=Key("b"),
+            host="a.test",
+            updated_redirect=moved.copy(
+                update={"key": "d", "owner": add_owner(database, redirect_quota=0)}
+            ),
+        )
+    assert redirect.list(db=database, host="a.test") == [moved, taken]
+
+
+def test_hosts(database: Database) -> None:
+    "does each host have its own keys"
+    first = redirect.create(
+        db=database, redirect=redirect.Model(host="a.test", key="k", uri=random_uri())
+    )
+    second = redirect.create(
+        db=database, redirect=redirect.Model(host="B.test.", key="k", uri=random_uri())
+    )
+    assert second.host == "b.test"
+    assert redirect.get(db=database, key=Key("k"), host="a.test") == first
+    assert redirect.get(db=database, key=Key("k"), host="b.test") == second
+    assert (
+        redirect.get(
+            db=database,
+            key=Key("K"),
+            host="b.test",
+            normalization=KeyNormalization.casefold,
+        )
+        == second
+    )
+    with pytest.raises(RedirectNotFoundError):
+        redirect.get(db=database, key=Key("k"))
+    with pytest.raises(DuplicateKeyError):
+        redirect.create(db=database, redirect=first.copy(update={"uri": random_uri()}))
+
+    assert redirect.list(db=database) == [first, second]
+    assert redirect.list(db=database, host="b.test") == [second]
+    assert redirect.find_by_uri(db=database, uri=first.uri, host="b.test") == []
+
+    moved = redirect.update(
+        db=database,
+        key=Key("k"),
+        host="a.test",
+        updated_redirect=first.copy(update={"host": "c.test"}),
+    )
+    assert moved.host == "c.test"
+    assert redirect.list(db=database, host="a.test") == []
+    redirect.delete(db=database, redirect=moved)
+    assert redirect.list(db=database) == [second]
+
+    with pytest.raises(TypeError):
+        redirect.list(db=database, after=Key("k"))
+
+
+def test_change_log(database: Database) -> None:
+    "is every change to a redirect logged, in order"
+    first = redirect.create(db=database, redirect=redirect.Model(key="a", uri="u:1"))
+    redirect.update(
+        db=database, key=Key("a"), updated_redirect=first.copy(update={"uri": "u:2"})
+    )
+    moved = redirect.update(
+        db=database, key=Key("a"), updated_redirect=first.copy(update={"key": "b"})
+    )
+    redirect.delete(db=database, redirect=moved)
+
+    changes = redirect.changes(db=database)
+    assert [(change.operation, change.key, change.uri) for change in changes] == [
+        (ChangeOperation.create, "a", "u:1"),
+        (ChangeOperation.update, "a", "u:2"),
+        (ChangeOperation.create, "b", "u:1"),
+        (ChangeOperation.delete, "a", None),
+        (ChangeOperation.delete, "b", None),
+    ]
+    sequences = [change.sequence for change in changes]
+    assert sequences == sorted(set(sequences))
+
+    # tailing from a cursor
+    assert redirect.changes(db=database, after=sequences[1], limit=2) == changes[2:4]
+    assert redirect.changes(db=database, after=sequences[-1]) == []
+
+
+def test_change_log_rolled_back(database: Database) -> None:
+    "is a change that fails left out of the log"
+    created = redirect.create(db=database, redirect=random_redirect())
+    with pytest.raises(DuplicateKeyError):
+        redirect.create(db=database, redirect=created)
+    with pytest.raises(RedirectQuotaError):
+        owner = user.create(
+            db=database, user=random_user().copy(update={"redirect_quota": 0})
+        )
+        redirect.create(
+            db=database,
+            redirect=random_redirect().copy(update={"owner": owner.username}),
+        )
+    assert [change.key for change in redirect.changes(db=database)] == [created.key]
@@ -0,0 +1,164 @@
+"""
+tests the out-of-line storage of long uris
+"""
+import base64
+import os
+
+from pony.orm import Database, db_session
+
+from mw_url_shortener.database import redirect, uris
+from mw_url_shortener.database.interface import (
+    compress_long_uris,
+    train_uri_dictionary,
+)
+from mw_url_shortener.database.uris import LONG_URI_THRESHOLD, train_dictionary
+from mw_url_shortener.types import Key, Uri
+from mw_url_shortener.utils import DEFAULT_HOST
+from mw_url_shortener.utils import unsafe_random_chars as random_string
+
+
+def tracking_uri() -> Uri:
+    "makes a long uri, with the kind of repetition tracking links have"
+    parameters = "&".join(
+        f"utm_{name}={random_string(8)}"
+        for name in ["source", "medium", "campaign", "term", "content"] * 8
+    )
+    return Uri(f"https://shop.example.com/products/{random_string(10)}?{parameters}")
+
+
+def long_uri_rows(database: Database) -> int:
+    "how many uris are stored out of line"
+    with db_session:
+        return database.LongUriEntity.select().count()
+
+
+def test_short_uri_inline(database: Database) -> None:
+    "are short uris kept in the redirect table"
+    uri = Uri("https://example.com/")
+    redirect.create(db=database, redirect=redirect.Model(key="a", uri=uri))
+    assert long_uri_rows(database) == 0
+    with db_session:
+        assert database.RedirectEntity[DEFAULT_HOST, "a"].uri == uri
+
+
+def test_long_uri_round_trip(database: Database) -> None:
+    "are long uris stored compressed and out of line, and read back unchanged"
+    uri = tracking_uri()
+    assert len(uri) > LONG_URI_THRESHOLD
+    redirect.create(db=database, redirect=redirect.Model(key="a", uri=uri))
+
+    with db_session:
+        redirect_entity = database.RedirectEntity[DEFAULT_HOST, "a"]
+        assert redirect_entity.uri == ""
+        long_uri = database.LongUriEntity[redirect_entity.long_uri_id]
+        assert long_uri.compressed
+        assert len(long_uri.data) < len(uri)
+
+    assert redirect.get(db=database, key=Key("a")).uri == uri
+    assert [found.uri for found in redirect.list(db=database)] == [uri]
+    assert [found.key for found in redirect.find_by_uri(db=database, uri=uri)] == ["a"]
+
+
+def test_data_uri(database: Database) -> None:
+    "is a random data uri, which barely compresses, stored and read back"
+    data = base64.b64encode(os.urandom(LONG_URI_THRESHOLD)).decode()
+    uri = Uri(f"data:application/octet-stream;base64,{data}")
+    redirect.create(db=database, redirect=redirect.Model(key="a", uri=uri))
+    with db_session:
+        (long_uri,) = database.LongUriEntity.select()[:]
+        assert len(long_uri.data) <= len(uri)
+    assert redirect.get(db=database, key=Key("a")).uri == uri
+
+
+def test_update_and_delete_long_uri(database: Database) -> None:
+    "are out of line uris replaced and removed along with their redirect"
+    redirect.create(db=database, redirect=redirect.Model(key="a", uri=tracking_uri()))
+    new_uri = tracking_uri()
+    redirect.update(
+        db=database, key=Key("a"), updated_redirect=redirect.Model(key="a", uri=new_uri)
+    )
+    assert long_uri_rows(database) == 1
+    assert redirect.get(db=database, key=Key("a")).uri == new_uri
+    assert redirect.find_by_uri(db=database, uri=new_uri)[0].key == "a"
+
+    short_uri = Uri("https://example.com/")
+    redirect.update(
+        db=database,
+        key=Key("a"),
+        updated_redirect=redirect.Model(key="a", uri=short_uri),
+    )
+    assert long_uri_rows(database) == 0
+    assert redirect.find_by_uri(db=database, uri=short_uri)[0].key == "a"
+
+    redirect.update(
+        db=database, key=Key("a"), updated_redirect=redirect.Model(key="b", uri=new_uri)
+    )
+    assert long_uri_rows(database) == 1
+    redirect.delete(db=database, redirect=redirect.get(db=database, key=Key("b")))
+    assert long_uri_rows(database) == 0
+
+
+def test_train_dictionary() -> None:
+    "does a trained dictionary contain the pieces uris share"
+    dictionary = train_dictionary([tracking_uri() for _ in range(20)])
+    assert b"shop.example.com/" in dictionary
+    assert b"utm_campaign=" in dictionary
+    assert train_dictionary(["https://a.test/", "https://b.test/"]) == b"https:/"
+    assert train_dictionary([]) == b""
+
+
+def test_dictionary_compression(database: Database) -> None:
+    "do uris compressed with a trained dictionary take less space"
+    for number in range(20):
+        redirect.create(
+            db=database, redirect=redirect.Model(key=str(number), uri=tracking_uri())
+        )
+    dictionary_id = train_uri_dictionary(db=database)
+    assert dictionary_id is not None
+
+    uri = tracking_uri()
+    redirect.create(db=database, redirect=redirect.Model(key="new", uri=uri))
+    with db_session:
+        without_dictionary = database.LongUriEntity[
+            database.RedirectEntity[DEFAULT_HOST, "0"].long_uri_id
+        ]
+        with_dictionary = database.LongUriEntity[
+            database.RedirectEntity[DEFAULT_HOST, "new"].long_uri_id
+        ]
+        assert without_dictionary.dictionary_id is None
+        assert with_dictionary.dictionary_id == dictionary_id
+        assert len(with_dictionary.data) < len(without_dictionary.data)
+
+    # uris compressed with and without the dictionary are both still readable
+    assert redirect.get(db=database, key=Key("new")).uri == uri
+    assert len(redirect.list(db=database)) == 21
+
+
+def test_train_without_long_uris(database: Database) -> None:
+    "is no dictionary made when there are no long uris"
+    assert train_uri_dictionary(db=database) is None
+
+
+def test_compress_long_uris(database: Database) -> None:
+    "are long uris added straight to the redirect table moved out of it"
+    long_uris = [tracking_uri() for _ in range(5)]
+    with db_session:
+        for number, uri in enumerate(long_uris):
+            database.RedirectEntity(key=str(number), uri=uri)
+        database.RedirectEntity(key="short", uri="https://example.com/")
+        # fewer characters than the threshold, but more bytes
+        long_uris.append("https://example.com/" + "é" * (LONG_URI_THRESHOLD // 2))
+        database.RedirectEntity(key="5", uri=long_uris[-1])
+
+    assert compress_long_uris(db=database, batch_size=2) == 6
+    assert long_uri_rows(database) == 6
+    assert compress_long_uris(db=database) == 0
+    for number, uri in enumerate(long_uris):
+        assert redirect.get(db=database, key=Key(str(number))).uri == uri
+        assert redirect.find_by_uri(db=database, uri=uri)[0].key == str(number)
+
+
+def test_uncompressed_fallback(database: Database) -> None:
+    "is data that compressing makes bigger kept as it is"
+    with db_session:
+        assert uris._pack(database, "x1") == (b"x1", False, None)
@@ -4,7 +4,7 @@ tests the user part of the database interface
 import pytest
 from pony.orm import Database
 
-from mw_url_shortener.database import user
+from mw_url_shortener.database import redirect, user
 from mw_url_shortener.database.user import (
     DatabaseError,
     HashedPassword,
@@ -12,7 +12,7 @@ from mw_url_shortener.database.user import (
     UserNotFoundError,
 )
 
-from .utils import random_hashed_password, random_user, random_username
+from .utils import random_hashed_password, random_uri, random_user, random_username
 
 
 def test_create_user(database: Database) -> None:
@@ -206,3 +206,19 @@ def test_delete_nonmatching_user() -> None:
     match what's in the database
     """
     raise NotImplementedError
+
+
+def test_rename_user_keeps_redirects(database: Database) -> None:
+    "does a renamed user still own their redirects, and keep their quota"
+    old_user = user.create(
+        db=database, user=random_user().copy(update={"redirect_quota": 5})
+    )
+    owned_redirect = redirect.create(
+        db=database, uri=random_uri(), owner=old_user.username
+    )
+    new_user = old_user.copy(update={"username": random_username()})
+    user.update(db=database, username=old_user.username, updated_user=new_user)
+
+    assert user.get(db=database, username=new_user.username).redirect_quota == 5
+    assert redirect.get(db=database, key=owned_redirect.key).owner == new_user.username
+    assert redirect.count(db=database, username=new_user.username) == 1
@@ -0,0 +1,273 @@
+"""
+tests the streaming export of redirects and users
+"""
+import csv
+import gzip
+import lzma
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator, List, Tuple
+
+import orjson
+import pytest
+from pony.orm import Database, db_session
+
+from mw_url_shortener.database import export, get_db, redirect, user
+from mw_url_shortener.database.export import (
+    REDIRECT_FIELDS,
+    USER_FIELDS,
+    export_redirects,
+    export_users,
+    guess_format,
+)
+from mw_url_shortener.database.interface import setup_db
+from mw_url_shortener.types import Compression, ExportFormat, Key
+
+from .test_database_uris import tracking_uri
+from .utils import random_redirect, random_user
+
+
+@pytest.fixture
+def redirects(database: Database) -> List[redirect.Model]:
+    "fills the database with a mix of redirects, and their owner"
+    owner = user.create(db=database, user=random_user())
+    created = [
+        redirect.create(db=database, redirect=random_redirect()) for _ in range(20)
+    ]
+    created.append(
+        redirect.create(
+            db=database, redirect=redirect.Model(key="long", uri=tracking_uri())
+        )
+    )
+    created.append(
+        redirect.create(
+            db=database,
+            redirect=redirect.Model(
+                host="sho.rt",
+                key="owned",
+                uri="https://example.com/",
+                expires_at=datetime(2100, 1, 2, 3, 4, 5, 6000),
+                owner=owner.username,
+            ),
+        )
+    )
+    # expired redirects are still exported
+    created.append(
+        redirect.create(
+            db=database,
+            redirect=redirect.Model(
+                key="old",
+                uri="https://example.com/old",
+                expires_at=datetime.utcnow() - timedelta(days=1),
+            ),
+        )
+    )
+    return sorted(created, key=lambda found: (found.host, found.key))
+
+
+def test_guess_format() -> None:
+    "are the format and compression read from the file name"
+    assert guess_format("r.jsonl.gz") == (ExportFormat.jsonl, Compression.gzip)
+    assert guess_format("r.csv.xz") == (ExportFormat.csv, Compression.xz)
+    assert guess_format("r.csv") == (ExportFormat.csv, Compression.none)
+    assert guess_format("r.sqlitedb") == (ExportFormat.sqlite, Compression.none)
+    assert guess_format("r") == (ExportFormat.jsonl, Compression.none)
+
+
+def test_export_jsonl(
+    database: Database, redirects: List[redirect.Model], tmp_path: Path
+) -> None:
+    "are redirects written as compressed JSON lines, in chunks"
+    output = tmp_path / "redirects.jsonl.gz"
+    assert export_redirects(database, output, chunk_size=3) == len(redirects)
+
+    with gzip.open(output) as file:
+        lines = [orjson.loads(line) for line in file]
+    assert [redirect.Model(**line) for line in lines] == redirects
+    assert all(tuple(line) == REDIRECT_FIELDS for line in lines)
+
+
+def test_export_unlocked_between_chunks(
+    database: Database,
+    redirects: List[redirect.Model],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    "can another connection write to the database while each chunk is written"
+    locked = []
+    write_jsonl = export._write_jsonl
+
+    def lock_each(chunks: Iterator[List[Any]]) -> Iterator[List[Any]]:
+        for rows in chunks:
+            # an exclusive lock can't be had while any reader holds one
+            writer = sqlite3.connect(database.provider.pool.filename, timeout=0)
+            try:
+                writer.execute("BEGIN EXCLUSIVE")
+                writer.rollback()
+            finally:
+                writer.close()
+            locked.append(len(rows))
+            yield rows
+
+    def checked(
+        chunks: Iterator[List[Any]], fields: Tuple[str, ...], file: BinaryIO
+    ) -> int:
+        return write_jsonl(lock_each(chunks), fields, file)
+
+    monkeypatch.setattr(export, "_write_jsonl", checked)
+    output = tmp_path / "redirects.jsonl"
+    assert export_redirects(database, output, chunk_size=5) == len(redirects)
+    assert locked == [5, 5, 5, 5, 3]
+    lines = [orjson.loads(line) for line in output.read_bytes().splitlines()]
+    assert [redirect.Model(**line) for line in lines] == redirects
+
+
+def test_export_csv(
+    database: Database, redirects: List[redirect.Model], tmp_path: Path
+) -> None:
+    "are redirects written as CSV, with a header row"
+    output = tmp_path / "redirects.out"
+    written = export_redirects(
+        database,
+        output,
+        export_format=ExportFormat.csv,
+        compression=Compression.xz,
+        chunk_size=7,
+    )
+    assert written == len(redirects)
+
+    with lzma.open(output, "rt", encoding="utf-8", newline="") as file:
+        rows = list(csv.DictReader(file))
+    assert tuple(rows[0]) == REDIRECT_FIELDS
+    assert [
+        redirect.Model(**{name: value for name, value in row.items() if value != ""})
+        for row in rows
+    ] == redirects
+
+
+def test_export_sqlite(
+    database: Database, redirects: List[redirect.Model], tmp_path: Path
+) -> None:
+    "can a server use a SQLite export of the users and redirects"
+    output = tmp_path / "export.sqlitedb"
+    users = user.list(db=database)
+    assert export_users(database, output, chunk_size=1) == len(users)
+    assert export_redirects(database, output, chunk_size=4) == len(redirects)
+
+    exported = setup_db(db=get_db(), filename=output)
+    assert user.list(db=exported) == users
+    unexpired = [found for found in redirects if found.key != "old"]
+    assert redirect.list(db=exported) == unexpired
+    # the columns pony fills in were filled in too
+    found = redirect.get(db=exported, key=Key("LONG/"), normalization="casefold")
+    assert redirect.find_by_uri(db=exported, uri=found.uri) == [found]
+    assert redirect.count(db=exported, username=users[0].username) == 1
+
+    with pytest.raises(ValueError):
+        export_redirects(database, output, compression=Compression.gzip)
+
+
+def test_export_sqlite_again(
+    database: Database, redirects: List[redirect.Model], tmp_path: Path
+) -> None:
+    "does exporting into the same SQLite file again replace what's there"
+    output = tmp_path / "export.sqlitedb"
+    export_users(database, output)
+    export_redirects(database, output)
+    changed = redirect.update(
+        db=database,
+        key=redirects[0].key,
+        host=redirects[0].host,
+        updated_redirect=redirects[0].copy(update={"uri": "https://example.com/new"}),
+    )
+    assert export_users(database, output) == 1
+    assert export_redirects(database, output) == len(redirects)
+
+    exported = setup_db(db=get_db(), filename=output)
+    assert len(user.list(db=exported)) == 1
+    assert redirect.get(db=exported, key=changed.key, host=changed.host) == changed
+    assert len(redirect.list(db=exported)) == len(redirects) - 1
+
+
+def test_export_users_jsonl(database: Database, tmp_path: Path) -> None:
+    "are users written with their hashed passwords and quotas"
+    users = [user.create(db=database, user=random_user()) for _ in range(5)]
+    output = tmp_path / "users.jsonl"
+    assert export_users(database, output) == 5
+
+    lines = [orjson.loads(line) for line in output.read_bytes().splitlines()]
+    assert all(tuple(line) == USER_FIELDS for line in lines)
+    exported = {line["username"]: user.Model(**line) for line in lines}
+    assert exported == {found.username: found for found in users}
+
+
+def test_export_empty(database: Database, tmp_path: Path) -> None:
+    "is an empty table exported as an empty file"
+    output = tmp_path / "redirects.csv"
+    assert export_redirects(database, output) == 0
+    assert output.read_bytes() == b"host,key,uri,expires_at,owner\r\n"
+
+
+def test_export_command(
+    database: Database, redirects: List[redirect.Model], tmp_path: Path
+) -> None:
+    "does the export subcommand write the files it's given"
+    with db_session:
+        database_file = database.provider.pool.filename
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            database_file,
+            "export",
+            "--redirects",
+            str(tmp_path / "redirects.jsonl.bz2"),
+            "--users",
+            str(tmp_path / "users.csv"),
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert f"exported {len(redirects)} redirects" in output
+    assert "exported 1 users" in output
+    assert (tmp_path / "redirects.jsonl.bz2").read_bytes().startswith(b"BZh")
+
+
+def test_export_command_error(
+    database: Database, redirects: List[redirect.Model], tmp_path: Path
+) -> None:
+    "is an export the database refuses reported without a traceback"
+    with db_session:
+        database_file = database.provider.pool.filename
+    output = tmp_path / "export.sqlitedb"
+    export_redirects(database, output)
+    connection = sqlite3.connect(str(output))
+    connection.execute(
+        'CREATE TRIGGER refuse BEFORE INSERT ON "RedirectEntity" '
+        "BEGIN SELECT RAISE(ABORT, 'refused'); END"
+    )
+    connection.close()
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            database_file,
+            "export",
+            "--redirects",
+            str(output),
+        ],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert completed.returncode != 0
+    assert "could not export redirects" in completed.stderr
+    assert "refused" in completed.stderr
+    assert "Traceback" not in completed.stderr
@@ -0,0 +1,118 @@
+"""
+tests the tiered database file checks
+"""
+import sqlite3
+from functools import partial
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+from mw_url_shortener.database import get_db, integrity
+from mw_url_shortener.database.integrity import cached_result, check_database_file
+from mw_url_shortener.database.interface import set_database_file_and_connect
+from mw_url_shortener.types import IntegrityCheck
+
+
+def make_database(path: Path, rows: int = 2000) -> Path:
+    "makes a database file spread over many pages"
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute("CREATE TABLE t (value TEXT)")
+        connection.execute("CREATE INDEX t_value ON t (value)")
+        connection.executemany(
+            "INSERT INTO t VALUES (?)", [(f"value {n}" * 5,) for n in range(rows)]
+        )
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def checks(monkeypatch: pytest.MonkeyPatch) -> List[IntegrityCheck]:
+    "records the thorough checks that are actually run"
+    run_check = integrity._run_check
+    levels: List[IntegrityCheck] = []
+
+    def recording_run_check(path: Path, level: IntegrityCheck) -> Tuple[bool, bool]:
+        if level != IntegrityCheck.header:
+            levels.append(level)
+        return run_check(path, level)
+
+    monkeypatch.setattr(integrity, "_run_check", recording_run_check)
+    return levels
+
+
+def test_header_check(tmp_path: Path) -> None:
+    "are empty files, and SQLite files, accepted, and other files refused"
+    empty = tmp_path / "empty.sqlitedb"
+    empty.touch()
+    assert check_database_file(empty)
+    assert check_database_file(make_database(tmp_path / "real.sqlitedb"))
+    assert not check_database_file(tmp_path / "missing.sqlitedb")
+
+    not_sqlite = tmp_path / "not.sqlitedb"
+    not_sqlite.write_bytes(b"not a database" * 100)
+    assert not check_database_file(not_sqlite)
+    with pytest.raises(ValueError):
+        set_database_file_and_connect(db=get_db(), filename=not_sqlite)
+
+
+def test_check_cached(tmp_path: Path, checks: List[IntegrityCheck]) -> None:
+    "is a thorough check only repeated once the database changes"
+    path = make_database(tmp_path / "db.sqlitedb")
+    assert check_database_file(path, level=IntegrityCheck.quick)
+    assert check_database_file(path, level=IntegrityCheck.quick)
+    assert checks == [IntegrityCheck.quick]
+    assert cached_result(path).level == IntegrityCheck.quick
+
+    # a quick check doesn't stand in for a full one, but a full one does for
+    # a quick one
+    assert check_database_file(path, level=IntegrityCheck.full)
+    assert check_database_file(path, level=IntegrityCheck.quick)
+    assert checks == [IntegrityCheck.quick, IntegrityCheck.full]
+
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute("INSERT INTO t VALUES ('new')")
+    connection.close()
+    assert cached_result(path) is None
+    assert check_database_file(path, level=IntegrityCheck.quick)
+    assert checks[-1] == IntegrityCheck.quick and len(checks) == 3
+
+
+def test_corrupt_database(tmp_path: Path) -> None:
+    "does a thorough check find damage the header check can't"
+    path = make_database(tmp_path / "db.sqlitedb")
+    data = bytearray(path.read_bytes())
+    page_size = int.from_bytes(data[16:18], "big")
+    # scribbles over every page but the first, which holds the schema
+    for page in range(page_size, len(data), page_size):
+        data[page + 8 : page + 64] = b"\xff" * 56
+    path.write_bytes(bytes(data))
+
+    assert check_database_file(path)
+    assert not check_database_file(path, level=IntegrityCheck.quick)
+    assert cached_result(path).ok is False
+    # the failure is remembered for every level
+    assert not check_database_file(path, level=IntegrityCheck.full)
+
+
+def test_locked_database_not_saved(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, checks: List[IntegrityCheck]
+) -> None:
+    "is a check that couldn't run because of a lock tried again, not saved"
+    path = make_database(tmp_path / "db.sqlitedb")
+    # don't wait for the lock
+    monkeypatch.setattr(sqlite3, "connect", partial(sqlite3.connect, timeout=0))
+    holder = sqlite3.connect(str(path), isolation_level=None)
+    holder.execute("BEGIN EXCLUSIVE")
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            check_database_file(path, level=IntegrityCheck.quick)
+    finally:
+        holder.execute("ROLLBACK")
+        holder.close()
+    assert cached_result(path) is None
+
+    assert check_database_file(path, level=IntegrityCheck.quick)
+    assert checks == [IntegrityCheck.quick, IntegrityCheck.quick]
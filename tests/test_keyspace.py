@@ -0,0 +1,187 @@
+"""
+tests the key-space occupancy analyzer
+"""
+import subprocess
+import sys
+
+import orjson
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pony.orm import Database, db_session
+
+from mw_url_shortener.api import keyspace as keyspace_api
+from mw_url_shortener.database.keyspace import (
+    analyze_keyspace,
+    count_keys,
+    failure_probability,
+)
+from mw_url_shortener.settings import DatabaseSettings, ServerSettings
+from mw_url_shortener.utils import KEY_CHARACTERS
+from mw_url_shortener.utils import unsafe_random_chars as random_string
+
+from .utils import all_combinations, random_uri
+
+
+def add_keys(db: Database, *keys: str) -> None:
+    "adds redirects with these keys, in a single transaction"
+    uri = random_uri()
+    with db_session:
+        for key in keys:
+            db.RedirectEntity(key=key, uri=uri)
+
+
+def test_count_keys(database: Database) -> None:
+    "are keys counted by length, and split by alphabet"
+    add_keys(database, "a", "b", "ab", "abc", "a-c", "é", "long/path")
+    used, other = count_keys(db=database, batch_size=2)
+    assert used == {1: 2, 2: 1, 3: 1}
+    assert other == {1: 1, 3: 1, 9: 1}
+
+
+def test_count_keys_per_host(database: Database) -> None:
+    "does a domain count its own keys, and the ones it falls back to, once each"
+    add_keys(database, "a", "b", "x-y")
+    with db_session:
+        for key in ["abc", "a", "é"]:
+            database.RedirectEntity(host="sho.rt", key=key, uri=random_uri())
+        database.RedirectEntity(host="other.test", key="zz", uri=random_uri())
+    assert count_keys(db=database) == ({1: 2}, {3: 1})
+    assert count_keys(db=database, host="sho.rt", batch_size=2) == (
+        {1: 2, 3: 1},
+        {1: 1, 3: 1},
+    )
+    report = analyze_keyspace(db=database, key_length=1, host="other.test")
+    assert report.total == 4
+
+
+def test_empty_keyspace(database: Database) -> None:
+    "is nothing recommended for an empty database"
+    report = analyze_keyspace(db=database, key_length=3)
+    assert report.total == 0
+    (length,) = report.lengths
+    assert length.length == 3
+    assert length.capacity == len(KEY_CHARACTERS) ** 3
+    assert length.failure_probability == 0
+    assert length.expected_attempts == 1
+    assert not report.raise_key_length
+
+
+def test_full_keyspace(database: Database) -> None:
+    "is a full key length reported as certain to fail"
+    add_keys(database, *KEY_CHARACTERS)
+    report = analyze_keyspace(db=database, key_length=1)
+    (length,) = report.lengths
+    assert length.occupancy == 1
+    assert length.failure_probability == 1
+    assert length.expected_attempts is None
+    assert length.remaining == 0
+    assert report.raise_key_length
+    assert report.recommended_key_length == 2
+
+
+def test_recommendation(database: Database) -> None:
+    "is raising key_length recommended once failure becomes likely"
+    alphabet = "ab"
+    # half of the 2-character keys, and all of the 1-character keys
+    add_keys(database, "a", "b", "aa", "ab")
+    report = analyze_keyspace(
+        db=database,
+        key_length=1,
+        duplicate_threshold=2,
+        max_failure_probability=0.2,
+        alphabet=alphabet,
+    )
+    lengths = {length.length: length for length in report.lengths}
+    assert lengths[2].failure_probability == failure_probability(2, 4, 2) == 0.125
+    assert lengths[2].expected_attempts == 2
+    # 0.2 ** (1/3) * 4 is about 2.3, so no more keys fit
+    assert lengths[2].remaining == 0
+    assert report.recommended_key_length == 2
+
+    report = analyze_keyspace(
+        db=database,
+        key_length=2,
+        duplicate_threshold=2,
+        max_failure_probability=0.1,
+        alphabet=alphabet,
+    )
+    assert report.recommended_key_length == 3
+
+
+def test_keyspace_route(
+    database: Database, correct_database_settings: DatabaseSettings
+) -> None:
+    "does the API report the occupancy at the server's key_length"
+    add_keys(database, *all_combinations("ab", 2))
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = ServerSettings(
+        **correct_database_settings.dict(), api_key=random_string(10), key_length=2
+    )
+    app.include_router(keyspace_api.router_v1, prefix="/keyspace")
+    client = TestClient(app)
+
+    report = client.get("/keyspace/").json()
+    assert report["key_length"] == 2
+    assert report["total"] == 4
+    assert report["lengths"][0]["used"] == 4
+    assert not report["raise_key_length"]
+
+    report = client.get("/keyspace/", params={"key_length": 3}).json()
+    assert report["key_length"] == 3
+    assert client.get("/keyspace/", params={"key_length": 0}).status_code == 422
+
+
+@pytest.mark.parametrize("output", ["table", "json"])
+def test_keyspace_command(
+    database: Database, correct_database_settings: DatabaseSettings, output: str
+) -> None:
+    "does the keyspace subcommand recommend raising a full key length"
+    add_keys(database, *KEY_CHARACTERS)
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            str(correct_database_settings.database_file),
+            "keyspace",
+            "--key-length",
+            "1",
+            *(["--json"] if output == "json" else []),
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    if output == "json":
+        assert orjson.loads(completed.stdout)["recommended_key_length"] == 2
+    else:
+        assert "raise key_length to 2" in completed.stdout
+
+
+def test_keyspace_command_host(
+    database: Database, correct_database_settings: DatabaseSettings
+) -> None:
+    "does the keyspace subcommand count a domain's keys, and the ones it falls back to"
+    add_keys(database, "a", "b")
+    with db_session:
+        database.RedirectEntity(host="sho.rt", key="c", uri=random_uri())
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            str(correct_database_settings.database_file),
+            "keyspace",
+            "--host",
+            "Sho.RT",
+            "--json",
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    assert orjson.loads(completed.stdout)["total"] == 3
@@ -0,0 +1,156 @@
+"""
+tests the pieces of the load generator that don't need a running server, and
+reporting a server that fails to start
+"""
+import asyncio
+import sqlite3
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from mw_url_shortener.loadtest import (
+    LevelResult,
+    existing_keys,
+    free_port,
+    percentile,
+    populate_database,
+    run_level,
+    saturation_point,
+    start_server,
+    wait_for_server,
+    zipf_sampler,
+)
+from mw_url_shortener.types import Key
+
+
+def level(concurrency: int, throughput: float) -> LevelResult:
+    "makes an example result"
+    return LevelResult(
+        concurrency=concurrency,
+        requests=int(throughput),
+        errors=0,
+        duration=1.0,
+        throughput=throughput,
+        p50=0.001,
+        p99=0.002,
+        p999=0.003,
+    )
+
+
+def test_zipf_sampler() -> None:
+    "is the most popular key drawn far more often than the least popular"
+    keys = [Key(str(number)) for number in range(100)]
+    sample = zipf_sampler(keys, s=1.1)(20_000)
+    assert set(sample) <= set(keys)
+    counts = Counter(sample).most_common()
+    # with s=1.1, rank 1 is drawn about 100**1.1 (~158) times as often as rank 100
+    assert counts[0][1] > 20 * counts[-1][1]
+
+
+@pytest.mark.parametrize("s", [0, -1])
+def test_zipf_sampler_bad_exponent(s: float) -> None:
+    "is an error raised for exponents that aren't positive"
+    with pytest.raises(ValueError) as err:
+        zipf_sampler([Key("a")], s=s)
+    assert "the Zipf exponent must be positive" in str(err.value)
+
+
+def test_percentile() -> None:
+    "are nearest-rank percentiles picked from the sorted latencies"
+    ordered = [float(number) for number in range(1, 1001)]
+    assert percentile(ordered, 0.5) == 500.0
+    assert percentile(ordered, 0.99) == 990.0
+    assert percentile(ordered, 0.999) == 999.0
+    assert percentile([1.0], 0.999) == 1.0
+
+
+def test_saturation_point() -> None:
+    "is the first level to reach the plateau chosen"
+    results = [level(1, 1000), level(2, 1800), level(4, 2000), level(8, 2010)]
+    assert saturation_point(results) == results[2]
+    assert saturation_point([]) is None
+
+
+def test_populate_database(tmp_path: Path) -> None:
+    "can the database be prepopulated and read back"
+    database_file = tmp_path / "loadtest.sqlitedb"
+    keys = populate_database(database_file, 50)
+    assert len(set(keys)) == 50
+    assert sorted(existing_keys(database_file)) == sorted(keys)
+
+
+def test_existing_keys_read_only(tmp_path: Path) -> None:
+    "does reading the keys leave the database's schema alone"
+    database_file = tmp_path / "loadtest.sqlitedb"
+    keys = populate_database(database_file, 5)
+
+    def schema() -> List[object]:
+        connection = sqlite3.connect(str(database_file))
+        try:
+            return [
+                connection.execute("PRAGMA user_version").fetchone(),
+                connection.execute("SELECT * FROM sqlite_master").fetchall(),
+            ]
+        finally:
+            connection.close()
+
+    # as if it were made by an older version, which setup would migrate
+    connection = sqlite3.connect(str(database_file))
+    connection.execute("PRAGMA user_version = 1")
+    connection.close()
+    before = schema()
+    assert sorted(existing_keys(database_file)) == sorted(keys)
+    assert schema() == before
+
+
+def test_run_level_quotes_keys() -> None:
+    "are keys that aren't ASCII percent-encoded in the request line"
+    paths: List[bytes] = []
+
+    async def respond(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            paths.append(request_line.split(b" ")[1])
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            writer.write(
+                b"HTTP/1.1 307 Temporary Redirect\r\nContent-Length: 0\r\n\r\n"
+            )
+        writer.close()
+
+    async def run() -> LevelResult:
+        server = await asyncio.start_server(respond, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await run_level("127.0.0.1", port, [Key("é/ü"), Key("a b")], 1, 0.05)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert result.errors == 0 and result.requests > 0
+    assert set(paths) == {b"/%C3%A9/%C3%BC", b"/a%20b"}
+
+
+def test_server_start_failure(tmp_path: Path) -> None:
+    "is the reason a server couldn't start reported"
+    port = free_port("127.0.0.1")
+    with tempfile.TemporaryFile() as server_log:
+        server = start_server(
+            tmp_path / "missing.sqlitedb", "127.0.0.1", port, stderr=server_log
+        )
+        with pytest.raises(RuntimeError) as error:
+            wait_for_server("127.0.0.1", port, server=server, stderr=server_log)
+    assert "server exited with status" in str(error.value)
+    assert "missing.sqlitedb" in str(error.value)
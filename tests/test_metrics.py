@@ -0,0 +1,120 @@
+"""
+tests the in-process metrics
+"""
+from urllib.request import urlopen
+
+import pytest
+from pony.orm import Database
+
+from mw_url_shortener import metrics
+from mw_url_shortener.database import redirect
+from mw_url_shortener.metrics import Counter, Histogram, timed
+from mw_url_shortener.utils import unsafe_random_chars as random_string
+
+from .utils import random_redirect
+
+
+def random_metric_name() -> str:
+    "metrics are registered globally, so each test needs unique names"
+    return f"test_{random_string(10)}"
+
+
+def test_counter() -> None:
+    "does a counter count, per set of label values"
+    counter = Counter(random_metric_name(), "example", ("result",))
+    counter.inc("hit")
+    counter.inc("hit")
+    counter.inc("miss", amount=3)
+    assert counter.get("hit") == 2
+    assert counter.get("miss") == 3
+    assert counter.get("other") == 0
+
+
+def test_counter_bad_labels() -> None:
+    "is an error raised when the wrong number of label values is given"
+    counter = Counter(random_metric_name(), "example", ("result",))
+    with pytest.raises(ValueError) as err:
+        counter.inc()
+    assert "takes labels (result)" in str(err.value)
+
+
+def test_counter_negative() -> None:
+    "can a counter only go up"
+    counter = Counter(random_metric_name(), "example")
+    with pytest.raises(ValueError) as err:
+        counter.inc(amount=-1)
+    assert "counters can only be incremented" in str(err.value)
+
+
+def test_histogram_buckets() -> None:
+    "are observations counted into cumulative buckets"
+    name = random_metric_name()
+    histogram = Histogram(name, "example", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    assert histogram.count() == 4
+    samples = list(histogram.samples())
+    assert f'{name}_bucket{{le="0.1"}} 2' in samples
+    assert f'{name}_bucket{{le="1.0"}} 3' in samples
+    assert f'{name}_bucket{{le="+Inf"}} 4' in samples
+    assert f"{name}_count 4" in samples
+
+
+def test_histogram_time() -> None:
+    "does the time context manager record an observation"
+    histogram = Histogram(random_metric_name(), "example", ("kind",))
+    with histogram.time("example"):
+        pass
+    assert histogram.count("example") == 1
+
+
+def test_timed() -> None:
+    "does the timed decorator label observations with the function name"
+    histogram = Histogram(random_metric_name(), "example", ("function",))
+
+    @timed(histogram)
+    def example_function(value: int) -> int:
+        "example docstring"
+        return value
+
+    assert example_function(value=1) == 1
+    assert example_function.__doc__ == "example docstring"
+    assert histogram.count("example_function") == 1
+
+
+def test_expose() -> None:
+    "does the exposition text include the HELP and TYPE lines"
+    name = random_metric_name()
+    counter = Counter(name, "example documentation", ("label",))
+    counter.inc('quote"d')
+    text = metrics.expose()
+    assert f"# HELP {name} example documentation\n" in text
+    assert f"# TYPE {name} counter\n" in text
+    assert f'{name}{{label="quote\\"d"}} 1\n' in text
+
+
+def test_database_functions_recorded(database: Database) -> None:
+    "are database interface calls timed, and db_sessions counted"
+    before_count = metrics.DATABASE_SECONDS.count("get_redirect")
+    before_sessions = metrics.DATABASE_SESSIONS.get()
+    created_redirect = redirect.create(db=database, redirect=random_redirect())
+    redirect.get(db=database, key=created_redirect.key)
+    assert metrics.DATABASE_SECONDS.count("create_redirect") >= 1
+    # create_redirect also calls get_redirect, to check for duplicates
+    assert metrics.DATABASE_SECONDS.count("get_redirect") == before_count + 2
+    assert metrics.DATABASE_SESSIONS.get() >= before_sessions + 3
+
+
+def test_http_server() -> None:
+    "are metrics served on a separate port"
+    httpd = metrics.start_http_server(port=0)
+    try:
+        port = httpd.server_address[1]
+        with urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            body = response.read().decode("utf-8")
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert "mw_url_shortener_redirect_requests_total" in body
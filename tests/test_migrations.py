@@ -0,0 +1,238 @@
+"""
+tests upgrading databases made by earlier versions
+"""
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from pony.orm import Database, db_session
+
+from mw_url_shortener.database import get_db, migrations, redirect, user
+from mw_url_shortener.database.config import get_config
+from mw_url_shortener.database.interface import (
+    generate_mapping,
+    set_database_file_and_connect,
+)
+from mw_url_shortener.settings import ServerSettings
+from mw_url_shortener.types import Key, KeyNormalization, Uri
+from mw_url_shortener.utils import DEFAULT_HOST
+
+# The tables, as the first release made them
+FIRST_SCHEMA = """
+CREATE TABLE "RedirectEntity" (
+  "key" TEXT NOT NULL PRIMARY KEY,
+  "uri" TEXT NOT NULL
+);
+CREATE TABLE "UserEntity" (
+  "username" TEXT NOT NULL PRIMARY KEY,
+  "hashed_password" TEXT NOT NULL
+);
+CREATE TABLE "ConfigEntity" (
+  "version" TEXT NOT NULL PRIMARY KEY,
+  "class_name" TEXT NOT NULL,
+  "json" TEXT NOT NULL
+);
+"""
+
+
+def first_database(path: Path, redirects: int = 10) -> Path:
+    "makes a database file with the first tables, and a few rows"
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.executescript(FIRST_SCHEMA)
+        connection.executemany(
+            'INSERT INTO "RedirectEntity" VALUES (?, ?)',
+            [
+                (f"k{number}", f"https://example.com/{number}")
+                for number in range(redirects)
+            ],
+        )
+        connection.execute(
+            'INSERT INTO "UserEntity" VALUES (?, ?)', ("old_user", "hashed")
+        )
+    connection.close()
+    return path
+
+
+def test_new_database(database: Database) -> None:
+    "does a new database start at the newest version"
+    with db_session:
+        assert migrations.schema_version(database) == migrations.LATEST_VERSION
+    assert migrations.pending_migrations(database) == []
+
+
+def test_migrate_first_database(tmp_path: Path) -> None:
+    "is a database made by the first release brought up to date"
+    path = first_database(tmp_path / "old.sqlitedb")
+    settings = ServerSettings(database_file=path, api_key="apikey", key_length=5)
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute(
+            'INSERT INTO "ConfigEntity" VALUES (?, ?, ?)',
+            ("current", "ServerSettings", settings.json()),
+        )
+    connection.close()
+
+    db = set_database_file_and_connect(db=get_db(), filename=path)
+    assert migrations.pending_migrations(db) == migrations.MIGRATIONS
+    applied = migrations.migrate(db, batch_size=3)
+    assert applied == migrations.MIGRATIONS
+    assert migrations.migrate(db) == []
+    generate_mapping(db)
+
+    assert get_config(db=db) == settings
+    assert user.get(db=db, username="old_user").redirect_quota is None
+    old_redirects = redirect.list(db=db)
+    assert [found.key for found in old_redirects] == [f"k{n}" for n in range(10)]
+    assert {found.host for found in old_redirects} == {DEFAULT_HOST}
+    # normalized_key and uri_hash were filled in
+    found = redirect.get(db=db, key=Key("K3/"), normalization=KeyNormalization.casefold)
+    assert found.uri == "https://example.com/3"
+    assert redirect.find_by_uri(db=db, uri=Uri("https://example.com/3")) == [found]
+
+    created = redirect.create(
+        db=db, redirect=redirect.Model(host="sho.rt", key="k3", uri="https://a.test/")
+    )
+    assert redirect.get(db=db, key=Key("k3"), host="sho.rt") == created
+
+
+def test_migrate_during_writes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    "are changes made while a table is being rebuilt kept"
+    path = first_database(tmp_path / "old.sqlitedb", redirects=9)
+    copy_batch = migrations._copy_batch
+    batches = []
+
+    def copy_batch_then_write(*args, **kwargs):
+        "copies a batch, then changes rows from another connection"
+        last_rowid = copy_batch(*args, **kwargs)
+        batches.append(last_rowid)
+        if len(batches) == 1:
+            connection = sqlite3.connect(str(path))
+            with connection:
+                # k0 has been copied, and k8 hasn't yet
+                connection.execute(
+                    "UPDATE \"RedirectEntity\" SET uri = 'https://new/' "
+                    "WHERE key IN ('k0', 'k8')"
+                )
+                connection.execute("DELETE FROM \"RedirectEntity\" WHERE key = 'k1'")
+                connection.execute("DELETE FROM \"RedirectEntity\" WHERE key = 'k7'")
+                connection.execute(
+                    'INSERT INTO "RedirectEntity" (key, uri) '
+                    "VALUES ('added', 'https://added/')"
+                )
+                connection.execute(
+                    "UPDATE \"RedirectEntity\" SET key = 'moved' WHERE key = 'k2'"
+                )
+            connection.close()
+        return last_rowid
+
+    monkeypatch.setattr(migrations, "_copy_batch", copy_batch_then_write)
+    db = set_database_file_and_connect(db=get_db(), filename=path)
+    migrations.migrate(db, batch_size=3)
+    assert len(batches) > 2
+
+    connection = sqlite3.connect(str(path))
+    rows = dict(
+        connection.execute('SELECT key, uri FROM "RedirectEntity" ORDER BY key')
+    )
+    hosts = {row[0] for row in connection.execute('SELECT host FROM "RedirectEntity"')}
+    tables = {
+        row[0]
+        for row in connection.execute("SELECT name FROM sqlite_master")
+        if "migrating" in row[0]
+    }
+    connection.close()
+    assert rows == {
+        "added": "https://added/",
+        "k0": "https://new/",
+        "k3": "https://example.com/3",
+        "k4": "https://example.com/4",
+        "k5": "https://example.com/5",
+        "k6": "https://example.com/6",
+        "k8": "https://new/",
+        "moved": "https://example.com/2",
+    }
+    assert hosts == {DEFAULT_HOST}
+    assert not tables, "the new table and its triggers are gone"
+
+
+def test_newer_database(tmp_path: Path) -> None:
+    "is a database from a newer version refused"
+    path = first_database(tmp_path / "new.sqlitedb")
+    connection = sqlite3.connect(str(path))
+    connection.execute(f"PRAGMA user_version = {migrations.LATEST_VERSION + 1}")
+    connection.close()
+    db = set_database_file_and_connect(db=get_db(), filename=path)
+    with pytest.raises(ValueError):
+        migrations.migrate(db)
+
+
+def test_setup_command(tmp_path: Path) -> None:
+    "does the setup subcommand list, then apply, the migrations"
+    path = first_database(tmp_path / "old.sqlitedb")
+
+    def setup(*arguments: str) -> str:
+        return subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "mw_url_shortener",
+                "--database-file",
+                str(path),
+                "setup",
+                *arguments,
+            ],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout
+
+    assert f"{len(migrations.MIGRATIONS)} migrations to apply" in setup("--dry-run")
+    assert "up to date" in setup("--batch-size", "4")
+    assert "0 migrations to apply" in setup("--dry-run")
+    connection = sqlite3.connect(str(path))
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    connection.close()
+    assert version == migrations.LATEST_VERSION
+
+
+def test_setup_command_new_database(tmp_path: Path) -> None:
+    "does the setup subcommand make a database file that doesn't exist yet"
+    path = tmp_path / "new.sqlitedb"
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "setup",
+            "--database-file",
+            str(path),
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert "up to date" in output
+    connection = sqlite3.connect(str(path))
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    connection.close()
+    assert version == migrations.LATEST_VERSION
+
+    # the directory it goes in has to exist
+    missing = tmp_path / "missing" / "new.sqlitedb"
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "setup",
+            "--database-file",
+            str(missing),
+        ],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert completed.returncode != 0
+    assert "is not a directory" in completed.stderr
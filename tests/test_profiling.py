@@ -0,0 +1,157 @@
+"""
+tests the opt-in profiling hooks
+"""
+import asyncio
+from pathlib import Path
+from typing import Iterable
+
+import orjson
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pony.orm import Database
+
+from mw_url_shortener import profiling
+from mw_url_shortener.api import redirects as redirects_api
+from mw_url_shortener.api.authentication import hash_password
+from mw_url_shortener.database import redirect, user
+from mw_url_shortener.profiling import FileSink, RingBufferSink, profiled
+from mw_url_shortener.types import PlainPassword, Username
+
+from .utils import random_redirect
+
+
+@pytest.fixture(autouse=True)
+def disable_profiling() -> Iterable[None]:
+    "makes sure profiling doesn't leak out of a test"
+    yield None
+    profiling.disable()
+
+
+def test_disabled_by_default(database: Database) -> None:
+    "is nothing recorded until profiling is enabled"
+    sink = RingBufferSink()
+    redirect.create(db=database, redirect=random_redirect())
+    profiling.enable(sink)
+    profiling.disable()
+    redirect.create(db=database, redirect=random_redirect())
+    assert sink.records() == []
+
+
+def test_database_interface_records(database: Database) -> None:
+    "are statements and changed rows recorded for interface functions"
+    sink = RingBufferSink()
+    profiling.enable(sink)
+    redirect.create(db=database, redirect=random_redirect())
+
+    records = {record.name.rsplit(".", 1)[-1]: record for record in sink.records()}
+    assert "get_redirect" in records
+    assert "create_redirect" in records
+    create_record = records["create_redirect"]
+    # the duplicate check, and the insert
+    assert create_record.statements >= 2
+    # the redirect, and its entry in the change log
+    assert create_record.rows_changed == 2
+    assert create_record.wall_time > 0
+    assert records["get_redirect"].rows_changed == 0
+
+
+def test_api_route_records(database: Database) -> None:
+    "are API route handlers recorded, with the interface calls they make"
+    password = PlainPassword("password")
+    api_user = user.create(
+        db=database,
+        user=user.Model(
+            username=Username("profiled_user"), hashed_password=hash_password(password)
+        ),
+    )
+    app = FastAPI()
+    app.state.db = database
+    app.include_router(redirects_api.router_v1, prefix="/redirects")
+    client = TestClient(app)
+    client.auth = (api_user.username, password)
+    sink = RingBufferSink()
+    profiling.enable(sink)
+
+    assert client.get("/redirects/").status_code == 200
+    names = [record.name for record in sink.records()]
+    assert names[-1] == "mw_url_shortener.api.redirects.read"
+    assert "mw_url_shortener.database.interface.list_redirects" in names
+
+
+def test_coroutine_records() -> None:
+    "are coroutine functions still coroutine functions, and recorded"
+    sink = RingBufferSink()
+    profiling.enable(sink, sample_rate=1.0)
+
+    @profiled
+    async def example() -> int:
+        "waits, then answers"
+        await asyncio.sleep(0)
+        return 1
+
+    assert asyncio.iscoroutinefunction(example)
+
+    async def both() -> list:
+        return list(await asyncio.gather(example(), example()))
+
+    assert asyncio.get_event_loop().run_until_complete(both()) == [1, 1]
+    records = sink.records()
+    assert [record.name.rsplit(".", 1)[-1] for record in records] == ["example"] * 2
+    # never sampled, since other coroutines run while one waits
+    assert all(record.report is None for record in records)
+
+
+def test_nested_totals() -> None:
+    "does a block without a database sum up the profiled calls inside it"
+    sink = RingBufferSink()
+    profiling.enable(sink)
+
+    @profiled
+    def inner() -> None:
+        "does nothing"
+
+    with profiling.profile_block("outer"):
+        inner()
+        inner()
+
+    names = [record.name for record in sink.records()]
+    assert names[-1] == "outer"
+    assert len(names) == 3
+
+
+def test_sampled_report() -> None:
+    "are sampled calls run under cProfile"
+    sink = RingBufferSink()
+    profiling.enable(sink, sample_rate=1.0)
+
+    @profiled
+    def example() -> int:
+        "sums some numbers"
+        return sum(range(100))
+
+    assert example() == 4950
+    (record,) = sink.records()
+    assert record.report is not None
+    assert "function calls" in record.report
+
+
+def test_file_sink(tmp_path: Path) -> None:
+    "are records written as lines of JSON"
+    path = tmp_path / "profile.jsonl"
+    profiling.enable(FileSink(path))
+    with profiling.profile_block("first"):
+        pass
+    with profiling.profile_block("second"):
+        pass
+
+    lines = path.read_bytes().splitlines()
+    assert [orjson.loads(line)["name"] for line in lines] == ["first", "second"]
+
+
+@pytest.mark.parametrize("sample_rate", [-0.1, 1.1])
+def test_bad_sample_rate(sample_rate: float) -> None:
+    "is an error raised for sample rates outside of 0 to 1"
+    with pytest.raises(ValueError) as err:
+        profiling.enable(RingBufferSink(), sample_rate=sample_rate)
+    assert "sample_rate must be between 0 and 1" in str(err.value)
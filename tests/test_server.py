@@ -0,0 +1,305 @@
+"""
+tests the redirect server
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any
+from urllib.parse import quote
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+from pony.orm import Database, db_session
+
+from mw_url_shortener import metrics, server
+from mw_url_shortener.database import redirect
+from mw_url_shortener.database.config import save_config
+from mw_url_shortener.server import (
+    app_router,
+    get_settings,
+    install_expiry_sweeper,
+    install_integrity_checker,
+    install_settings_watcher,
+    reload_settings,
+)
+from mw_url_shortener.settings import DatabaseSettings, ServerSettings
+from mw_url_shortener.types import KeyNormalization
+from mw_url_shortener.utils import unsafe_random_chars as random_string
+
+from .utils import (
+    WAIT_TIMEOUT,
+    join_all,
+    random_key,
+    random_redirect,
+    random_uri,
+    wait_until,
+)
+
+
+@pytest.fixture
+def server_settings(correct_database_settings: DatabaseSettings) -> ServerSettings:
+    "makes settings for running a server"
+    return ServerSettings(
+        **correct_database_settings.dict(),
+        api_key=random_string(10),
+        settings_poll_interval=0.05,
+    )
+
+
+@pytest.fixture
+def client(database: Database, server_settings: ServerSettings) -> TestClient:
+    "makes a test client for a redirect server backed by the test database"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = server_settings
+    app.include_router(app_router)
+    return TestClient(app)
+
+
+def test_redirect(database: Database, client: TestClient) -> None:
+    "does a known key redirect to its uri"
+    created_redirect = redirect.create(db=database, redirect=random_redirect())
+    before_count = metrics.REDIRECT_SECONDS.count()
+
+    response = client.get(f"/{created_redirect.key}", allow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == created_redirect.uri
+    assert metrics.REDIRECT_SECONDS.count() == before_count + 1
+
+
+def test_redirect_not_found(client: TestClient) -> None:
+    "does an unknown key return a 404"
+    before_count = metrics.REDIRECT_REQUESTS.get("404")
+
+    response = client.get(f"/{random_key()}", allow_redirects=False)
+    assert response.status_code == 404
+    assert metrics.REDIRECT_REQUESTS.get("404") == before_count + 1
+
+
+@pytest.mark.parametrize(
+    "variant", ["{key}/", "{key}//", "{quoted_key}", "{upper_key}"]
+)
+def test_redirect_variant(
+    database: Database,
+    client: TestClient,
+    server_settings: ServerSettings,
+    variant: str,
+) -> None:
+    "are variants of a key redirected, depending on key_normalization"
+    key = "ab-é"
+    database_redirect = redirect.create(
+        db=database, redirect=redirect.Model(key=key, uri=random_uri())
+    )
+    path = variant.format(key=key, quoted_key=quote(quote(key)), upper_key=key.upper())
+
+    # only the exact key is matched, unless operators opt in
+    response = client.get(f"/{path}", allow_redirects=False)
+    assert response.status_code == 404
+
+    client.app.state.settings = server_settings.copy(
+        update={"key_normalization": KeyNormalization.lenient}
+    )
+    response = client.get(f"/{path}", allow_redirects=False)
+    if variant == "{upper_key}":
+        assert response.status_code == 404
+    else:
+        assert response.status_code == 307
+        assert response.headers["location"] == database_redirect.uri
+
+    client.app.state.settings = server_settings.copy(
+        update={"key_normalization": KeyNormalization.casefold}
+    )
+    response = client.get(f"/{path}", allow_redirects=False)
+    assert response.status_code == 307
+
+
+def test_redirect_coalesced(
+    database: Database, client: TestClient, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    "do concurrent requests for one key share a database lookup"
+    created_redirect = redirect.create(db=database, redirect=random_redirect())
+    lookups = []
+    release = threading.Event()
+    get_redirect = server.get_redirect
+
+    def held_get_redirect(**kwargs: Any) -> redirect.Model:
+        lookups.append(kwargs["key"])
+        assert release.wait(WAIT_TIMEOUT), "the lookup was never released"
+        return get_redirect(**kwargs)
+
+    monkeypatch.setattr(server, "get_redirect", held_get_redirect)
+    before_count = metrics.COALESCED_LOOKUPS.get()
+    responses = []
+
+    def request() -> None:
+        responses.append(client.get(f"/{created_redirect.key}", allow_redirects=False))
+
+    threads = [threading.Thread(target=request, daemon=True) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # hold the first lookup until every other request is waiting on it
+    wait_until(lambda: server._redirect_lookups.waiting() == 7)
+    release.set()
+    join_all(threads)
+
+    assert [response.status_code for response in responses] == [307] * 8
+    assert len(lookups) == 1
+    assert metrics.COALESCED_LOOKUPS.get() == before_count + 7
+
+    # nothing is cached, so a later request looks the redirect up again
+    response = client.get(f"/{created_redirect.key}", allow_redirects=False)
+    assert response.status_code == 307
+    assert len(lookups) == 2
+
+
+def test_reload_settings(database: Database, server_settings: ServerSettings) -> None:
+    "are settings saved to the database swapped in"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = server_settings
+    assert not reload_settings(app), "there are no saved settings yet"
+
+    new_settings = server_settings.copy(update={"key_length": 7})
+    save_config(db=database, new_settings=new_settings)
+    assert reload_settings(app)
+    assert app.state.settings == new_settings
+    assert not reload_settings(app), "nothing has changed since the last reload"
+
+
+def test_reload_keeps_restart_required(
+    database: Database, server_settings: ServerSettings, tmp_path: Path
+) -> None:
+    "do settings that need a restart keep the values the server is running with"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = server_settings
+    save_config(
+        db=database,
+        new_settings=server_settings.copy(
+            update={
+                "key_length": 7,
+                "api_key": "changed",
+                "port": server_settings.port + 1,
+                "read_only": True,
+                "backup_directory": tmp_path,
+            }
+        ),
+    )
+    assert reload_settings(app)
+    assert app.state.settings.key_length == 7
+    assert app.state.settings == server_settings.copy(update={"key_length": 7})
+
+
+def test_settings_watcher(database: Database, server_settings: ServerSettings) -> None:
+    "does a running server pick up settings saved to the database"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = server_settings
+    install_settings_watcher(app)
+
+    @app.get("/key_length")
+    def key_length(settings: ServerSettings = Depends(get_settings)) -> int:
+        "reports the current key_length"
+        return settings.key_length
+
+    with TestClient(app) as watched_client:
+        assert watched_client.get("/key_length").json() == 3
+        save_config(
+            db=database, new_settings=server_settings.copy(update={"key_length": 5})
+        )
+        for _ in range(100):
+            if watched_client.get("/key_length").json() == 5:
+                break
+            time.sleep(0.01)
+        assert watched_client.get("/key_length").json() == 5
+
+
+def test_expiry_sweeper(database: Database, server_settings: ServerSettings) -> None:
+    "does a running server delete expired redirects"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = server_settings.copy(update={"expiry_sweep_interval": 0.05})
+    install_expiry_sweeper(app)
+    expired_redirect = redirect.create(
+        db=database,
+        redirect=redirect.Model(
+            key="a",
+            uri=random_uri(),
+            expires_at=datetime.utcnow() + timedelta(milliseconds=50),
+        ),
+    )
+
+    def remaining() -> int:
+        with db_session:
+            return database.RedirectEntity.select().count()
+
+    app.include_router(app_router)
+
+    with TestClient(app) as sweeping_client:
+        for _ in range(100):
+            # the test client only runs the event loop during requests
+            sweeping_client.get(f"/{expired_redirect.key}", allow_redirects=False)
+            if remaining() == 0:
+                break
+            time.sleep(0.01)
+        assert remaining() == 0
+
+
+def test_redirect_hosts(database: Database, client: TestClient) -> None:
+    "is each domain answered from its own keys, and other domains rejected"
+    client.app.state.settings = client.app.state.settings.copy(
+        update={"domains": ["a.test", "b.test"]}
+    )
+    first = redirect.create(
+        db=database, redirect=redirect.Model(host="a.test", key="k", uri=random_uri())
+    )
+    second = redirect.create(
+        db=database, redirect=redirect.Model(host="b.test", key="k", uri=random_uri())
+    )
+
+    for host, expected in [("a.test", first), ("B.test:8000", second)]:
+        response = client.get("/k", headers={"host": host}, allow_redirects=False)
+        assert response.status_code == 307
+        assert response.headers["location"] == expected.uri
+
+    # redirects made before the server had domains are still reached
+    legacy = redirect.create(
+        db=database, redirect=redirect.Model(key="legacy", uri=random_uri())
+    )
+    for host in ["a.test", "b.test"]:
+        response = client.get("/legacy", headers={"host": host}, allow_redirects=False)
+        assert response.status_code == 307
+        assert response.headers["location"] == legacy.uri
+    # unless a domain has a redirect with the same key
+    own = redirect.create(
+        db=database,
+        redirect=redirect.Model(host="a.test", key="legacy", uri=random_uri()),
+    )
+    response = client.get("/legacy", headers={"host": "a.test"}, allow_redirects=False)
+    assert response.headers["location"] == own.uri
+
+    # unknown hosts are rejected before the database is used
+    client.app.state.db = None
+    response = client.get("/k", headers={"host": "c.test"}, allow_redirects=False)
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Unknown host"
+
+
+def test_integrity_checker(database: Database, server_settings: ServerSettings) -> None:
+    "does a running server check its database on a schedule"
+    app = FastAPI()
+    app.state.db = database
+    app.state.settings = server_settings.copy(update={"integrity_check_interval": 0.05})
+    install_integrity_checker(app)
+    app.include_router(app_router)
+
+    with TestClient(app) as checking_client:
+        for _ in range(100):
+            # the test client only runs the event loop during requests
+            checking_client.get(f"/{random_key()}", allow_redirects=False)
+            if getattr(app.state, "database_ok", None) is not None:
+                break
+            time.sleep(0.01)
+        assert app.state.database_ok is True
@@ -0,0 +1,310 @@
+"""
+tests the sync agent, which mirrors a server's redirects
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Set
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pony.orm import Database, db_session, select
+
+from mw_url_shortener import sync
+from mw_url_shortener.client import ApiClient, ClientError
+from mw_url_shortener.database import get_db, redirect
+from mw_url_shortener.database.interface import setup_db
+from mw_url_shortener.server import app_router
+from mw_url_shortener.settings import ServerSettings
+from mw_url_shortener.types import Key
+
+from .conftest import LiveApi
+from .test_database_uris import tracking_uri
+from .utils import join_all, random_uri, wait_until
+
+
+def make_mirror(path: Path) -> Database:
+    "makes an empty mirror, as the client subcommand does"
+    sync.prepare_mirror(path)
+    return setup_db(db=get_db(), filename=path)
+
+
+def api_client(live_api: LiveApi, password: str = "") -> ApiClient:
+    "a client for the live API"
+    return ApiClient(
+        server_url=live_api.server_url,
+        api_key=live_api.api_key,
+        username=live_api.username,
+        password=password or live_api.password,
+    )
+
+
+def test_sync(database: Database, live_api: LiveApi, tmp_path: Path) -> None:
+    "does the mirror follow the server's creates, updates, and deletes"
+    mirror = make_mirror(tmp_path / "mirror.sqlitedb")
+    created = [redirect.create(db=database, uri=random_uri()) for _ in range(5)]
+    created.append(
+        redirect.create(
+            db=database, redirect=redirect.Model(key="l", uri=tracking_uri())
+        )
+    )
+
+    with api_client(live_api) as client:
+        assert sync.sync_once(mirror, client, batch_size=2) == 6
+        assert redirect.list(db=mirror) == redirect.list(db=database)
+
+        changed = redirect.update(
+            db=database,
+            key=created[0].key,
+            updated_redirect=created[0].copy(update={"uri": random_uri()}),
+        )
+        moved = redirect.update(
+            db=database,
+            key=created[1].key,
+            updated_redirect=created[1].copy(update={"key": "moved"}),
+        )
+        redirect.delete(db=database, redirect=created[2])
+        # the same key, made again in the same batch
+        redirect.delete(db=database, redirect=created[3])
+        redirect.create(db=database, redirect=created[3].copy(update={"uri": "u:1"}))
+
+        assert sync.sync_once(mirror, client) == 6
+        assert sync.sync_once(mirror, client) == 0
+    assert redirect.list(db=mirror) == redirect.list(db=database)
+    assert redirect.get(db=mirror, key=changed.key) == changed
+    assert redirect.get(db=mirror, key=Key("moved")) == moved
+    with pytest.raises(redirect.RedirectNotFoundError):
+        redirect.get(db=mirror, key=created[2].key)
+
+
+def test_sync_snapshot(
+    database: Database,
+    live_api: LiveApi,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    "does a new mirror get the redirects made before the change log was added"
+    created = [redirect.create(db=database, uri=random_uri()) for _ in range(4)]
+    created.append(
+        redirect.create(
+            db=database,
+            redirect=redirect.Model(host="sho.rt", key="l", uri=tracking_uri()),
+        )
+    )
+    # as if they were made before there was a change log
+    with db_session:
+        database.execute('DELETE FROM "RedirectChangeEntity"')
+    redirect.create(db=database, uri=random_uri())
+    (logged,) = redirect.changes(db=database)
+
+    pages = []
+    snapshot = ApiClient.snapshot
+
+    def delete_while_paging(self: ApiClient, *args: Any, **kwargs: Any) -> Any:
+        page = snapshot(self, *args, **kwargs)
+        if not pages:
+            # a change to a redirect the mirror already has
+            redirect.delete(db=database, redirect=page.redirects[0])
+        pages.append(page)
+        return page
+
+    monkeypatch.setattr(ApiClient, "snapshot", delete_while_paging)
+    mirror = make_mirror(tmp_path / "mirror.sqlitedb")
+    with api_client(live_api) as client:
+        # 6 redirects, and the delete, which was made after the first page
+        assert sync.sync_once(mirror, client, batch_size=2) == 7
+        assert pages[0].sequence == logged.sequence
+        assert sync.read_cursor(mirror, client.server_url) == (
+            redirect.changes(db=database)[-1].sequence
+        )
+        assert redirect.list(db=mirror) == redirect.list(db=database)
+        assert len(redirect.list(db=mirror)) == 5
+
+        # sorts after the "*" redirects, so it isn't the one deleted
+        redirect.update(
+            db=database,
+            key=created[-1].key,
+            host=created[-1].host,
+            updated_redirect=created[-1].copy(update={"uri": random_uri()}),
+        )
+        assert sync.sync_once(mirror, client) == 1
+    assert len(pages) == 4
+    assert redirect.list(db=mirror) == redirect.list(db=database)
+
+
+def test_sync_resumes(database: Database, live_api: LiveApi, tmp_path: Path) -> None:
+    "does a restarted agent only ask for changes it hasn't applied"
+    path = tmp_path / "mirror.sqlitedb"
+    redirect.create(db=database, uri=random_uri())
+    with api_client(live_api) as client:
+        sync.sync_once(make_mirror(path), client)
+        cursor = sync.read_cursor(
+            setup_db(db=get_db(), filename=path), client.server_url
+        )
+        assert cursor == redirect.changes(db=database)[-1].sequence
+
+        redirect.create(db=database, uri=random_uri())
+        restarted = setup_db(db=get_db(), filename=path)
+        assert sync.sync_once(restarted, client) == 1
+        assert len(redirect.list(db=restarted)) == 2
+
+
+def test_run_agent(database: Database, live_api: LiveApi, tmp_path: Path) -> None:
+    "does a running agent pick up new changes until it's stopped"
+    mirror = make_mirror(tmp_path / "mirror.sqlitedb")
+    stop = threading.Event()
+    with api_client(live_api) as client:
+        agent = threading.Thread(
+            target=sync.run_agent,
+            kwargs={
+                "db": mirror,
+                "client": client,
+                "poll_interval": 0.01,
+                "stop": stop,
+            },
+        )
+        agent.start()
+        created = redirect.create(db=database, uri=random_uri())
+        for _ in range(200):
+            if redirect.list(db=mirror):
+                break
+            time.sleep(0.01)
+        stop.set()
+        agent.join()
+    assert redirect.list(db=mirror) == [created]
+
+
+def test_run_agent_sweeps_expired(
+    database: Database, live_api: LiveApi, tmp_path: Path
+) -> None:
+    "does a running agent delete redirects from the mirror once they expire"
+    mirror = make_mirror(tmp_path / "mirror.sqlitedb")
+    kept = redirect.create(db=database, uri=random_uri())
+    expiring = redirect.create(
+        db=database,
+        uri=random_uri(),
+        expires_at=datetime.utcnow() + timedelta(seconds=2),
+    )
+
+    def mirrored() -> Set[str]:
+        with db_session:
+            return set(select(found.key for found in mirror.RedirectEntity))
+
+    stop = threading.Event()
+    with api_client(live_api) as client:
+        agent = threading.Thread(
+            target=sync.run_agent,
+            kwargs={
+                "db": mirror,
+                "client": client,
+                "poll_interval": 0.01,
+                "stop": stop,
+                "expiry_sweep_interval": 0.01,
+            },
+            daemon=True,
+        )
+        agent.start()
+        try:
+            wait_until(lambda: expiring.key in mirrored())
+            wait_until(lambda: mirrored() == {kept.key})
+        finally:
+            stop.set()
+            join_all([agent])
+    # the server doesn't sweep here, so it still has the expired redirect
+    with db_session:
+        assert database.RedirectEntity.get(key=expiring.key)
+
+
+def test_refused(live_api: LiveApi, tmp_path: Path) -> None:
+    "is a wrong password reported, and the mirror left alone"
+    mirror = make_mirror(tmp_path / "mirror.sqlitedb")
+    with api_client(live_api, password="wrong") as client:
+        with pytest.raises(ClientError) as error:
+            sync.sync_once(mirror, client)
+    assert error.value.status == 401
+    assert sync.read_cursor(mirror, live_api.server_url) == 0
+
+
+def test_read_only_server(
+    database: Database, live_api: LiveApi, tmp_path: Path
+) -> None:
+    "can a server answer redirects from the mirror"
+    path = tmp_path / "mirror.sqlitedb"
+    created = redirect.create(db=database, uri=random_uri())
+    with api_client(live_api) as client:
+        sync.sync_once(make_mirror(path), client)
+
+    app = FastAPI()
+    app.state.db = setup_db(db=get_db(), filename=path)
+    app.state.settings = ServerSettings(
+        database_file=path, api_key="apikey", read_only=True
+    )
+    app.include_router(app_router)
+    response = TestClient(app).get(f"/{created.key}", allow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == created.uri
+
+
+def test_client_command(database: Database, live_api: LiveApi, tmp_path: Path) -> None:
+    "does the client subcommand catch the mirror up"
+    path = tmp_path / "mirror.sqlitedb"
+    # the setup subcommand would make this
+    make_mirror(path).disconnect()
+    redirect.create(db=database, uri=random_uri())
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "--database-file",
+            str(path),
+            "client",
+            "--server-url",
+            live_api.server_url,
+            "--api-key",
+            live_api.api_key,
+            "--username",
+            live_api.username,
+            "--once",
+        ],
+        env={**os.environ, "URL_SHORTENER_PASSWORD": live_api.password},
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert "applied 1 changes" in output
+    assert len(redirect.list(db=setup_db(db=get_db(), filename=path))) == 1
+
+
+def test_client_command_new_mirror(
+    database: Database, live_api: LiveApi, tmp_path: Path
+) -> None:
+    "does the client subcommand make a mirror that doesn't exist yet"
+    path = tmp_path / "new_mirror.sqlitedb"
+    created = redirect.create(db=database, uri=random_uri())
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "mw_url_shortener",
+            "client",
+            "--database-file",
+            str(path),
+            "--server-url",
+            live_api.server_url,
+            "--api-key",
+            live_api.api_key,
+            "--username",
+            live_api.username,
+            "--once",
+        ],
+        env={**os.environ, "URL_SHORTENER_PASSWORD": live_api.password},
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    assert redirect.list(db=setup_db(db=get_db(), filename=path)) == [created]
@@ -1,9 +1,32 @@
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from functools import partial
 from string import ascii_letters, digits
 from typing import List, Tuple, Union
 
 import pytest
 
-from mw_url_shortener.utils import orjson_dumps, safe_random_chars, unsafe_random_chars
+from mw_url_shortener.utils import (
+    ENTROPY_BLOCK_SIZE,
+    KEY_CHARACTERS,
+    CharacterTable,
+    SingleFlight,
+    normalize_host,
+    normalize_key,
+    orjson_dumps,
+    printable_characters_generator,
+    safe_key_chars,
+    safe_keys,
+    safe_random_chars,
+    unsafe_random_chars,
+    unsafe_random_string,
+    word_characters,
+)
+
+from .utils import WAIT_TIMEOUT, join_all, wait_until
 
 
 def test_orjson_dumps_types() -> None:
@@ -123,3 +146,191 @@ def test_safe_random_chars_bad_values(var: Union[int, float]) -> None:
     with pytest.raises(ValueError) as err:
         safe_random_chars(var)
     assert "safe_random_chars only takes positive integer values" in str(err.value)
+
+
+@pytest.mark.parametrize("length", [1, 100, ENTROPY_BLOCK_SIZE * 3])
+def test_safe_key_chars(length: int) -> None:
+    "are the right number of key characters returned, including past a block"
+    characters = safe_key_chars(length)
+    assert isinstance(characters, str)
+    assert len(characters) == length
+    assert set(characters) <= set(KEY_CHARACTERS)
+
+
+def test_safe_key_chars_uniform() -> None:
+    "is every key character about equally likely"
+    expected = 1000
+    counts = Counter(safe_key_chars(expected * len(KEY_CHARACTERS)))
+    assert set(counts) == set(KEY_CHARACTERS)
+    # about 10 standard deviations either side
+    assert all(700 < count < 1300 for count in counts.values())
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_safe_key_chars_after_fork() -> None:
+    "does a forked child make different keys than its parent"
+    # fill the buffer before forking
+    safe_key_chars(1)
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write_end, safe_key_chars(32).encode("ascii"))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end, "rb") as pipe:
+        child_key = pipe.read().decode("ascii")
+    os.waitpid(pid, 0)
+    assert len(child_key) == 32
+    assert child_key != safe_key_chars(32)
+
+
+@pytest.mark.parametrize(
+    "var", ["string", b"\xff\xff", object(), list((1, 2, 3)), tuple((1, 2, 3))]
+)
+def test_safe_key_chars_bad_types(
+    var: Union[str, bytes, object, List[int], Tuple[int, int, int]]
+) -> None:
+    "is an error raised for a length that isn't a number"
+    with pytest.raises(TypeError) as err:
+        safe_key_chars(var)
+    assert "safe_key_chars only takes positive integer values" in str(err.value)
+
+
+@pytest.mark.parametrize("var", [-1, -0.01, 0])
+def test_safe_key_chars_bad_values(var: Union[int, float]) -> None:
+    "is an error raised for a length that isn't positive"
+    with pytest.raises(ValueError) as err:
+        safe_key_chars(var)
+    assert "safe_key_chars only takes positive integer values" in str(err.value)
+
+
+def test_safe_keys() -> None:
+    "are many keys of the same length made at once"
+    keys = safe_keys(length=8, number=5000)
+    assert len(keys) == 5000
+    assert all(len(key) == 8 for key in keys)
+    assert set("".join(keys)) <= set(KEY_CHARACTERS)
+    # 62**8 possible keys makes a repeat very unlikely
+    assert len(set(keys)) == 5000
+
+
+@pytest.mark.parametrize("length,number", [(0, 1), (1, 0), (-1, 5)])
+def test_safe_keys_bad_values(length: int, number: int) -> None:
+    "is an error raised for a length or number that isn't positive"
+    with pytest.raises(ValueError) as err:
+        safe_keys(length=length, number=number)
+    assert "safe_keys only takes positive integer values" in str(err.value)
+
+
+def test_character_table() -> None:
+    "are characters found, listed, and sampled from every range"
+    table = CharacterTable([(ord("a"), ord("c")), (ord("x"), ord("x"))])
+    assert len(table) == 4
+    assert list(table) == ["a", "b", "c", "x"]
+    assert "b" in table and "x" in table
+    assert "d" not in table and "A" not in table and "ab" not in table
+    assert set(table.sample(1000)) == {"a", "b", "c", "x"}
+
+
+def test_printable_characters_generator() -> None:
+    "are all of the printable, non-whitespace characters generated, in order"
+    expected = (chr(code_point) for code_point in range(sys.maxunicode + 1))
+    assert list(printable_characters_generator()) == [
+        character
+        for character in expected
+        if character.isprintable() and not character.isspace()
+    ]
+
+
+def test_word_characters() -> None:
+    "does the table of word characters match the \\w regular expression"
+    word_re = re.compile(r"\w")
+    table = word_characters()
+    assert "_" in table
+    assert all(word_re.match(character) for character in table)
+    for code_point in range(0, sys.maxunicode + 1, 97):
+        character = chr(code_point)
+        assert bool(word_re.match(character)) == (character in table)
+
+
+def test_unsafe_random_string() -> None:
+    "is a string of word characters of the right length made"
+    characters = unsafe_random_string(1000)
+    assert len(characters) == 1000
+    assert re.match(r"^\w+$", characters)
+
+
+@pytest.mark.parametrize(
+    "key,casefold,expected",
+    [
+        ("abc", True, "abc"),
+        ("abc///", True, "abc"),
+        ("a%2Fb%20c", True, "a/b c"),
+        ("ABC", True, "abc"),
+        ("ABC/", False, "ABC"),
+        ("e\u0301", False, "\u00e9"),
+        ("Straße", True, "strasse"),
+    ],
+)
+def test_normalize_key(key: str, casefold: bool, expected: str) -> None:
+    "are the differences copied links pick up removed"
+    assert normalize_key(key, casefold=casefold) == expected
+
+
+@pytest.mark.parametrize(
+    "host,expected",
+    [
+        ("sho.rt", "sho.rt"),
+        ("Sho.RT:8000", "sho.rt"),
+        ("sho.rt.", "sho.rt"),
+        ("[::1]:8000", "[::1]"),
+        ("Bücher.example", "xn--bcher-kva.example"),
+        ("", ""),
+    ],
+)
+def test_normalize_host(host: str, expected: str) -> None:
+    "are Host headers and domains reduced to one form"
+    assert normalize_host(host) == expected
+
+
+def test_single_flight() -> None:
+    "do concurrent calls for one key share a call, and its result or error"
+    single_flight: SingleFlight[int] = SingleFlight()
+    release = threading.Event()
+    calls = Counter()
+    results: List[Tuple[int, bool]] = []
+    errors: List[BaseException] = []
+
+    def slow(key: str) -> int:
+        calls[key] += 1
+        assert release.wait(WAIT_TIMEOUT), "the call was never released"
+        if key == "bad":
+            raise KeyError(key)
+        return len(key)
+
+    def call(key: str) -> None:
+        try:
+            results.append(single_flight.do(key, partial(slow, key)))
+        except KeyError as err:
+            errors.append(err)
+
+    threads = [
+        threading.Thread(target=call, args=(key,), daemon=True)
+        for key in ["good"] * 5 + ["bad"] * 3
+    ]
+    for thread in threads:
+        thread.start()
+    # let every other thread start waiting before the calls finish
+    wait_until(lambda: single_flight.waiting() == 4 + 2)
+    release.set()
+    join_all(threads)
+    assert single_flight.waiting() == 0
+
+    assert calls == {"good": 1, "bad": 1}
+    assert sorted(results) == [(4, False)] + [(4, True)] * 4
+    assert len(errors) == 3 and len(set(map(id, errors))) == 1
+    # nothing is remembered once the call is done
+    assert single_flight.do("good", partial(slow, "good")) == (4, False)
+    assert calls["good"] == 2
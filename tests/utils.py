@@ -4,8 +4,10 @@ utilities used by the tests
 generally, these are utilities that can't work as pytest fixtures, since pytest fixtures provide the same value all throught a single test function, regardless of scope
 """
 import itertools
+import threading
+import time
 from random import randint
-from typing import Iterable
+from typing import Callable, Iterable
 
 import faker  # faker fixture required for tests
 
@@ -87,3 +89,25 @@ def all_combinations(characters: str, length: int) -> Iterable[str]:
             yield "".join(three_str_tuple)
 
     return combo_gen()
+
+
+# How long, in seconds, a test waits for other threads before it fails
+WAIT_TIMEOUT = 10.0
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float = WAIT_TIMEOUT) -> None:
+    "waits for predicate to be true, and fails if it isn't within timeout"
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, f"still waiting after {timeout}s"
+        time.sleep(0.001)
+
+
+def join_all(
+    threads: Iterable[threading.Thread], timeout: float = WAIT_TIMEOUT
+) -> None:
+    "joins every thread, and fails if any are still running after timeout"
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+        assert not thread.is_alive(), f"{thread.name} still running after {timeout}s"